@@ -0,0 +1,108 @@
+# Written by Keith Jolley
+# Copyright (c) 2024, University of Oxford
+# E-mail: keith.jolley@biology.ox.ac.uk
+#
+# This file is part of BIGSdb Python Toolkit.
+#
+# BIGSdb Python Toolkit is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BIGSdb Python Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BIGSdb Python Toolkit. If not,
+# see <https://www.gnu.org/licenses/>.
+
+import argparse
+import json
+import multiprocessing
+import multiprocessing.connection
+import signal
+import sys
+import os
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--module_dir", type=str, required=True, help="Plugin module directory"
+)
+parser.add_argument("--log_file", type=str, required=False, help="BIGSdb log file")
+parser.add_argument(
+    "--workers", type=int, default=1, help="Number of worker processes (default 1)"
+)
+parser.add_argument(
+    "--max_jobs",
+    type=int,
+    required=False,
+    help="Number of jobs a worker process runs before it is restarted",
+)
+parser.add_argument(
+    "--poll_interval",
+    type=int,
+    default=5,
+    help="Seconds between checks of an empty queue (default 5)",
+)
+parser.add_argument(
+    "--queue_metrics",
+    action="store_true",
+    help="Show queue depth and wait time metrics (JSON) and exit",
+)
+args = parser.parse_args()
+
+sys.path.insert(0, args.module_dir)
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "src")))
+
+from bigsdb.job_worker import JobWorker
+
+
+def run_worker():
+    worker = JobWorker(
+        module_dir=args.module_dir,
+        log_file=args.log_file,
+        options={"max_jobs": args.max_jobs, "poll_interval": args.poll_interval},
+    )
+    worker.run()
+
+
+def main():
+    if args.queue_metrics:
+        worker = JobWorker(module_dir=args.module_dir, log_file=args.log_file)
+        print(json.dumps(worker.job_manager.get_queue_metrics(), indent=2))
+        return
+    if args.workers < 1:
+        raise ValueError("--workers must be at least 1.")
+    if args.workers == 1 and not args.max_jobs:
+        run_worker()
+        return
+    processes = []
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # Each worker has its own connections. Workers that exit after max_jobs
+    # are replaced until the daemon is stopped.
+    while not stopping:
+        processes = [process for process in processes if process.is_alive()]
+        while len(processes) < args.workers and not stopping:
+            process = multiprocessing.Process(target=run_worker)
+            process.start()
+            processes.append(process)
+        multiprocessing.connection.wait([p.sentinel for p in processes])
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -19,9 +19,22 @@
 # see <https://www.gnu.org/licenses/>.
 
 import os
+import math
+import pickle
+import shutil
+import signal
+import tempfile
+import multiprocessing
 from pathlib import Path
 import bigsdb.utils
 from bigsdb.plugin import Plugin
+from bigsdb.excel_writer import ExcelWriter
+from bigsdb.parallel_gzip import ParallelGzipWriter
+
+EXPORT_CHUNK_SIZE = 1000
+# Minimum number of isolates exported by each worker process when the export
+# is split between processes.
+PARALLEL_EXPORT_MIN_CHUNK_SIZE = 5000
 
 
 class PyExport(Plugin):
@@ -57,6 +70,7 @@ class PyExport(Plugin):
             "image": None,
             "system_flag": "DatasetExport",
             "enabled_by_default": 1,
+            "result_cache_ttl": 3600,
         }
 
     def run(self):
@@ -158,6 +172,7 @@ class PyExport(Plugin):
                 "loci": loci,
                 "username": self.username,
                 "email": self.email,
+                **self.get_result_cache_params(),
             }
         )
         print(self.get_job_redirect(job_id))
@@ -173,16 +188,24 @@ class PyExport(Plugin):
                 eav_fields.append(field)
         return eav_fields
 
-    def _get_header(self, job_id):
+    # Define the output columns once so that the header and every row are built
+    # from the same plan.
+    def _get_columns(self, job_id):
+        columns = []
         param_fields = self.params.get("fields", "").split("||")
-        header = []
         for field in param_fields:
             if self.parser.is_field(field):
-                header.append(field)
+                columns.append({"type": "field", "field": field, "heading": field})
             elif "___" in field:  # Extended attribute
-                header.append(field.split("___")[1])
-        eav_fields = self._get_selected_eav_fields()
-        header.extend(eav_fields)
+                columns.append(
+                    {
+                        "type": "extended_attribute",
+                        "field": field,
+                        "heading": field.split("___")[1],
+                    }
+                )
+        for field in self._get_selected_eav_fields():
+            columns.append({"type": "eav_field", "field": field, "heading": field})
         schemes = self.datastore.run_query(
             "SELECT id FROM schemes ORDER BY id", None, {"fetch": "col_arrayref"}
         )
@@ -194,16 +217,26 @@ class PyExport(Plugin):
                     for locus in loci:
                         if not locus_used.get(locus):
                             locus_used[locus] = 1
-                            header.append(locus)
+                            columns.append(
+                                {"type": "locus", "locus": locus, "heading": locus}
+                            )
                 if self.params.get("scheme_fields"):
                     fields = self.datastore.get_scheme_fields(scheme_id)
-                    header.extend(fields)
+                    for field in fields:
+                        columns.append(
+                            {
+                                "type": "scheme_field",
+                                "scheme_id": scheme_id,
+                                "field": field,
+                                "heading": field,
+                            }
+                        )
         loci = self.job_manager.get_job_loci(job_id)
         for locus in loci:
             if not locus_used.get(locus):
                 locus_used[locus] = 1
-                header.append(locus)
-        return header
+                columns.append({"type": "locus", "locus": locus, "heading": locus})
+        return columns
 
     def _get_prov_fields(self):
         param_fields = self.params.get("fields", "").split("||")
@@ -214,128 +247,60 @@ class PyExport(Plugin):
         return fields
 
     def run_job(self, job_id):
-        view = self.system.get("view")
         ids = self.job_manager.get_job_isolates(job_id)
-        isolate_table = self.datastore.create_temp_list_table_from_list("int", ids)
-        loci = self.job_manager.get_job_loci(job_id)
-        locus_table = self.datastore.create_temp_list_table_from_list("text", loci)
-        schemes = self.datastore.run_query(
-            "SELECT id FROM schemes ORDER BY id", None, {"fetch": "col_arrayref"}
-        )
-
+        columns = self._get_columns(job_id)
+        header = [column["heading"] for column in columns]
+        self.export_columns = columns
+        progress = self.job_manager.get_progress_reporter(job_id)
+        processes = self._get_export_processes(len(ids))
+        # Worker processes are started before any output threads so that
+        # they are forked from a single-threaded process.
+        workers = self._start_export_workers(ids, processes) if processes > 1 else None
         outfile = f"{self.config['tmp_dir']}/{job_id}.txt"
-        param_fields = self.params.get("fields", "").split("||")
-        header = self._get_header(job_id)
-        fields = self._get_prov_fields()
-
-        if "id" not in fields:
-            fields.insert(0, "id")
-
-        qry = (
-            f"SELECT "
-            + ",".join(fields)
-            + f" FROM {view} v JOIN {isolate_table} l ON v.id=l.value ORDER BY id"
-        )
-        results = self.datastore.run_query(
-            qry, None, {"fetch": "all_arrayref", "slice": {}}
-        )
-        eav_fields = self._get_selected_eav_fields()
-        last_progress = 0
-        total = len(results)
-        with open(outfile, "w") as f:
-            f.write("\t".join(header) + "\n")
-            i = 0
-            for record in results:
-                row_values = []
-                for field in param_fields:
-                    if self.parser.is_field(field):
-                        row_values.append(record.get(field, ""))
-                    elif "___" in field:  # Extended attribute
-                        ext_value = self._get_extended_attribute_value(record, field)
-                        row_values.append(ext_value or "")
-                for field in eav_fields:
-                    row_values.append(
-                        str(
-                            self.datastore.get_eav_field_value(record["id"], field)
-                            or ""
-                        )
-                    )
-                designations = (
-                    self.datastore.get_allele_designations_with_locus_list_table(
-                        record["id"], locus_table
-                    )
-                )
-                alleles = {}
-                for designation in designations:
-                    if alleles.get(designation["locus"]) == None:
-                        alleles[designation["locus"]] = []
-                    alleles[designation["locus"]].append(designation["allele_id"])
-
-                locus_used = {}
-                for scheme_id in schemes:
-                    if self.params.get(f"s_{scheme_id}"):
-                        if self.params.get("scheme_members"):
-                            loci = self.datastore.get_scheme_loci(scheme_id)
-                            for locus in loci:
-                                if not locus_used.get(locus):
-                                    locus_used[locus] = 1
-                                    row_values.append("; ".join(alleles.get(locus, [])))
-                        if self.params.get("scheme_fields"):
-                            fields = self.datastore.get_scheme_fields(scheme_id)
-                            if len(fields):
-                                field_values = self.datastore.get_scheme_field_values_by_isolate_id(
-                                    isolate_id=record["id"], scheme_id=scheme_id
-                                )
-
-                                for field in fields:
-                                    if field_values.get(field):
-                                        sorted_keys = sorted(
-                                            field_values[field].keys(), key=_sort_keys
-                                        )
-                                        try:
-                                            row_values.append(
-                                                "; ".join(list(sorted_keys))
-                                            )
-                                        except:
-                                            row_values.append("")
-                                    else:
-                                        row_values.append("")
-                for locus in loci:
-                    if not locus_used.get(locus):
-                        locus_used[locus] = 1
-                        row_values.append("; ".join(alleles.get(locus, [])))
-
-                i += 1
-                f.write(
-                    "\t".join(self._convert_to_string(value) for value in row_values)
-                    + "\n"
-                )
-                progress = int(80 * (i / total))
-                if progress > last_progress:
-                    last_progress = progress
-                    self.job_manager.update_job_status(
-                        job_id, {"percent_complete": progress}
-                    )
+        excel_file = f"{self.config['tmp_dir']}/{job_id}.xlsx"
+        try:
+            # The Excel file is written at the same time as the text file.
+            excel_writer = ExcelWriter(
+                excel_file,
+                header,
+                {
+                    "worksheet": "Export",
+                    "text_fields": self.system.get("labelfield"),
+                },
+            )
+            # A compressed copy of the text file is also written as it is
+            # produced so that it does not have to be compressed once the job
+            # has finished.
+            gzip_writer = ParallelGzipWriter(
+                f"{outfile}.gz", self.job_manager.get_gzip_options()
+            )
+            with open(outfile, "w") as f, excel_writer, gzip_writer:
+                line = "\t".join(header) + "\n"
+                f.write(line)
+                gzip_writer.write(line)
+                if workers:
+                    rows = self._get_worker_rows(workers, len(ids), progress)
+                else:
+                    rows = self._get_rows(ids, progress)
+                for string_values in rows:
+                    line = "\t".join(string_values) + "\n"
+                    f.write(line)
+                    gzip_writer.write(line)
+                    excel_writer.write_row(string_values)
+        finally:
+            if workers:
+                self._stop_export_workers(workers)
         if not Path(outfile).is_file():
             self.logger.error(f"File {outfile} does not exist")
             return
+        progress.update({"percent_complete": 90, "stage": "Compressing output files"})
         self.job_manager.update_job_output(
             job_id,
             {
                 "filename": f"{job_id}.txt",
                 "description": "01_Export table (text)",
                 "compress": 1,
-                "keep_original": 1,  # Original needed to generate Excel file
-            },
-        )
-        self.job_manager.update_job_status(
-            job_id, {"percent_complete": 80, "stage": "Creating Excel file"}
-        )
-        excel_file = bigsdb.utils.text2excel(
-            outfile,
-            {
-                "worksheet": "Export",
-                "text_fields": self.system.get("labelfield"),
+                "precompressed": 1,
             },
         )
         if Path(excel_file).is_file():
@@ -348,8 +313,185 @@ class PyExport(Plugin):
                 },
             )
 
-        if Path(f"{outfile}.gz").is_file():
-            Path(outfile).unlink()
+    # Large exports are split between worker processes if export_processes is
+    # set in bigsdb.conf.
+    def _get_export_processes(self, total):
+        processes = self.config.get("export_processes", 1)
+        if not isinstance(processes, int) or processes < 2:
+            return 1
+        return max(1, min(processes, total // PARALLEL_EXPORT_MIN_CHUNK_SIZE))
+
+    # Returns the formatted values of each row, in id order, for the isolates.
+    # progress is updated as rows are produced unless a callback is given
+    # instead.
+    def _get_rows(self, ids, progress=None, callback=None):
+        view = self.system.get("view")
+        columns = self.export_columns
+        isolate_table = self.datastore.create_temp_list_table_from_list("int", ids)
+        fields = self._get_prov_fields()
+        if "id" not in fields:
+            fields.insert(0, "id")
+
+        # Each class of data is retrieved with one query per chunk of isolates
+        # rather than one (or more) queries per isolate.
+        eav_fields = [col["field"] for col in columns if col["type"] == "eav_field"]
+        scheme_ids = list(
+            dict.fromkeys(
+                col["scheme_id"] for col in columns if col["type"] == "scheme_field"
+            )
+        )
+        loci = {col["locus"] for col in columns if col["type"] == "locus"}
+        locus_list = sorted(loci)
+        locus_table = self.datastore.create_temp_list_table_from_list(
+            "text", locus_list
+        )
+        designation_matrix = None
+        if loci and self.config.get("designation_matrix"):
+            try:
+                designation_matrix = self.datastore.get_designation_matrix()
+            except Exception as e:
+                self.logger.error(f"Designation matrix not used: {e}")
+        qry = (
+            f"SELECT "
+            + ",".join(fields)
+            + f" FROM {view} v JOIN {isolate_table} l ON v.id=l.value ORDER BY id"
+        )
+        results = self.datastore.run_query(qry, None, {"fetch": "iter_hashref"})
+        total = len(ids)
+        i = 0
+        for chunk in bigsdb.utils.batch(results, EXPORT_CHUNK_SIZE):
+            chunk_ids = [record["id"] for record in chunk]
+            eav_values = (
+                self.datastore.get_eav_values(chunk_ids, eav_fields)
+                if eav_fields
+                else {}
+            )
+            designations = {}
+            if loci and designation_matrix:
+                try:
+                    designations = designation_matrix.get_designations(
+                        chunk_ids, locus_list
+                    )
+                except Exception as e:
+                    self.logger.error(f"Designation matrix not used: {e}")
+                    designation_matrix = None
+            if loci and not designation_matrix:
+                designations = self.datastore.get_allele_designations_by_isolate_ids(
+                    chunk_ids, locus_table
+                )
+            scheme_field_values = {
+                scheme_id: self.datastore.get_scheme_field_values_by_isolate_ids(
+                    chunk_ids, scheme_id
+                )
+                for scheme_id in scheme_ids
+            }
+            for record in chunk:
+                isolate_designations = designations.get(record["id"], {})
+                row_values = []
+                for column in columns:
+                    if column["type"] == "field":
+                        row_values.append(record.get(column["field"], ""))
+                    elif column["type"] == "extended_attribute":
+                        row_values.append(
+                            self._get_extended_attribute_value(record, column["field"])
+                        )
+                    elif column["type"] == "eav_field":
+                        row_values.append(
+                            eav_values.get(record["id"], {}).get(column["field"]) or ""
+                        )
+                    elif column["type"] == "locus":
+                        row_values.append(
+                            "; ".join(
+                                designation["allele_id"]
+                                for designation in isolate_designations.get(
+                                    column["locus"], []
+                                )
+                            )
+                        )
+                    elif column["type"] == "scheme_field":
+                        field_values = scheme_field_values[column["scheme_id"]].get(
+                            record["id"], {}
+                        )
+                        row_values.append(
+                            self._format_scheme_field_value(
+                                field_values.get(column["field"])
+                            )
+                        )
+                i += 1
+                yield [self._convert_to_string(value) for value in row_values]
+                if progress:
+                    progress.set_progress(int(90 * (i / total)))
+            if callback:
+                callback(len(chunk))
+
+    # The isolate list is split into contiguous ranges of ids, each of which is
+    # exported by a worker process to a part file. The parts are read back in
+    # order so the output is the same as that of a single process.
+    def _start_export_workers(self, ids, processes):
+        ids = sorted(ids)
+        chunk_size = max(
+            PARALLEL_EXPORT_MIN_CHUNK_SIZE, math.ceil(len(ids) / (processes * 4))
+        )
+        part_dir = tempfile.mkdtemp(prefix="export_", dir=self.config["tmp_dir"])
+        context = multiprocessing.get_context("fork")
+        counter = context.Value("i", 0)
+        pool = context.Pool(
+            processes, initializer=_init_export_worker, initargs=(self, counter)
+        )
+        results = [
+            pool.apply_async(
+                _export_part, (f"{part_dir}/{i}.pickle", ids[i : i + chunk_size])
+            )
+            for i in range(0, len(ids), chunk_size)
+        ]
+        return {
+            "pool": pool,
+            "results": results,
+            "counter": counter,
+            "part_dir": part_dir,
+        }
+
+    def _get_worker_rows(self, workers, total, progress):
+        for result in workers["results"]:
+            # Progress is the number of rows exported by all workers.
+            while not result.ready():
+                result.wait(1)
+                progress.set_progress(int(90 * (workers["counter"].value / total)))
+            part_file = result.get()
+            with open(part_file, "rb") as f:
+                while True:
+                    try:
+                        rows = pickle.load(f)
+                    except EOFError:
+                        break
+                    yield from rows
+            os.remove(part_file)
+        progress.set_progress(90)
+
+    def _stop_export_workers(self, workers):
+        workers["pool"].terminate()
+        workers["pool"].join()
+        shutil.rmtree(workers["part_dir"], ignore_errors=True)
+
+    def _write_export_part(self, part_file, ids, counter):
+        def add_to_counter(rows):
+            with counter.get_lock():
+                counter.value += rows
+
+        with open(part_file, "wb") as f:
+            rows = self._get_rows(ids, callback=add_to_counter)
+            for chunk in bigsdb.utils.batch(rows, EXPORT_CHUNK_SIZE):
+                pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return part_file
+
+    def _format_scheme_field_value(self, field_values):
+        if not field_values:
+            return ""
+        sorted_keys = sorted(field_values.keys(), key=_sort_keys)
+        try:
+            return "; ".join(list(sorted_keys))
+        except:
+            return ""
 
     def _convert_to_string(self, value):
         if value is None:
@@ -359,23 +501,26 @@ class PyExport(Plugin):
         else:
             return str(value)
 
-    def _get_extended_attribute_value(self, record, field):
+    def _load_extended_attribute_values(self, field):
         isolate_field, attribute = field.split("___")
+        data = self.datastore.run_query(
+            "SELECT field_value,value FROM isolate_value_extended_attributes WHERE "
+            "(isolate_field,attribute)=(?,?)",
+            [isolate_field, attribute],
+            {"fetch": "all_arrayref"},
+        )
+        self.cache["extended_attribute_values"][field] = {
+            field_value: value for field_value, value in data
+        }
+
+    def _get_extended_attribute_value(self, record, field):
+        isolate_field = field.split("___")[0]
         if record.get(isolate_field, "") == "":
             return ""
-        if not self.cache["extended_attributes"][attribute][record[isolate_field], ""]:
-            self.cache["extended_attributes"][attribute][
-                record.get(isolate_field)
-            ] = self.datastore.run_query(
-                "SELECT value FROM isolate_value_extended_attributes WHERE "
-                "(isolate_field,attribute,field_value)=(?,?,?)",
-                [
-                    isolate_field,
-                    attribute,
-                    record[isolate_field],
-                ],
-            )
-        return self.cache["extended_attributes"][attribute][record[isolate_field]] or ""
+        if field not in self.cache["extended_attribute_values"]:
+            self._load_extended_attribute_values(field)
+        values = self.cache["extended_attribute_values"][field]
+        return values.get(str(record[isolate_field])) or ""
 
     def get_plugin_javascript(self):
         return """
@@ -391,6 +536,25 @@ $(document).ready(function(){
 """
 
 
+_export_worker = {}
+
+
+def _init_export_worker(plugin, counter):
+    # Signal handlers inherited from a job worker would stop the pool from
+    # terminating its processes.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    plugin.initiate_worker_process()
+    _export_worker["plugin"] = plugin
+    _export_worker["counter"] = counter
+
+
+def _export_part(part_file, ids):
+    return _export_worker["plugin"]._write_export_part(
+        part_file, ids, _export_worker["counter"]
+    )
+
+
 def _sort_keys(key):
     try:
         # Try to convert the key to an integer
@@ -0,0 +1,90 @@
+# Written by Keith Jolley
+# Copyright (c) 2024, University of Oxford
+# E-mail: keith.jolley@biology.ox.ac.uk
+#
+# This file is part of BIGSdb Python Toolkit.
+#
+# BIGSdb Python Toolkit is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BIGSdb Python Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BIGSdb Python Toolkit. If not,
+# see <https://www.gnu.org/licenses/>.
+
+# This script moves jobs that ended more than a set number of days ago (with
+# their parameters, isolate, profile and locus lists and output records) from
+# the jobs database tables to the archive tables created by
+# sql/jobs_archive.sql, or deletes them with --purge. Run it regularly, e.g.
+# daily from cron, so that the jobs table only holds active and recent jobs.
+
+# Version 20241018
+
+import os
+import sys
+import logging
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+
+from bigsdb.base_application import BaseApplication
+from bigsdb.data_connector import DataConnector
+from bigsdb.job_manager import JobManager
+from bigsdb.constants import DIRS
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "-c", "--config_dir", default=DIRS["CONFIG_DIR"], help="BIGSdb config directory"
+)
+parser.add_argument(
+    "-d",
+    "--days",
+    type=int,
+    help="Archive jobs that ended more than this number of days ago "
+    "(default job_archive_days in bigsdb.conf or 90)",
+)
+parser.add_argument(
+    "-b", "--batch_size", type=int, help="Number of jobs moved in each transaction"
+)
+parser.add_argument(
+    "-p",
+    "--purge",
+    action="store_true",
+    help="Delete jobs and their output files rather than archiving them",
+)
+args = parser.parse_args()
+
+
+def main():
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+    app = BaseApplication(config_dir=args.config_dir, testing=True, logger=logger)
+    app._read_db_config_file()
+    app._read_host_mapping_file()
+    job_manager = JobManager(
+        data_connector=DataConnector(system={}, config=app.config, logger=logger),
+        system={},
+        config=app.config,
+        logger=logger,
+    )
+    options = {"purge": args.purge}
+    if args.days is not None:
+        options["days"] = args.days
+    if args.batch_size is not None:
+        options["batch_size"] = args.batch_size
+    try:
+        job_manager.archive_jobs(options)
+    except Exception as e:
+        logger.error(f"Job archival failed: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+# Written by Keith Jolley
+# Copyright (c) 2024, University of Oxford
+# E-mail: keith.jolley@biology.ox.ac.uk
+#
+# This file is part of BIGSdb Python Toolkit.
+#
+# BIGSdb Python Toolkit is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BIGSdb Python Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BIGSdb Python Toolkit. If not,
+# see <https://www.gnu.org/licenses/>.
+
+# This script compares the time taken by the admission checks made when a job
+# is submitted (duplicate job, queued jobs from the same IP address and the
+# database and user quotas) using the previous separate queries and the
+# current single statement, with and without the partial indexes in
+# sql/jobs_indexes.sql. It runs against a temporary copy of the jobs table
+# filled with historic jobs, so the real jobs table is not touched.
+
+# Version 20241018
+
+import os
+import sys
+import time
+import logging
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+
+from bigsdb.data_connector import DataConnector
+from bigsdb.job_manager import JobManager
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-d", "--database", default="bigsdb_jobs", help="Jobs database")
+parser.add_argument("--host", default="localhost", help="Database host")
+parser.add_argument("--port", type=int, default=5432, help="Database port")
+parser.add_argument("--user", help="Database user")
+parser.add_argument("--password", help="Database password")
+parser.add_argument(
+    "-r", "--rows", type=int, default=1000000, help="Number of historic jobs"
+)
+parser.add_argument("-a", "--active", type=int, default=200, help="Active jobs")
+parser.add_argument(
+    "-i", "--iterations", type=int, default=200, help="Submissions to time"
+)
+args = parser.parse_args()
+
+OLD_QUERIES = [
+    "SELECT EXISTS(SELECT * FROM jobs WHERE (ip_address,status)=(%(ip_address)s,"
+    "'submitted'))",
+    "SELECT id FROM jobs WHERE fingerprint=%(fingerprint)s AND (status='started' "
+    "OR status='submitted') AND username=%(username)s",
+    "SELECT COUNT(*) FROM jobs WHERE dbase_config=%(dbase_config)s AND status IN "
+    "('submitted','started')",
+    "SELECT COUNT(*) FROM jobs WHERE (dbase_config,username)=(%(dbase_config)s,"
+    "%(username)s) AND status IN ('submitted','started')",
+]
+
+
+def get_job_manager():
+    logger = logging.getLogger(__name__)
+    logger.addHandler(logging.StreamHandler())
+    config = {
+        "jobs_db": args.database,
+        "dbhost": args.host,
+        "dbport": args.port,
+        "dbuser": args.user,
+        "dbpassword": args.password,
+        "host_map": {},
+    }
+    system = {"job_quota": 100, "user_job_quota": 10}
+    return JobManager(
+        data_connector=DataConnector(system=system, config=config, logger=logger),
+        system=system,
+        config=config,
+        logger=logger,
+    )
+
+
+# A temporary table takes precedence over the permanent jobs table for the
+# rest of the session.
+def create_jobs_table(db):
+    cursor = db.cursor()
+    cursor.execute("CREATE TEMP TABLE jobs (LIKE public.jobs INCLUDING DEFAULTS)")
+    cursor.execute(
+        "INSERT INTO jobs (id,dbase_config,username,email,ip_address,submit_time,"
+        "start_time,stop_time,module,status,percent_complete,priority,fingerprint) "
+        "SELECT 'BIGSdb_hist_'||i,'db_'||(i%50),'user_'||(i%5000),'',"
+        "'10.0.'||(i%250)||'.'||(i%200),now()-(i||' minutes')::interval,"
+        "now()-(i||' minutes')::interval,now()-(i||' minutes')::interval,"
+        "'PyExport',CASE WHEN i%20=0 THEN 'failed' ELSE 'finished' END,100,5,"
+        "md5(i::text) FROM generate_series(1,%s) i",
+        [args.rows],
+    )
+    cursor.execute(
+        "INSERT INTO jobs (id,dbase_config,username,email,ip_address,submit_time,"
+        "module,status,percent_complete,priority,fingerprint) SELECT "
+        "'BIGSdb_active_'||i,'db_'||(i%50),'user_'||(i%100),'','10.1.0.'||(i%100),"
+        "now(),'PyExport',CASE WHEN i%4=0 THEN 'started' ELSE 'submitted' END,0,5,"
+        "md5('active'||i) FROM generate_series(1,%s) i",
+        [args.active],
+    )
+    cursor.execute("ANALYZE jobs")
+    db.commit()
+
+
+def create_indexes(db):
+    with open(os.path.join(os.path.dirname(__file__), "../sql/jobs_indexes.sql")) as f:
+        statements = f.read().replace("CONCURRENTLY ", "")
+    cursor = db.cursor()
+    cursor.execute(statements)
+    db.commit()
+
+
+def get_submission(i):
+    return {
+        "dbase_config": f"db_{i % 50}",
+        "username": f"user_{i % 100}",
+        "ip_address": f"10.1.0.{i % 100}",
+        "fingerprint": f"new_{i}",
+    }
+
+
+def time_old_queries(db):
+    cursor = db.cursor()
+    start = time.perf_counter()
+    for i in range(args.iterations):
+        for qry in OLD_QUERIES:
+            cursor.execute(qry, get_submission(i))
+            cursor.fetchall()
+    db.rollback()
+    return time.perf_counter() - start
+
+
+def time_admission_check(job_manager):
+    start = time.perf_counter()
+    for i in range(args.iterations):
+        submission = get_submission(i)
+        job_manager._check_admission(submission, submission["fingerprint"])
+    job_manager.db.rollback()
+    return time.perf_counter() - start
+
+
+def report(label, elapsed):
+    print(f"{label}: {1000 * elapsed / args.iterations:.3f}ms per submission")
+
+
+def main():
+    job_manager = get_job_manager()
+    create_jobs_table(job_manager.db)
+    print(
+        f"{args.rows} historic jobs, {args.active} active jobs, "
+        f"{args.iterations} submissions."
+    )
+    report("Separate queries, no indexes", time_old_queries(job_manager.db))
+    report("Single statement, no indexes", time_admission_check(job_manager))
+    create_indexes(job_manager.db)
+    report("Separate queries, partial indexes", time_old_queries(job_manager.db))
+    report("Single statement, partial indexes", time_admission_check(job_manager))
+
+
+if __name__ == "__main__":
+    main()
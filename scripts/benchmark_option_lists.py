@@ -0,0 +1,104 @@
+# Written by Keith Jolley
+# Copyright (c) 2024, University of Oxford
+# E-mail: keith.jolley@biology.ox.ac.uk
+#
+# This file is part of BIGSdb Python Toolkit.
+#
+# BIGSdb Python Toolkit is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BIGSdb Python Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BIGSdb Python Toolkit. If not,
+# see <https://www.gnu.org/licenses/>.
+
+# This script times building the option lists for every field with an optlist
+# in an isolate database config.xml, as is done when rendering a form. The
+# previous behaviour (a new collator built and the list sorted on each call)
+# is timed alongside the current cached behaviour.
+
+# Version 20241018
+
+import argparse
+import time
+import pyuca
+from bigsdb.xml_parser import XMLParser
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-c", "--config", required=True, help="Path to config.xml")
+parser.add_argument(
+    "-r", "--renders", type=int, default=20, help="Number of form renders"
+)
+parser.add_argument(
+    "-s",
+    "--sort",
+    action="store_true",
+    help="Treat all option lists as sorted (sort=yes)",
+)
+args = parser.parse_args()
+
+
+def get_parser():
+    xml_parser = XMLParser()
+    xml_parser.parse(args.config)
+    if args.sort:
+        for field in xml_parser.optlists:
+            xml_parser.attributes[field]["sort"] = "yes"
+    return xml_parser
+
+
+def render_uncached(xml_parser):
+    for field in xml_parser.optlists:
+        values = []
+        if "values" in xml_parser.attributes[field]:
+            values.extend(
+                xml_parser._get_special_optlist_values(
+                    xml_parser.attributes[field]["values"]
+                )
+            )
+        values.extend(xml_parser.optlists[field])
+        if xml_parser.attributes[field].get("sort") == "yes":
+            collator = pyuca.Collator()
+            values = sorted(values, key=collator.sort_key)
+
+
+def render_cached(xml_parser):
+    for field in xml_parser.optlists:
+        xml_parser.get_field_option_list(field)
+
+
+def benchmark(label, render):
+    xml_parser = get_parser()
+    start = time.perf_counter()
+    for _ in range(args.renders):
+        render(xml_parser)
+    elapsed = time.perf_counter() - start
+    print(
+        f"{label}: {elapsed:.3f}s total; "
+        f"{1000 * elapsed / args.renders:.2f}ms per form render"
+    )
+
+
+def main():
+    xml_parser = get_parser()
+    sorted_fields = [
+        field
+        for field in xml_parser.optlists
+        if xml_parser.attributes[field].get("sort") == "yes"
+    ]
+    print(
+        f"{len(xml_parser.optlists)} option lists "
+        f"({len(sorted_fields)} sorted); {args.renders} renders."
+    )
+    benchmark("Before (collator per call)", render_uncached)
+    benchmark("After (cached)", render_cached)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+-- Archive tables for the jobs database.
+--
+-- JobManager.archive_jobs() (run by scripts/archive_jobs.py) moves jobs that
+-- ended more than job_archive_days ago, together with their rows in the
+-- per-job tables, into these tables so that the jobs table and its indexes
+-- only hold active and recent jobs.
+--
+-- The archive tables have the same columns as the live tables. If a column
+-- is added to a live table, add it to its archive table as well.
+--
+-- Run with: psql -f jobs_archive.sql bigsdb_jobs
+
+CREATE TABLE IF NOT EXISTS archived_jobs (LIKE jobs INCLUDING DEFAULTS);
+CREATE UNIQUE INDEX IF NOT EXISTS i_archived_jobs_id ON archived_jobs(id);
+CREATE INDEX IF NOT EXISTS i_archived_jobs_stop_time ON archived_jobs(stop_time);
+CREATE INDEX IF NOT EXISTS i_archived_jobs_dbase_username ON archived_jobs(dbase_config,username);
+
+CREATE TABLE IF NOT EXISTS archived_params (LIKE params INCLUDING DEFAULTS);
+CREATE INDEX IF NOT EXISTS i_archived_params_job_id ON archived_params(job_id);
+
+CREATE TABLE IF NOT EXISTS archived_isolates (LIKE isolates INCLUDING DEFAULTS);
+CREATE INDEX IF NOT EXISTS i_archived_isolates_job_id ON archived_isolates(job_id);
+
+CREATE TABLE IF NOT EXISTS archived_profiles (LIKE profiles INCLUDING DEFAULTS);
+CREATE INDEX IF NOT EXISTS i_archived_profiles_job_id ON archived_profiles(job_id);
+
+CREATE TABLE IF NOT EXISTS archived_loci (LIKE loci INCLUDING DEFAULTS);
+CREATE INDEX IF NOT EXISTS i_archived_loci_job_id ON archived_loci(job_id);
+
+CREATE TABLE IF NOT EXISTS archived_output (LIKE output INCLUDING DEFAULTS);
+CREATE INDEX IF NOT EXISTS i_archived_output_job_id ON archived_output(job_id);
+
+GRANT SELECT,INSERT,DELETE ON archived_jobs,archived_params,archived_isolates,
+archived_profiles,archived_loci,archived_output TO apache;
+
+-- Selects the jobs to archive, oldest first.
+CREATE INDEX IF NOT EXISTS i_jobs_ended ON jobs((COALESCE(stop_time,submit_time)))
+WHERE status NOT IN ('submitted','started');
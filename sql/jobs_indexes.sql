@@ -0,0 +1,24 @@
+-- Recommended indexes for the jobs database.
+--
+-- Admission checks, duplicate detection and the scheduler only look at active
+-- (submitted or started) jobs, which are a tiny fraction of a jobs table that
+-- keeps the history of every job. Partial indexes over the active jobs stay
+-- small however large the table grows.
+--
+-- Run with: psql -f jobs_indexes.sql bigsdb_jobs
+-- (CONCURRENTLY avoids locking the table, so cannot be run in a transaction.)
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS i_jobs_active_status ON jobs(status)
+WHERE status IN ('submitted','started');
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS i_jobs_active_fingerprint ON jobs(fingerprint)
+WHERE status IN ('submitted','started');
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS i_jobs_active_dbase_username ON jobs(dbase_config,username)
+WHERE status IN ('submitted','started');
+
+-- Finished jobs whose output can be re-used (result_cache_ttl).
+CREATE INDEX CONCURRENTLY IF NOT EXISTS i_jobs_finished_fingerprint ON jobs(fingerprint,stop_time)
+WHERE status='finished';
+
+ANALYZE jobs;
@@ -0,0 +1,23 @@
+-- Notification trigger for the jobs database.
+--
+-- Sends a 'cancel' notification on the bigsdb_jobs channel whenever a job's
+-- cancel flag is set, so that running jobs are told about cancellations
+-- straight away whichever client (e.g. the Perl web interface) sets it.
+--
+-- The payload is the same text as JobManager.cancel_job sends, so
+-- PostgreSQL delivers only one notification if both are sent in the same
+-- transaction.
+--
+-- Run with: psql -f jobs_notify.sql bigsdb_jobs
+
+CREATE OR REPLACE FUNCTION jobs_notify_cancel() RETURNS trigger AS $$
+BEGIN
+	PERFORM pg_notify('bigsdb_jobs','{"event": "cancel", "job_id": ' || to_json(NEW.id)::text || '}');
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS jobs_notify_cancel ON jobs;
+CREATE TRIGGER jobs_notify_cancel AFTER UPDATE OF cancel ON jobs
+FOR EACH ROW WHEN (NEW.cancel AND NOT COALESCE(OLD.cancel,FALSE))
+EXECUTE FUNCTION jobs_notify_cancel();
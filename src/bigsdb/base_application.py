@@ -20,9 +20,13 @@
 
 import configparser
 import logging
+import hashlib
+from datetime import date
 from pathlib import Path
 import bigsdb.utils
+import bigsdb.xml_parser
 from bigsdb.xml_parser import XMLParser
+from bigsdb.config_snapshot import ConfigSnapshot
 from bigsdb.data_connector import DataConnector
 from bigsdb.datastore import Datastore
 from bigsdb.constants import DIRS, CONNECTION_DETAILS
@@ -45,16 +49,13 @@ class BaseApplication(object):
         self.config_dir = config_dir
         self.dbase_config_dir = dbase_config_dir
         self.logger = logger
-        self.config = self._read_config_file()
         if testing:
+            self.config = self._read_config_file()
             return
         if database == None:
             raise ValueError("No database parameter passed.")
         self.instance = database
-        self._read_db_config_file()
-        self._read_host_mapping_file()
-        self._read_dbase_config_xml_file()
-        self._set_system_overrides()
+        self._read_config(options)
         self.system["host"] = (
             host
             or self.system.get("host")
@@ -79,12 +80,54 @@ class BaseApplication(object):
             self.system["view"] = self.system.get("view", "isolates")
             self.system["labelfield"] = self.system.get("labelfield", "isolate")
         self.data_connector = DataConnector(
-            system=self.system, config=self.config, logger=self.logger
+            system=self.system,
+            config=self.config,
+            logger=self.logger,
+            pooled=options.get("pooled_connections", False),
         )
         self._db_connect()
         self._setup_datastore()
         if not options.get("no_user_db_needed", False):
             self.datastore.initiate_user_dbs()
+            if self.config.get("prewarm_user_dbs"):
+                self.datastore.prewarm_user_dbs({"background": True})
+
+    def _read_config(self, options={}):
+        config_snapshot = ConfigSnapshot(
+            cache_dir=options.get("config_cache_dir", DIRS["CONFIG_CACHE_DIR"]),
+            name=self._get_config_snapshot_name(),
+            sources=self._get_config_sources(),
+            logger=self.logger,
+        )
+        snapshot = config_snapshot.load()
+        if snapshot is not None:
+            self.config, self.system, self.parser = snapshot
+            return
+        self.config = self._read_config_file()
+        self._read_db_config_file()
+        self._read_host_mapping_file()
+        self._read_dbase_config_xml_file()
+        self._set_system_overrides()
+        config_snapshot.save((self.config, self.system, self.parser))
+
+    def _get_config_snapshot_name(self):
+        digest = hashlib.md5(
+            f"{self.config_dir}|{self.dbase_config_dir}".encode()
+        ).hexdigest()
+        return f"{self.instance}_{digest[:12]}"
+
+    # Files that the configuration is read from, together with the modules
+    # that parse them (so that a snapshot made by older code is not used).
+    def _get_config_sources(self):
+        return [
+            f"{self.config_dir}/bigsdb.conf",
+            f"{self.config_dir}/db.conf",
+            f"{self.config_dir}/host_mapping.conf",
+            f"{self.dbase_config_dir}/{self.instance}/config.xml",
+            f"{self.dbase_config_dir}/{self.instance}/system.overrides",
+            __file__,
+            bigsdb.xml_parser.__file__,
+        ]
 
     def _read_config_file(self, filename=None):
         filename = filename or f"{self.config_dir}/bigsdb.conf"
@@ -102,7 +145,7 @@ class BaseApplication(object):
             elif bigsdb.utils.is_float(value):
                 value = float(value)
             elif bigsdb.utils.is_date(value):
-                value = date(value)
+                value = date.fromisoformat(value)
             dict[key] = value
         # refdb attribute has been renamed ref_db for consistency
         # with other databases (refdb still works)
@@ -162,7 +205,7 @@ class BaseApplication(object):
             elif bigsdb.utils.is_float(value):
                 value = float(value)
             elif bigsdb.utils.is_date(value):
-                value = date(value)
+                value = date.fromisoformat(value)
             self.system[key] = value
 
     def _db_connect(self):
@@ -0,0 +1,99 @@
+# Written by Keith Jolley
+# Copyright (c) 2024, University of Oxford
+# E-mail: keith.jolley@biology.ox.ac.uk
+#
+# This file is part of BIGSdb Python Toolkit.
+#
+# BIGSdb Python Toolkit is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BIGSdb Python Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BIGSdb Python Toolkit. If not,
+# see <https://www.gnu.org/licenses/>.
+
+import os
+import logging
+import pickle
+
+
+# The parsed and typed configuration (bigsdb.conf, db.conf, host_mapping.conf,
+# the database config.xml and system.overrides) stored in a pickled file so
+# that it does not need to be parsed again by every process. The snapshot is
+# keyed by the modification times and sizes of the source files (and of the
+# modules that parse them) and is ignored if any of these has changed.
+#
+# The snapshot contains database credentials so the cache directory must
+# already exist, be owned by the user running the process and not be
+# accessible to anyone else. Otherwise the snapshot is not used.
+class ConfigSnapshot:
+    def __init__(self, cache_dir=None, name=None, sources=[], logger=None):
+        self.cache_dir = cache_dir
+        self.filename = f"{cache_dir}/{name}.pickle"
+        self.sources = list(sources)
+        if logger is None:
+            self.logger = logging.getLogger(__name__)
+            self.logger.addHandler(logging.NullHandler())
+        else:
+            self.logger = logger
+        self.enabled = self._is_cache_dir_private()
+        self.key = None
+
+    def _is_cache_dir_private(self):
+        if not self.cache_dir:
+            return False
+        try:
+            stat = os.stat(self.cache_dir)
+        except OSError:
+            return False
+        return stat.st_uid == os.getuid() and not stat.st_mode & 0o077
+
+    def get_key(self):
+        key = []
+        for filename in self.sources:
+            try:
+                stat = os.stat(filename)
+                key.append((filename, stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                key.append((filename, None, None))
+        return key
+
+    # The key is taken before the files are read so that a file that changes
+    # while it is being parsed does not result in a stale snapshot.
+    def load(self):
+        if not self.enabled:
+            return
+        self.key = self.get_key()
+        try:
+            with open(self.filename, "rb") as f:
+                snapshot = pickle.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            self.logger.error(f"Cannot read config snapshot {self.filename}: {e}")
+            return
+        if snapshot.get("key") != self.key:
+            return
+        return snapshot.get("data")
+
+    def save(self, data):
+        if not self.enabled or self.key is None:
+            return
+        tmp_file = f"{self.filename}.{os.getpid()}.tmp"
+        try:
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(
+                    {"key": self.key, "data": data},
+                    f,
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+            os.replace(tmp_file, self.filename)
+        except Exception as e:
+            self.logger.error(f"Cannot write config snapshot {self.filename}: {e}")
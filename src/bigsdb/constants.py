@@ -20,7 +20,11 @@
 
 import re
 
-DIRS = {"CONFIG_DIR": "/etc/bigsdb", "DBASE_CONFIG_DIR": "/etc/bigsdb/dbases"}
+DIRS = {
+    "CONFIG_DIR": "/etc/bigsdb",
+    "DBASE_CONFIG_DIR": "/etc/bigsdb/dbases",
+    "CONFIG_CACHE_DIR": "/var/cache/bigsdb/config",
+}
 
 LOGS = {"BIGSDB_LOG": "/var/log/bigsdb.log", "JOBS_LOG": "/var/log/bigsdb_jobs.log"}
 
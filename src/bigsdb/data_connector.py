@@ -18,11 +18,24 @@
 # along with BIGSdb Python Toolkit. If not,
 # see <https://www.gnu.org/licenses/>.
 
+import threading
+import time
 import psycopg2
+import psycopg2.extensions
+from contextlib import contextmanager
+from bigsdb.query_profiler import QueryProfiler
+
+POOL_DEFAULTS = {
+    "db_pool_min": 1,  # Connections opened when the pool is created and kept.
+    "db_pool_max": 10,
+    "db_pool_idle_timeout": 300,  # Seconds before surplus idle connections close.
+    "db_pool_check_interval": 30,  # Seconds idle before a connection is pinged.
+    "db_pool_timeout": 60,  # Seconds to wait for a connection when pool is full.
+}
 
 
 class DataConnector(object):
-    def __init__(self, system=None, config=None, logger=None):
+    def __init__(self, system=None, config=None, logger=None, pooled=False):
         if system == None:
             raise ValueError("No system parameter passed.")
         if config == None:
@@ -31,6 +44,29 @@ class DataConnector(object):
         self.config = config
         self.system = system
         self.logger = logger
+        self.pooled = pooled
+        self.pools = {}
+        self.lock = threading.Lock()
+        self.leases = threading.local()
+        self.profiler = None
+        if config.get("query_profile"):
+            self.profiler = QueryProfiler(
+                profile_dir=config.get("query_profile_dir")
+                or f"{config.get('secure_tmp_dir')}/query_profiles",
+                logger=logger,
+                options={
+                    key: config[f"query_profile_{key}"]
+                    for key in ("n_plus_one_threshold", "top")
+                    if f"query_profile_{key}" in config
+                },
+            )
+
+    # Extra arguments for new connections, e.g. so that queries are recorded
+    # by the profiler.
+    def _get_connect_args(self, connect_args):
+        if self.profiler is None:
+            return connect_args
+        return {**connect_args, "connection_factory": self.profiler.connection_factory}
 
     def get_connection(
         self, dbase_name, host=None, port=None, user=None, password=None
@@ -43,24 +79,328 @@ class DataConnector(object):
         user = user or self.system.get("user")
         password = password or self.system.get("password")
         cache_name = f"{host}|{dbase_name}"
-        if cache_name not in self.db:
-            conn = psycopg2.connect(
-                dbname=dbase_name, host=host, port=port, user=user, password=password
-            )
-            self.db[cache_name] = conn
-        return self.db[cache_name]
+        connect_args = self._get_connect_args(
+            {
+                "dbname": dbase_name,
+                "host": host,
+                "port": port,
+                "user": user,
+                "password": password,
+            }
+        )
+        if self.pooled:
+            return self._get_leased_connection(cache_name, connect_args)
+        with self.lock:
+            if cache_name in self.db and self.db[cache_name].closed:
+                # Only replace the connection that has gone away.
+                self._log_error(f"Connection to {cache_name} closed - reconnecting.")
+                del self.db[cache_name]
+            if cache_name in self.db:
+                return self.db[cache_name]
+        # Connect outside of the lock so that connections to different
+        # databases can be made in parallel.
+        conn = psycopg2.connect(**connect_args)
+        with self.lock:
+            if cache_name in self.db:  # Another thread connected first.
+                conn.close()
+            else:
+                self.db[cache_name] = conn
+            return self.db[cache_name]
+
+    # Open a connection that is not cached or shared, e.g. for a dedicated
+    # LISTEN connection. The caller is responsible for closing it.
+    def get_new_connection(
+        self, dbase_name, host=None, port=None, user=None, password=None
+    ):
+        if dbase_name == None:
+            raise ValueError("No dbase_name parameter passed.")
+        return psycopg2.connect(
+            dbname=dbase_name,
+            host=self.config["host_map"].get(host) or host or self.system.get("host"),
+            port=port or self.system.get("port"),
+            user=user or self.system.get("user"),
+            password=password or self.system.get("password"),
+        )
+
+    # In pooled mode each thread is leased its own connection to each database
+    # from a shared pool. The lease (the pool and connection) is kept until
+    # release_connections() is called by that thread.
+    def _get_leased_connection(self, cache_name, connect_args):
+        leases = self._get_thread_leases()
+        if cache_name in leases:
+            pool, conn = leases[cache_name]
+            if not conn.closed:
+                return conn
+            del leases[cache_name]
+            pool.discard(conn)
+        pool = self._get_pool(cache_name, connect_args)
+        conn = pool.checkout()
+        leases[cache_name] = (pool, conn)
+        return conn
+
+    def _get_thread_leases(self):
+        if not hasattr(self.leases, "connections"):
+            self.leases.connections = {}
+        return self.leases.connections
+
+    def _get_pool(self, cache_name, connect_args):
+        with self.lock:
+            pool = self.pools.get(cache_name)
+            created = pool is None
+            if created:
+                options = {
+                    key: self.config.get(key, default)
+                    for key, default in POOL_DEFAULTS.items()
+                }
+                pool = ConnectionPool(
+                    connect_args,
+                    min_size=options["db_pool_min"],
+                    max_size=options["db_pool_max"],
+                    idle_timeout=options["db_pool_idle_timeout"],
+                    check_interval=options["db_pool_check_interval"],
+                    timeout=options["db_pool_timeout"],
+                    logger=self.logger,
+                )
+                self.pools[cache_name] = pool
+
+        # Connect outside of the lock.
+        if created:
+            pool.fill()
+        return pool
+
+    # Return connections leased by the current thread to their pools. If a
+    # pool has since been closed (by drop_all_connections) its connections
+    # are closed instead.
+    def release_connections(self):
+        if not self.pooled:
+            return
+        leases = self._get_thread_leases()
+        for cache_name in list(leases.keys()):
+            pool, conn = leases.pop(cache_name)
+            pool.checkin(conn)
+
+    # Check out a connection for the duration of a with block, e.g.
+    # with data_connector.connection(dbase_name="jobs") as db:
+    @contextmanager
+    def connection(self, dbase_name, host=None, port=None, user=None, password=None):
+        if not self.pooled:
+            yield self.get_connection(dbase_name, host, port, user, password)
+            return
+        if dbase_name == None:
+            raise ValueError("No dbase_name parameter passed.")
+        host = self.config["host_map"].get(host) or host or self.system.get("host")
+        pool = self._get_pool(
+            f"{host}|{dbase_name}",
+            self._get_connect_args(
+                {
+                    "dbname": dbase_name,
+                    "host": host,
+                    "port": port or self.system.get("port"),
+                    "user": user or self.system.get("user"),
+                    "password": password or self.system.get("password"),
+                }
+            ),
+        )
+        conn = pool.checkout()
+        try:
+            yield conn
+        finally:
+            pool.checkin(conn)
 
     def drop_all_connections(self, except_list=None):
         if except_list is None or not isinstance(except_list, list):
             except_list = []
-            except_set = set(except_list)
-        for db in list(self.db.keys()):
-            if db in except_set:
-                continue
+        except_set = set(except_list)
+        if self.pooled:
+            leases = self._get_thread_leases()
+            for db in list(leases.keys()):
+                if db not in except_set:
+                    leases.pop(db)[1].close()
+        with self.lock:
+            for db in list(self.db.keys()):
+                if db in except_set:
+                    continue
+                try:
+                    self.db[db].close()
+                except Exception as e:
+                    self._log_error(
+                        f"Error disconnecting from database {self.db[db]}: {e}"
+                    )
+                del self.db[db]
+            for db in list(self.pools.keys()):
+                if db in except_set:
+                    continue
+                self.pools.pop(db).close_all()
+
+    def get_pool_stats(self):
+        return {name: pool.get_stats() for name, pool in self.pools.items()}
+
+    def _log_error(self, message):
+        if self.logger:
+            self.logger.error(message)
+
+
+class ConnectionPool(object):
+    def __init__(
+        self,
+        connect_args,
+        min_size=1,
+        max_size=10,
+        idle_timeout=300,
+        check_interval=30,
+        timeout=60,
+        logger=None,
+    ):
+        if min_size > max_size:
+            raise ValueError("Pool min_size cannot be larger than max_size.")
+        self.connect_args = connect_args
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self.logger = logger
+        self.idle = []  # [connection, time returned to pool]
+        self.in_use = 0
+        self.reconnects = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    # Liveness checks and new connections are made outside of the lock so
+    # that other threads are not held up by the round trips.
+    def checkout(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self.condition:
+                conn, last_used = self._reserve(deadline)
+            if conn is None:
+                break
+            if self._is_alive(conn, last_used):
+                return conn
+            self.discard(conn)
+        try:
+            return psycopg2.connect(**self.connect_args)
+        except Exception:
+            with self.condition:
+                self.in_use -= 1
+                self.condition.notify()
+            raise
+
+    # Takes the most recently used idle connection, or reserves a slot for a
+    # new connection (returning None), waiting if the pool is full. Called
+    # with the condition held.
+    def _reserve(self, deadline):
+        while True:
+            self._close_expired_idle()
+            if self.idle:
+                self.in_use += 1
+                return self.idle.pop()
+            if self.in_use < self.max_size:
+                self.in_use += 1
+                return None, None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self.condition.wait(remaining):
+                raise TimeoutError(
+                    f"No connection to {self.connect_args['dbname']} available "
+                    f"within {self.timeout}s (pool max_size={self.max_size})."
+                )
+
+    # Open connections until the pool holds min_size.
+    def fill(self):
+        while True:
+            with self.condition:
+                if self.closed or len(self.idle) + self.in_use >= self.min_size:
+                    return
+                self.in_use += 1
             try:
-                self.db[db].close()
+                conn = psycopg2.connect(**self.connect_args)
             except Exception as e:
+                with self.condition:
+                    self.in_use -= 1
+                    self.condition.notify()
+                if self.logger:
+                    self.logger.error(
+                        f"Cannot open pooled connection to "
+                        f"{self.connect_args['dbname']}: {e}"
+                    )
+                return
+            self.checkin(conn)
+
+    def checkin(self, conn):
+        if not conn.closed:
+            try:
+                # Don't leave a transaction open on an idle connection.
+                if (
+                    conn.info.transaction_status
+                    != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+                ):
+                    conn.rollback()
+            except Exception:
+                self._close(conn)
+        with self.condition:
+            self.in_use -= 1
+            if self.closed:
+                self._close(conn)
+            elif not conn.closed:
+                self.idle.append([conn, time.monotonic()])
+            self.condition.notify()
+
+    # Remove a broken connection from the pool's accounting.
+    def discard(self, conn):
+        self._close(conn)
+        with self.condition:
+            self.in_use -= 1
+            self.reconnects += 1
+            self.condition.notify()
+
+    def close_all(self):
+        with self.condition:
+            self.closed = True
+            for conn, _ in self.idle:
+                self._close(conn)
+            self.idle = []
+
+    def get_stats(self):
+        with self.condition:
+            return {
+                "idle": len(self.idle),
+                "in_use": self.in_use,
+                "reconnects": self.reconnects,
+            }
+
+    def _is_alive(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception as e:
+            if self.logger:
                 self.logger.error(
-                    f"Error disconnecting from database {self.db[db]}: {e}"
+                    f"Pooled connection to {self.connect_args['dbname']} "
+                    f"failed liveness check: {e}"
                 )
-            del self.db[db]
+            return False
+
+    def _close_expired_idle(self):
+        now = time.monotonic()
+        kept = []
+        # Oldest connections are at the start of the list.
+        surplus = len(self.idle) + self.in_use - self.min_size
+        for entry in self.idle:
+            if surplus > 0 and now - entry[1] > self.idle_timeout:
+                self._close(entry[0])
+                surplus -= 1
+            else:
+                kept.append(entry)
+        self.idle = kept
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
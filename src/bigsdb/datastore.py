@@ -22,10 +22,74 @@ import re
 import logging
 import psycopg2.extras
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from io import StringIO
 from collections import defaultdict
 import bigsdb.utils
 from bigsdb.scheme import Scheme
+from bigsdb.designation_matrix import DesignationMatrix
+from bigsdb.metadata_snapshot import MetadataSnapshot
+
+ITERSIZE = 2000  # Rows fetched per round trip by iter_* fetch methods.
+
+# When prepared statements are enabled, a query is prepared once it has been
+# run this number of times on a connection.
+PREPARE_THRESHOLD = 3
+MAX_PREPARED_STATEMENTS = 500  # Per connection.
+MAX_STATEMENT_COUNTS = 5000  # Queries counted towards the threshold.
+
+# Changes to these tables invalidate the metadata snapshot.
+METADATA_TABLES = [
+    "loci",
+    "schemes",
+    "scheme_members",
+    "scheme_fields",
+    "scheme_groups",
+    "scheme_group_scheme_members",
+    "scheme_group_group_members",
+    "set_loci",
+    "set_schemes",
+]
+
+# Changes to these tables may change the output of jobs run on isolate data.
+ISOLATE_DATA_TABLES = [
+    "isolates",
+    "isolate_aliases",
+    "allele_designations",
+    "private_isolates",
+    "isolate_value_extended_attributes",
+    "eav_int",
+    "eav_float",
+    "eav_text",
+    "eav_date",
+    "eav_boolean",
+]
+
+
+# Changes to these tables may change which isolates a user can see.
+ACCESS_CONTROL_TABLES = [
+    "users",
+    "permissions",
+    "user_groups",
+    "user_group_members",
+    "projects",
+    "project_members",
+    "project_users",
+    "user_group_projects",
+    "merged_project_users",
+    "set_view",
+]
+
+# Tables in sequence definition databases (as well as the mv_scheme_<id>
+# tables) that scheme field values are looked up from.
+SCHEME_DEFINITION_TABLES = [
+    "profiles",
+    "profile_members",
+    "profile_fields",
+    "retired_profiles",
+]
 
 
 class Datastore(object):
@@ -58,6 +122,14 @@ class Datastore(object):
         self.prefs = defaultdict(nested_defaultdict)
         self.user_dbs = {}
         self.scheme = {}
+        self.prepare_statements = bool(self.config.get("prepared_statements"))
+        self.prepare_threshold = int(
+            self.config.get("prepare_threshold", PREPARE_THRESHOLD)
+        )
+        self.prepared = {}
+        self.designation_matrix = None
+        self.metadata_snapshot = None
+        self.statement_stats = {"hits": 0, "misses": 0, "prepared": 0, "failed": 0}
 
     def run_query(self, qry, values=[], options={}):
         if type(values) is not list:
@@ -65,9 +137,36 @@ class Datastore(object):
         db = options.get("db", self.db)
         fetch = options.get("fetch", "row_array")
         qry = replace_placeholders(qry)
+
+        # Results of queries of metadata tables can be shared between
+        # processes via the metadata snapshot.
+        if options.get("metadata") and not fetch.startswith("iter"):
+            snapshot = self.get_metadata_snapshot()
+            if snapshot is not None:
+                key = (
+                    qry,
+                    repr(values),
+                    fetch,
+                    repr(options.get("slice")),
+                    options.get("key"),
+                )
+                if key in snapshot:
+                    return snapshot[key]
+                value = self.run_query(qry, values, {**options, "metadata": False})
+                snapshot[key] = value
+                return value
+
+        # Iterative fetches use a server-side cursor so that only itersize rows
+        # are held in memory at any one time.
+        if fetch == "iter_hashref" or fetch == "iter_arrayref":
+            return self._run_iterative_query(qry, values, db, fetch, options)
         cursor = db.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        statement = self._get_prepared_statement(qry, values, db, options)
         try:
-            cursor.execute(qry, values)
+            if statement:
+                cursor.execute(statement, values)
+            else:
+                cursor.execute(qry, values)
         except Exception as e:
             self.logger.error(f"{e} Query:{qry}")
 
@@ -111,6 +210,241 @@ class Datastore(object):
         self.logger.error("Query failed - invalid fetch method specified.")
         return None
 
+    # Returns None unless enabled with the 'metadata_cache' config option.
+    def get_metadata_snapshot(self):
+        if not self.config.get("metadata_cache"):
+            return
+        if self.metadata_snapshot is None:
+            cache_dir = self.config.get("metadata_cache_dir") or (
+                f"{self.config.get('secure_tmp_dir')}/metadata_cache"
+            )
+            self.metadata_snapshot = MetadataSnapshot(
+                filename=f"{cache_dir}/{self.system['db']}.pickle",
+                get_fingerprint=self.get_metadata_fingerprint,
+                logger=self.logger,
+            )
+        self.metadata_snapshot.refresh()
+        return self.metadata_snapshot
+
+    # Changes when any of the locus, scheme, scheme group or set tables change.
+    def get_metadata_fingerprint(self):
+        return self.get_table_change_fingerprint(METADATA_TABLES)
+
+    # Returns a value that changes whenever rows in any of the tables are
+    # added, removed or updated. This is made from the row counts, the latest
+    # datestamps and the insert/update/delete statistics counters. Row counts
+    # and datestamps can be left out (with the counts and datestamps options
+    # set to False) for large tables, so that only the statistics are read.
+    # The tables are those of the isolate database unless a connection is
+    # passed with the db option. Returns None if any of the queries fail.
+    def get_table_change_fingerprint(self, tables, options={}):
+        db_options = {"db": options["db"]} if options.get("db") else {}
+        terms = []
+        if options.get("counts", True):
+            existing = self.run_query(
+                "SELECT table_name FROM information_schema.tables WHERE "
+                "table_name=ANY(?) AND table_schema=current_schema() ORDER BY "
+                "table_name",
+                [list(tables)],
+                {"fetch": "col_arrayref", **db_options},
+            )
+            if existing is None:
+                return
+            terms += [f"(SELECT COUNT(*) FROM {table})::text" for table in existing]
+        if options.get("datestamps", True):
+            # Only the datestamp tables of the isolate database are cached.
+            key = None if options.get("db") else ",".join(tables)
+            datestamp_tables = self.cache["datestamp_tables"].get(key)
+            if datestamp_tables is None:
+                datestamp_tables = self.run_query(
+                    "SELECT table_name FROM information_schema.columns WHERE "
+                    "table_name=ANY(?) AND column_name='datestamp' AND "
+                    "table_schema=current_schema() ORDER BY table_name",
+                    [list(tables)],
+                    {"fetch": "col_arrayref", **db_options},
+                )
+                if datestamp_tables is None:
+                    return
+                if key is not None:
+                    self.cache["datestamp_tables"][key] = datestamp_tables
+            terms += [
+                f"COALESCE((SELECT MAX(datestamp) FROM {table})::text,'')"
+                for table in datestamp_tables
+            ]
+        counts = ""
+        if terms:
+            counts = self.run_query("SELECT " + "||','||".join(terms), [], db_options)
+        self.run_query("SELECT pg_stat_clear_snapshot()", [], db_options)
+        stats = self.run_query(
+            "SELECT relname,n_tup_ins,n_tup_upd,n_tup_del FROM pg_stat_user_tables "
+            "WHERE relname=ANY(?) AND schemaname=current_schema() ORDER BY relname",
+            [list(tables)],
+            {"fetch": "all_arrayref", **db_options},
+        )
+        if counts is None or stats is None:
+            return
+        return bigsdb.utils.get_md5_hash(
+            counts + ";" + ";".join(",".join(map(str, row)) for row in stats)
+        )
+
+    # Changes when anything that the output of a job run on isolate data
+    # depends on changes, e.g. to tell whether the output of an earlier job is
+    # still valid: the isolate data, the locus and scheme definitions, the
+    # tables that decide which isolates a user can see (the user is part of
+    # the job fingerprint) and the profiles in the scheme databases. Only the
+    # statistics counters are read, so no tables are scanned. These can lag
+    # changes by a short time (normally about a second), so a change made
+    # within that time before a job is submitted may not be seen. Returns None
+    # if any part cannot be determined.
+    def get_isolate_data_fingerprint(self):
+        table_fingerprint = self.get_table_change_fingerprint(
+            ISOLATE_DATA_TABLES + METADATA_TABLES + ACCESS_CONTROL_TABLES,
+            {"counts": False, "datestamps": False},
+        )
+        scheme_fingerprint = self.get_scheme_data_fingerprint()
+        if table_fingerprint is None or scheme_fingerprint is None:
+            return
+        view = self.system.get("base_view", self.system.get("view")) or ""
+        return bigsdb.utils.get_md5_hash(
+            f"{table_fingerprint};{scheme_fingerprint};{view}"
+        )
+
+    # Changes when the profiles or scheme definitions of any of the schemes
+    # in the sequence definition databases change. Returns None if any of the
+    # scheme databases cannot be checked.
+    def get_scheme_data_fingerprint(self):
+        schemes = self.run_query(
+            "SELECT id,dbase_name,dbase_host,dbase_user,dbase_password,dbase_id FROM "
+            "schemes WHERE dbase_name IS NOT NULL ORDER BY id",
+            [],
+            {"fetch": "all_arrayref", "slice": {}, "metadata": 1},
+        )
+        if schemes is None:
+            return
+        scheme_dbases = {}
+        for scheme in schemes:
+            key = (scheme["dbase_name"], scheme["dbase_host"], scheme["dbase_user"])
+            scheme_dbases.setdefault(key, {"scheme": scheme, "tables": []})
+            scheme_dbases[key]["tables"].append(f"mv_scheme_{scheme['dbase_id']}")
+        fingerprints = []
+        for key, scheme_dbase in scheme_dbases.items():
+            try:
+                db = self._get_scheme_db(scheme_dbase["scheme"])
+                fingerprint = self.get_table_change_fingerprint(
+                    SCHEME_DEFINITION_TABLES + scheme_dbase["tables"],
+                    {"counts": False, "datestamps": False, "db": db},
+                )
+            except Exception as e:
+                self.logger.error(f"Cannot check scheme database {key[0]}: {e}")
+                return
+            if fingerprint is None:
+                return
+            fingerprints.append(f"{key[0]}:{fingerprint}")
+        return bigsdb.utils.get_md5_hash(";".join(fingerprints))
+
+    # Returns an EXECUTE statement for the query if it has been (or can now be)
+    # prepared on the connection, otherwise None. Prepared statements are
+    # used if enabled with the 'prepared_statements' config option, or for
+    # individual queries with the 'prepare' option.
+    def _get_prepared_statement(self, qry, values, db, options):
+        prepare = options.get("prepare", self.prepare_statements)
+        if not prepare or db.autocommit:
+            return
+        connection = self.prepared.get(id(db))
+        if connection is None or connection["db"] is not db or db.closed:
+            # Forget connections that have since been closed.
+            self.prepared = {
+                key: value
+                for key, value in self.prepared.items()
+                if not value["db"].closed
+            }
+            connection = {"db": db, "statements": {}, "counts": {}}
+            self.prepared[id(db)] = connection
+        statements = connection["statements"]
+        if qry in statements:
+            if statements[qry] is None:
+                return
+            self.statement_stats["hits"] += 1
+            return statements[qry]
+        self.statement_stats["misses"] += 1
+        counts = connection["counts"]
+        if len(statements) >= MAX_PREPARED_STATEMENTS:
+            counts.clear()
+            return
+
+        # Queries that are built with literal values may never repeat, so
+        # counting starts again rather than growing without limit.
+        if qry not in counts and len(counts) >= MAX_STATEMENT_COUNTS:
+            counts.clear()
+        counts[qry] = counts.get(qry, 0) + 1
+        if options.get("prepare") is not True and counts[qry] < self.prepare_threshold:
+            return
+        del counts[qry]
+        statements[qry] = self._prepare_statement(
+            db, qry, f"bigsdb_stmt_{len(statements) + 1}"
+        )
+        if statements[qry] is None:
+            return
+        return statements[qry]
+
+    # A savepoint is used so that a failure to prepare, e.g. if a parameter
+    # type cannot be determined, does not abort the current transaction. The
+    # query is then always run unprepared.
+    def _prepare_statement(self, db, qry, name):
+        if not re.match(r"\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b", qry, re.I):
+            return
+        parameter_query, parameter_count = convert_placeholders_to_numbered(qry)
+        cursor = db.cursor()
+        try:
+            cursor.execute("SAVEPOINT bigsdb_prepare")
+            cursor.execute(f"PREPARE {name} AS {parameter_query}")
+            cursor.execute("RELEASE SAVEPOINT bigsdb_prepare")
+        except Exception as e:
+            self.logger.debug(f"Cannot prepare statement: {e} Query:{qry}")
+            self.statement_stats["failed"] += 1
+            try:
+                cursor.execute("ROLLBACK TO SAVEPOINT bigsdb_prepare")
+            except Exception:
+                db.rollback()
+            return
+        self.statement_stats["prepared"] += 1
+        if not parameter_count:
+            return f"EXECUTE {name}"
+        return f"EXECUTE {name}(" + ",".join(["%s"] * parameter_count) + ")"
+
+    def get_statement_cache_stats(self):
+        stats = dict(self.statement_stats)
+        placeholder_cache = replace_placeholders.cache_info()
+        stats["placeholder_hits"] = placeholder_cache.hits
+        stats["placeholder_misses"] = placeholder_cache.misses
+        return stats
+
+    def _run_iterative_query(self, qry, values, db, fetch, options):
+        cursor = db.cursor(
+            name=f"bigsdb_iter_{random.randint(0, 99999999)}",
+            cursor_factory=psycopg2.extras.DictCursor,
+            withhold=options.get("withhold", False),
+        )
+        cursor.itersize = options.get("itersize", ITERSIZE)
+        try:
+            cursor.execute(qry, values)
+        except Exception as e:
+            self.logger.error(f"{e} Query:{qry}")
+            return iter([])
+        return self._iterate_cursor(cursor, fetch)
+
+    def _iterate_cursor(self, cursor, fetch):
+        try:
+            for row in cursor:
+                yield dict(row) if fetch == "iter_hashref" else row
+        finally:
+            try:
+                cursor.close()
+            except Exception:
+                pass  # Cursor is closed automatically at end of transaction.
+
+    # Connection details for each user database are read, but connections are
+    # only made when a database is first used (see get_user_db).
     def initiate_user_dbs(self):
         configs = self.run_query(
             "SELECT * FROM user_dbases ORDER BY id",
@@ -118,27 +452,51 @@ class Datastore(object):
             {"fetch": "all_arrayref", "slice": {}},
         )
         for config in configs:
-            try:
-                self.user_dbs[config["id"]] = {
-                    "db": self.data_connector.get_connection(
-                        dbase_name=config.get("dbase_name"),
-                        host=config.get("dbase_host")
-                        or self.config.get("dbhost")
-                        or self.system.get("host"),
-                        port=config.get("dbase_port")
-                        or self.config.get("dbport")
-                        or self.system.get("port"),
-                        user=config.get("dbase_user")
-                        or self.config.get("dbuser")
-                        or self.system.get("user"),
-                        password=config.get("dbase_password")
-                        or self.config.get("dbpassword")
-                        or self.system.get("password"),
-                    ),
-                    "name": self.config.get("dbase_name"),
-                }
-            except Exception as e:
-                self.logger.error(str(e))
+            self.user_dbs[config["id"]] = {
+                "connection": {
+                    "dbase_name": config.get("dbase_name"),
+                    "host": config.get("dbase_host")
+                    or self.config.get("dbhost")
+                    or self.system.get("host"),
+                    "port": config.get("dbase_port")
+                    or self.config.get("dbport")
+                    or self.system.get("port"),
+                    "user": config.get("dbase_user")
+                    or self.config.get("dbuser")
+                    or self.system.get("user"),
+                    "password": config.get("dbase_password")
+                    or self.config.get("dbpassword")
+                    or self.system.get("password"),
+                },
+                "name": config.get("dbase_name"),
+            }
+
+    # Connect to all user databases in parallel so that they are ready when
+    # needed. With the background option this runs in a separate thread, which
+    # is returned.
+    def prewarm_user_dbs(self, options={}):
+        if options.get("background"):
+            thread = threading.Thread(
+                target=self.prewarm_user_dbs,
+                args=({**options, "background": False},),
+                daemon=True,
+            )
+            thread.start()
+            return thread
+        ids = [id for id, user_db in self.user_dbs.items() if "db" not in user_db]
+        if not ids:
+            return
+        threads = options.get("threads", len(ids))
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(self._connect_user_db, ids))
+
+    def _connect_user_db(self, id):
+        user_db = self.user_dbs[id]
+        try:
+            with self.data_connector.connection(**user_db["connection"]):
+                pass
+        except Exception as e:
+            self.logger.error(f"Cannot connect to user db {user_db['name']}: {e}")
 
     def add_user_db(self, id=None, db=None, name=None):  # Just used for tests
         if id == None:
@@ -197,10 +555,16 @@ class Datastore(object):
         return user_data
 
     def get_user_db(self, id):
-        try:
-            return self.user_dbs[id]["db"]
-        except:
+        user_db = self.user_dbs.get(id)
+        if user_db is None:
             self.logger.error("Cannot get user db")
+            return
+        if "db" in user_db:
+            return user_db["db"]
+        try:
+            return self.data_connector.get_connection(**user_db["connection"])
+        except Exception as e:
+            self.logger.error(f"Cannot connect to user db {user_db['name']}: {e}")
 
     def get_eav_fields(self):
         return self.run_query(
@@ -262,6 +626,36 @@ class Datastore(object):
             [isolate_id, field],
         )
 
+    # Returns values of multiple EAV fields for a list of isolate ids (or the
+    # name of a temporary table of isolate ids) as a dict keyed by isolate id,
+    # each containing a dict of values keyed by field. Fields are grouped by
+    # EAV table so that only one query is needed per value type.
+    def get_eav_values(self, isolate_ids_or_table, fields):
+        table_fields = {}
+        for field in fields:
+            table = self.get_eav_field_table(field)
+            if table:
+                table_fields.setdefault(table, []).append(field)
+        if isinstance(isolate_ids_or_table, str):
+            join = f" JOIN {isolate_ids_or_table} l ON t.isolate_id=l.value"
+            isolate_clause = ""
+            isolate_values = []
+        else:
+            join = ""
+            isolate_clause = " AND t.isolate_id=ANY(?)"
+            isolate_values = [list(isolate_ids_or_table)]
+        values = {}
+        for table, table_field_list in table_fields.items():
+            data = self.run_query(
+                f"SELECT t.isolate_id,t.field,t.value FROM {table} t{join} WHERE "
+                f"t.field=ANY(?){isolate_clause}",
+                [table_field_list] + isolate_values,
+                {"fetch": "all_arrayref"},
+            )
+            for isolate_id, field, value in data:
+                values.setdefault(isolate_id, {})[field] = value
+        return values
+
     def initiate_view(self, username=None, curate=False, set_id=None):
         user_info = self.get_user_info_from_username(username)
         if self.system.get("dbtype", "") == "sequences":
@@ -272,6 +666,12 @@ class Datastore(object):
             )
         if self.system.get("dbtype", "") != "isolates":
             return
+        # Keep the configured view so that the temporary view can be
+        # re-initiated for a different user within the same session.
+        if "base_view" in self.system:
+            self.system["view"] = self.system["base_view"]
+        else:
+            self.system["base_view"] = self.system.get("view")
         if self.system.get("view") and set_id:
             if self.system.get("views") and bigsdb.utils.is_integer(set_id):
                 set_view = self.run_query(
@@ -384,15 +784,46 @@ class Datastore(object):
             user_term_count = qry.count("?")
             args = [user_info.get("id")] * user_term_count
         qry = replace_placeholders(qry)
+
+        # Queries must not fall back to a temp_view left over from an earlier
+        # user, so a failure here is fatal.
         try:
             cursor = self.db.cursor()
             cursor.execute(qry, args)
             self.db.commit()
         except Exception as e:
-            self.logger.error(e)
+            self.logger.error(f"Cannot create temporary view: {e}")
             self.db.rollback()
+            raise
         self.system["view"] = "temp_view"
 
+    # Drop temporary tables and views so that a long-running process can
+    # re-use its connection for a new job or request.
+    # Used when the connection has been replaced, e.g. leased again from a
+    # connection pool for a new job.
+    def set_connection(self, db):
+        self.db = db
+        self.scheme = {}  # Scheme objects hold their own connections.
+        if self.designation_matrix is not None:
+            self.designation_matrix.db = db
+
+    def reset_session(self):
+        # The previous job may have left its transaction aborted.
+        self.db.rollback()
+        cursor = self.db.cursor()
+        try:
+            cursor.execute("DISCARD TEMP")
+            self.db.commit()
+        except Exception as e:
+            self.logger.error(f"Cannot discard temporary tables: {e}")
+            self.db.rollback()
+        if "base_view" in self.system:
+            self.system["view"] = self.system["base_view"]
+        self.cache.pop("seqbin_count", None)
+        self.username_cache = {}
+        if self.metadata_snapshot is not None:
+            self.metadata_snapshot.save()
+
     def get_seqbin_count(self):
         if self.cache.get("seqbin_count") != None:
             return self.cache.get("seqbin_count")
@@ -515,7 +946,7 @@ class Datastore(object):
                 qry += " ORDER BY id"
 
         query_loci = []
-        data = self.run_query(qry, None, {"fetch": "all_arrayref"})
+        data = self.run_query(qry, None, {"fetch": "all_arrayref", "metadata": 1})
         for row in data:
             if options.get("query_pref") and (
                 not self.prefs["query_field_loci"].get(row[0])
@@ -554,7 +985,9 @@ class Datastore(object):
             )
 
         data = self.run_query(
-            qry, None, {"fetch": "col_arrayref", "cache": "get_loci_in_no_scheme"}
+            qry,
+            None,
+            {"fetch": "col_arrayref", "cache": "get_loci_in_no_scheme", "metadata": 1},
         )
 
         if not options.get("analyse_pref"):
@@ -607,11 +1040,52 @@ class Datastore(object):
         )
         return self.run_query(qry, isolate_id, {"fetch": "all_arrayref", "slice": {}})
 
+    # Returns a dict keyed by isolate id, each containing a dict of designations
+    # keyed by locus (same structure as returned by get_scheme_allele_designations).
+    def get_allele_designations_by_isolate_ids(self, isolate_ids, locus_list_table):
+        qry = (
+            "SELECT isolate_id,locus,allele_id,status FROM allele_designations ad "
+            f"JOIN {locus_list_table} l ON ad.locus=l.value WHERE isolate_id=ANY(?) "
+            "ORDER BY isolate_id,locus,status,(substring (allele_id, '^[0-9]+'))::int,"
+            "allele_id"
+        )
+        data = self.run_query(
+            qry, [list(isolate_ids)], {"fetch": "all_arrayref", "slice": {}}
+        )
+        designations = {}
+        for designation in data:
+            designations.setdefault(designation["isolate_id"], {}).setdefault(
+                designation["locus"], []
+            ).append(designation)
+        return designations
+
+    # Returns the cached matrix of all allele designations in the database,
+    # updated with any changes since it was last used.
+    def get_designation_matrix(self):
+        if self.designation_matrix is None:
+            cache_dir = self.config.get("designation_cache_dir") or (
+                f"{self.config.get('secure_tmp_dir')}/designation_matrix"
+            )
+            options = {}
+            if self.config.get("designation_matrix_check_interval"):
+                options["check_interval"] = int(
+                    self.config["designation_matrix_check_interval"]
+                )
+            self.designation_matrix = DesignationMatrix(
+                db=self.db,
+                dbase_name=self.system["db"],
+                cache_dir=cache_dir,
+                logger=self.logger,
+                options=options,
+            )
+        self.designation_matrix.refresh()
+        return self.designation_matrix
+
     def get_scheme_group_info(self, group_id):
         return self.run_query(
             "SELECT * FROM scheme_groups WHERE id=?",
             group_id,
-            {"fetch": "row_hashref", "cache": "get_scheme_group_info"},
+            {"fetch": "row_hashref", "cache": "get_scheme_group_info", "metadata": 1},
         )
 
     def get_scheme_info(self, scheme_id, options={}):
@@ -619,18 +1093,17 @@ class Datastore(object):
         scheme_info = self.run_query(
             "SELECT * FROM schemes WHERE id=?",
             scheme_id,
-            {
-                "fetch": "row_hashref",
-            },
+            {"fetch": "row_hashref", "metadata": 1},
         )
+        if scheme_info is None:
+            return
+        scheme_info = dict(scheme_info)  # Cached value is modified below.
 
         if "set_id" in options:
             desc = self.run_query(
                 "SELECT set_name FROM set_schemes WHERE set_id=? AND scheme_id=?",
                 [options["set_id"], scheme_id],
-                {
-                    "fetch": "row_array",
-                },
+                {"fetch": "row_array", "metadata": 1},
             )
             if desc:
                 scheme_info["name"] = desc[0]
@@ -639,7 +1112,7 @@ class Datastore(object):
             pk = self.run_query(
                 "SELECT field FROM scheme_fields WHERE scheme_id=? AND primary_key",
                 scheme_id,
-                {"fetch": "row_array"},
+                {"fetch": "row_array", "metadata": 1},
             )
             if pk:
                 scheme_info["primary_key"] = pk
@@ -655,7 +1128,7 @@ class Datastore(object):
                 + " FROM scheme_members WHERE scheme_id=? ORDER BY field_order,locus"
             )
             self.cache.setdefault("scheme_loci", {})[scheme_id] = self.run_query(
-                qry, scheme_id, {"fetch": "all_arrayref"}
+                qry, scheme_id, {"fetch": "all_arrayref", "metadata": 1}
             )
 
         loci = []
@@ -683,7 +1156,7 @@ class Datastore(object):
             data = self.run_query(
                 "SELECT scheme_id, field FROM scheme_fields ORDER BY field_order, field",
                 None,
-                {"fetch": "all_arrayref"},
+                {"fetch": "all_arrayref", "metadata": 1},
             )
             self.cache["all_scheme_fields"] = {}
             for row in data:
@@ -703,22 +1176,7 @@ class Datastore(object):
             attributes = self.get_scheme_info(scheme_id)
             if attributes.get("dbase_name"):
                 try:
-                    attributes["db"] = self.data_connector.get_connection(
-                        dbase_name=attributes["dbase_name"],
-                        host=attributes["dbase_host"]
-                        or self.config.get("dbase_host")
-                        or self.config.get("dbhost")
-                        or self.system.get("host"),
-                        user=attributes["dbase_user"]
-                        or self.config.get("dbase_user")
-                        or self.config.get("dbuser")
-                        or self.system.get("user"),
-                        password=attributes["dbase_password"]
-                        or self.config.get("dbase_password")
-                        or self.config.get("dbpassword")
-                        or self.system.get("password"),
-                    )
-
+                    attributes["db"] = self._get_scheme_db(attributes)
                 except Exception as e:
                     self.logger.error(
                         f"Error connecting scheme database scheme:{scheme_id}: {e}"
@@ -728,17 +1186,43 @@ class Datastore(object):
                 attributes["loci"] = self.get_scheme_loci(
                     scheme_id, ({"profile_name": 1, "analysis_pref": 0})
                 )
+                attributes["use_profile_index"] = bool(
+                    self.config.get("scheme_profile_index")
+                )
+                if self.config.get("scheme_profile_index_check_interval"):
+                    attributes["profile_index_check_interval"] = int(
+                        self.config["scheme_profile_index_check_interval"]
+                    )
                 attributes["primary_keys"] = self.run_query(
                     "SELECT field FROM scheme_fields WHERE scheme_id=%s AND "
                     "primary_key ORDER BY field_order",
                     scheme_id,
-                    {"fetch": "col_arrayref"},
+                    {"fetch": "col_arrayref", "metadata": 1},
                 )
+                attributes["instance"] = self.system.get("db")
                 self.scheme[scheme_id] = Scheme(
                     attributes=attributes, logger=self.logger
                 )
         return self.scheme[scheme_id]
 
+    # Connection to the sequence definition database of a scheme.
+    def _get_scheme_db(self, attributes):
+        return self.data_connector.get_connection(
+            dbase_name=attributes["dbase_name"],
+            host=attributes["dbase_host"]
+            or self.config.get("dbase_host")
+            or self.config.get("dbhost")
+            or self.system.get("host"),
+            user=attributes["dbase_user"]
+            or self.config.get("dbase_user")
+            or self.config.get("dbuser")
+            or self.system.get("user"),
+            password=attributes["dbase_password"]
+            or self.config.get("dbase_password")
+            or self.config.get("dbpassword")
+            or self.system.get("password"),
+        )
+
     def get_scheme_field_values_by_designations(
         self, scheme_id, designations, options={}
     ):
@@ -747,7 +1231,9 @@ class Datastore(object):
         try:
             scheme = self.get_scheme(scheme_id)
         except Exception as e:
-            self.logger.warn(f"Scheme {scheme_id} database is not configured correctly")
+            self.logger.warning(
+                f"Scheme {scheme_id} database is not configured correctly"
+            )
 
         if scheme is None:
             return
@@ -755,42 +1241,120 @@ class Datastore(object):
         if not options.get("no_convert"):
             self._convert_designations_to_profile_names(scheme_id, designations)
 
+        scheme_options = {}
+        if "use_index" in options:
+            scheme_options["use_index"] = options["use_index"]
         try:
-            field_data = scheme.get_field_values_by_designations(designations)
+            field_data = scheme.get_field_values_by_designations(
+                designations, scheme_options
+            )
         except Exception as e:
-            logger.warn(f"Scheme {scheme_id} database is not configured correctly")
+            self.logger.warning(
+                f"Scheme {scheme_id} database is not configured correctly"
+            )
 
         if options.get("no_status"):
             return field_data
+        return self._get_scheme_field_values_with_status(
+            scheme_id, designations, field_data
+        )
 
+    # Values are provisional if any designation (other than N or 0) of a
+    # scheme locus is not confirmed.
+    def _get_scheme_field_values_with_status(self, scheme_id, designations, field_data):
         values = {}
+        if not field_data:
+            return values
         loci = self.get_scheme_loci(scheme_id)
         fields = self.get_scheme_fields(scheme_id)
-
-        for data in field_data:
-            status = "confirmed"
-            for locus in loci:
-                if designations.get(locus) is None:
+        status = "confirmed"
+        for locus in loci:
+            if designations.get(locus) is None:
+                continue
+            for designation in designations[locus]:
+                if (
+                    designation["allele_id"] in ["N", "0"]
+                    or designation.get("status") == "confirmed"
+                ):
                     continue
-                for designation in designations[locus]:
-                    if (
-                        designation["allele_id"] in ["N", "0"]
-                        or designation.get("status") == "confirmed"
-                    ):
-                        continue
-                    status = "provisional"
-                    break
-                if status == "provisional":
-                    break
+                status = "provisional"
+                break
+            if status == "provisional":
+                break
 
+        for data in field_data:
             for field in fields:
-
                 data[field] = data.get(field, "")
-                if values.get(field, {}).get(data[field], "") != "confirmed":
+                if (
+                    values.get(field, {}).get(data[field], {}).get("status")
+                    != "confirmed"
+                ):
                     values.setdefault(field, {})[data[field]] = {"status": status}
 
         return values
 
+    # Batch version of get_scheme_field_values_by_isolate_id. Designations for
+    # all isolates are retrieved with one query and matched against the
+    # scheme profiles together. Returns a dict of values keyed by isolate id.
+    def get_scheme_field_values_by_isolate_ids(
+        self, isolate_ids, scheme_id, options={}
+    ):
+        isolate_ids = list(isolate_ids)
+        try:
+            scheme = self.get_scheme(scheme_id)
+        except Exception as e:
+            self.logger.warning(
+                f"Scheme {scheme_id} database is not configured correctly"
+            )
+            return {}
+        designation_sets = self.get_scheme_allele_designations_by_isolate_ids(
+            isolate_ids, scheme_id
+        )
+
+        if options.get("allow_presence"):
+            present = self.run_query(
+                "SELECT a.isolate_id,a.locus FROM allele_sequences a JOIN "
+                "scheme_members s ON a.locus=s.locus WHERE a.isolate_id=ANY(?) AND "
+                "s.scheme_id=?",
+                [isolate_ids, scheme_id],
+                {"fetch": "all_arrayref"},
+            )
+            for isolate_id, locus in present:
+                designations = designation_sets.setdefault(isolate_id, {})
+                if locus not in designations:
+                    designations[locus] = [{"allele_id": "P", "status": "confirmed"}]
+
+        if not options.get("no_convert"):
+            for designations in designation_sets.values():
+                self._convert_designations_to_profile_names(scheme_id, designations)
+
+        scheme_options = {}
+        if "use_index" in options:
+            scheme_options["use_index"] = options["use_index"]
+        try:
+            field_data = scheme.get_field_values_by_designation_sets(
+                designation_sets, scheme_options
+            )
+        except Exception as e:
+            self.logger.warning(
+                f"Scheme {scheme_id} database is not configured correctly"
+            )
+            field_data = {}
+
+        values = {}
+        for isolate_id in isolate_ids:
+            if not designation_sets.get(isolate_id):
+                values[isolate_id] = {}
+            elif options.get("no_status"):
+                values[isolate_id] = field_data.get(isolate_id, [])
+            else:
+                values[isolate_id] = self._get_scheme_field_values_with_status(
+                    scheme_id,
+                    designation_sets[isolate_id],
+                    field_data.get(isolate_id, []),
+                )
+        return values
+
     def get_scheme_field_values_by_isolate_id(self, isolate_id, scheme_id, options={}):
         designations = self.get_scheme_allele_designations(isolate_id, scheme_id)
 
@@ -816,17 +1380,38 @@ class Datastore(object):
         return field_values
 
     def _convert_designations_to_profile_names(self, scheme_id, designations):
-        data = self.run_query(
-            "SELECT locus, profile_name FROM scheme_members WHERE scheme_id=?",
-            scheme_id,
-            {"fetch": "all_arrayref"},
-        )
-        for locus, profile_name in data:
+        if scheme_id not in self.cache.get("scheme_profile_names", {}):
+            self.cache.setdefault("scheme_profile_names", {})[scheme_id] = (
+                self.run_query(
+                    "SELECT locus, profile_name FROM scheme_members WHERE scheme_id=?",
+                    scheme_id,
+                    {"fetch": "all_arrayref", "metadata": 1},
+                )
+            )
+        for locus, profile_name in self.cache["scheme_profile_names"][scheme_id]:
             if profile_name is None or locus == profile_name:
                 continue
-            designations[profile_name] = designations.pop(locus, None)
+            if locus in designations:
+                designations[profile_name] = designations.pop(locus)
         return
 
+    # Returns a dict keyed by isolate id, each containing a dict of the scheme
+    # designations keyed by locus.
+    def get_scheme_allele_designations_by_isolate_ids(self, isolate_ids, scheme_id):
+        data = self.run_query(
+            "SELECT * FROM allele_designations WHERE isolate_id=ANY(?) AND locus IN "
+            "(SELECT locus FROM scheme_members WHERE scheme_id=?) ORDER BY "
+            "isolate_id,status,(substring(allele_id, '^[0-9]+'))::int,allele_id",
+            [list(isolate_ids), scheme_id],
+            {"fetch": "all_arrayref", "slice": {}},
+        )
+        designations = {}
+        for designation in data:
+            designations.setdefault(designation["isolate_id"], {}).setdefault(
+                designation["locus"], []
+            ).append(designation)
+        return designations
+
     def get_scheme_allele_designations(self, isolate_id, scheme_id, options={}):
         designations = {}
 
@@ -870,10 +1455,27 @@ class Datastore(object):
 
 
 # BIGSdb Perl DBI code uses ? as placeholders in SQL queries. psycopg2 uses
-# %s. Rewrite so that the same SQL works with both.
+# %s. Rewrite so that the same SQL works with both. The same query strings are
+# used repeatedly so the rewritten versions are cached.
+@lru_cache(maxsize=2048)
 def replace_placeholders(query):
     return re.sub(r"\?", "%s", query)
 
 
+# Convert psycopg2 %s placeholders to the $1, $2... form used by PREPARE.
+# Returns the converted query and the number of parameters.
+def convert_placeholders_to_numbered(query):
+    count = 0
+
+    def number(match):
+        nonlocal count
+        if match.group(0) == "%%":
+            return "%"
+        count += 1
+        return f"${count}"
+
+    return re.sub(r"%%|%s", number, query), count
+
+
 def nested_defaultdict():
     return defaultdict(nested_defaultdict)
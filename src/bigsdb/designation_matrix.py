@@ -0,0 +1,378 @@
+# Written by Keith Jolley
+# Copyright (c) 2024, University of Oxford
+# E-mail: keith.jolley@biology.ox.ac.uk
+#
+# This file is part of BIGSdb Python Toolkit.
+#
+# BIGSdb Python Toolkit is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BIGSdb Python Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BIGSdb Python Toolkit. If not,
+# see <https://www.gnu.org/licenses/>.
+
+import os
+import json
+import mmap
+import time
+import fcntl
+import random
+import psycopg2.extras
+from contextlib import contextmanager
+
+# Seconds between checks of allele_designations for changes.
+REFRESH_CHECK_INTERVAL = 60
+CELL_SIZE = 4  # Bytes per cell (signed 32-bit integer).
+MAX_CODE = 2**31 - 2
+
+
+# Cache of the allele designations of an isolate database as an isolate x locus
+# matrix, stored in a memory-mapped file so that it can be shared between
+# processes and jobs and read without querying the database.
+#
+# Each cell is a signed 32-bit integer:
+#   0           no designation
+#   n > 0       a single confirmed designation with numeric allele id n - 1
+#   -n < 0      entry n in the side table, which holds the full list of
+#               designations (allele id and status) for cells with non-numeric
+#               or provisional allele ids or more than one designation.
+#
+# The matrix is updated incrementally from allele_designations.datestamp. It
+# is rebuilt if loci have been added or if designations have been removed.
+# Updates patch the changed cells in place (rows for new isolates are added
+# to the end of the file) under an exclusive lock on the lock file, while
+# readers hold a shared lock and reload the metadata (including the side
+# table) if it has changed. The metadata file is removed while the matrix is
+# being patched so that an interrupted update leads to a rebuild.
+class DesignationMatrix:
+    def __init__(
+        self, db=None, dbase_name=None, cache_dir=None, logger=None, options={}
+    ):
+        self.db = db
+        self.dbase_name = dbase_name
+        self.cache_dir = cache_dir
+        self.logger = logger
+        self.check_interval = options.get("check_interval", REFRESH_CHECK_INTERVAL)
+        self.matrix_file = os.path.join(cache_dir, f"{dbase_name}.matrix")
+        self.meta_file = os.path.join(cache_dir, f"{dbase_name}.json")
+        self.lock_file = os.path.join(cache_dir, f"{dbase_name}.lock")
+        self.meta = None
+        self.mmap = None
+        self.cells = None
+        self.last_check = None
+        self.lock = None
+
+    # Queries are run within a savepoint so that the caller's transaction is
+    # neither committed nor, if the refresh fails, aborted.
+    def refresh(self):
+        now = time.monotonic()
+        if self.last_check is not None and now - self.last_check < self.check_interval:
+            return
+        self.last_check = now
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        with self._locked(fcntl.LOCK_EX):
+            cursor = self.db.cursor()
+            cursor.execute("SAVEPOINT designation_matrix")
+            try:
+                self._load()
+                if self.meta is None:
+                    self._build()
+                else:
+                    self._update()
+                cursor.execute("RELEASE SAVEPOINT designation_matrix")
+            except Exception as e:
+                self.logger.error(f"Cannot refresh designation matrix: {e}")
+                cursor.execute("ROLLBACK TO SAVEPOINT designation_matrix")
+
+                # Reload from the files next time. If they were being updated
+                # the metadata file will have gone and the matrix is rebuilt.
+                self._close()
+                self.meta = None
+                raise
+
+    @contextmanager
+    def _locked(self, operation):
+        if self.lock is None:
+            self.lock = open(self.lock_file, "a")
+        fcntl.flock(self.lock, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock, fcntl.LOCK_UN)
+
+    # (Re)open the files if they have been replaced by another process.
+    def _load(self):
+        if not os.path.exists(self.meta_file) or not os.path.exists(self.matrix_file):
+            self._close()
+            self.meta = None
+            return
+        file_id = self._get_file_id()
+        if self.meta is not None and self.file_id == file_id:
+            return
+        with open(self.meta_file) as f:
+            self.meta = json.load(f)
+        self.meta.setdefault("side_table_unused", 0)
+        self._open_matrix()
+        self.file_id = file_id
+
+    def _get_file_id(self):
+        matrix_stat = os.stat(self.matrix_file)
+        meta_stat = os.stat(self.meta_file)
+        return (
+            matrix_stat.st_ino,
+            matrix_stat.st_size,
+            meta_stat.st_ino,
+            meta_stat.st_mtime_ns,
+        )
+
+    def _open_matrix(self, filename=None):
+        filename = filename or self.matrix_file
+        self._close()
+        self.isolate_row = {
+            isolate_id: row for row, isolate_id in enumerate(self.meta["isolates"])
+        }
+        self.locus_column = {
+            locus: column for column, locus in enumerate(self.meta["loci"])
+        }
+        if os.path.getsize(filename) == 0:
+            return
+        with open(filename, "r+b") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0)
+        self.cells = memoryview(self.mmap).cast("i")
+
+    def _close(self):
+        if self.cells is not None:
+            self.cells.release()
+            self.cells = None
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+    # The datestamp only has a resolution of a day, so the statistics
+    # counters are also needed to tell whether designations have been changed
+    # on the same day as the last update.
+    def _get_state(self):
+        cursor = self.db.cursor()
+        cursor.execute("SELECT COUNT(*),MAX(datestamp)::text FROM allele_designations")
+        count, datestamp = cursor.fetchone()
+        cursor.execute("SELECT pg_stat_clear_snapshot()")
+        cursor.execute(
+            "SELECT n_tup_ins,n_tup_upd,n_tup_del FROM pg_stat_user_tables WHERE "
+            "relname='allele_designations' AND schemaname=current_schema()"
+        )
+        stats = cursor.fetchone()
+        state = {
+            "count": count,
+            "datestamp": datestamp,
+            "stats": list(stats) if stats else None,
+        }
+        cursor.execute("SELECT id FROM loci ORDER BY id")
+        loci = [row[0] for row in cursor.fetchall()]
+        cursor.execute("SELECT id FROM isolates ORDER BY id")
+        isolates = [row[0] for row in cursor.fetchall()]
+        return state, loci, isolates
+
+    def _build(self):
+        state, loci, isolates = self._get_state()
+        self._close()
+        self.meta = {
+            "isolates": isolates,
+            "loci": loci,
+            "side_table": [],
+            "side_table_unused": 0,
+            **state,
+        }
+        tmp_file = f"{self.matrix_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, "wb") as f:
+                f.truncate(len(isolates) * len(loci) * CELL_SIZE)
+            self._open_matrix(tmp_file)
+            cursor = self.db.cursor(
+                f"bigsdb_designation_matrix_{random.randint(0, 99999999)}",
+                cursor_factory=psycopg2.extras.DictCursor,
+            )
+            cursor.itersize = 100000
+            cursor.execute(
+                "SELECT isolate_id,locus,allele_id,status FROM allele_designations "
+                "ORDER BY isolate_id,locus,status,"
+                "(substring(allele_id, '^[0-9]+'))::int,allele_id"
+            )
+            self._set_cells(cursor)
+            cursor.close()
+            self._save(tmp_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        self.logger.info(
+            f"Built designation matrix for {self.dbase_name}: "
+            f"{len(isolates)} isolates x {len(loci)} loci."
+        )
+
+    # Designations changed on or after the last datestamp (which only has
+    # a resolution of a day) are reloaded. Any other difference in the
+    # number of designations means that some have been deleted.
+    def _update(self):
+        state, loci, isolates = self._get_state()
+        if all(self.meta.get(key) == value for key, value in state.items()):
+            return
+        if loci != self.meta["loci"] or set(self.meta["isolates"]) - set(isolates):
+            self._build()
+            return
+        os.remove(self.meta_file)
+        new_isolates = [
+            isolate_id for isolate_id in isolates if isolate_id not in self.isolate_row
+        ]
+        if new_isolates:
+            self._close()
+            self.meta["isolates"].extend(new_isolates)
+            with open(self.matrix_file, "r+b") as f:
+                f.truncate(len(self.meta["isolates"]) * len(loci) * CELL_SIZE)
+            self._open_matrix()
+        cursor = self.db.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cursor.execute(
+            "SELECT isolate_id,locus,allele_id,status FROM allele_designations "
+            "WHERE (isolate_id,locus) IN (SELECT isolate_id,locus FROM "
+            "allele_designations WHERE datestamp>=%s) ORDER BY isolate_id,locus,"
+            "status,(substring(allele_id, '^[0-9]+'))::int,allele_id",
+            [self.meta["datestamp"]],
+        )
+        expected_count = self.meta["count"] + self._set_cells(cursor.fetchall())
+        if expected_count != state["count"]:
+            self._build()
+            return
+        self.meta.update(state)
+        self._save()
+
+    # Returns the change in the number of designations held in the matrix.
+    def _set_cells(self, rows):
+        loci = len(self.meta["loci"])
+        side_table = self.meta["side_table"]
+        cell = None
+        designations = []
+        change = 0
+
+        def store(cell, designations):
+            nonlocal change
+            current = self.cells[cell]
+            change += len(designations) - len(self.decode(current))
+            if (
+                len(designations) == 1
+                and designations[0][1] == "confirmed"
+                and designations[0][0].isdigit()
+                and (designations[0][0] == "0" or designations[0][0][0] != "0")
+                and int(designations[0][0]) <= MAX_CODE
+            ):
+                self.cells[cell] = int(designations[0][0]) + 1
+                if current < 0:
+                    self.meta["side_table_unused"] += 1
+                return
+            if current < 0:
+                side_table[-current - 1] = designations
+            else:
+                side_table.append(designations)
+                self.cells[cell] = -len(side_table)
+
+        for row in rows:
+            row_cell = (
+                self.isolate_row[row["isolate_id"]] * loci
+                + self.locus_column[row["locus"]]
+            )
+            if row_cell != cell:
+                if cell is not None:
+                    store(cell, designations)
+                cell = row_cell
+                designations = []
+            designations.append([row["allele_id"], row["status"]])
+        if cell is not None:
+            store(cell, designations)
+        return change
+
+    # Side table entries are left behind when a cell is given a numeric code,
+    # so the table is rewritten once more than half of it is unused.
+    def _compact_side_table(self):
+        side_table = self.meta["side_table"]
+        if self.meta["side_table_unused"] * 2 <= len(side_table):
+            return
+        compacted = []
+        cells = self.cells
+        for cell, code in enumerate(cells):
+            if code < 0:
+                compacted.append(side_table[-code - 1])
+                cells[cell] = -len(compacted)
+        self.meta["side_table"] = compacted
+        self.meta["side_table_unused"] = 0
+
+    # A newly built matrix is written to a temporary file which then replaces
+    # the original. The metadata are written last.
+    def _save(self, matrix_file=None):
+        if self.cells is not None:
+            self._compact_side_table()
+        if self.mmap is not None:
+            self.mmap.flush()
+        if matrix_file is not None:
+            os.replace(matrix_file, self.matrix_file)
+        tmp_file = f"{self.meta_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_file, self.meta_file)
+        self.file_id = self._get_file_id()
+
+    # Returns a zero-copy view of the codes for an isolate, one per locus (in
+    # the order of self.meta["loci"]), or None if the isolate is not present.
+    def get_row(self, isolate_id):
+        row = self.isolate_row.get(isolate_id)
+        if row is None or self.cells is None:
+            return
+        loci = len(self.meta["loci"])
+        return self.cells[row * loci : (row + 1) * loci]
+
+    def decode(self, code):
+        if code == 0:
+            return []
+        if code > 0:
+            return [{"allele_id": str(code - 1), "status": "confirmed"}]
+        return [
+            {"allele_id": allele_id, "status": status}
+            for allele_id, status in self.meta["side_table"][-code - 1]
+        ]
+
+    # Returns a dict keyed by isolate id, each containing a dict of
+    # designations keyed by locus (same structure as returned by
+    # Datastore.get_allele_designations_by_isolate_ids). Raises an error if
+    # the matrix has been removed, e.g. by a failed update, since the last
+    # refresh.
+    def get_designations(self, isolate_ids, loci):
+        with self._locked(fcntl.LOCK_SH):
+            self._load()
+            if self.meta is None:
+                raise RuntimeError(f"No designation matrix for {self.dbase_name}.")
+            return self._get_designations(isolate_ids, loci)
+
+    def _get_designations(self, isolate_ids, loci):
+        columns = [
+            (locus, self.locus_column[locus])
+            for locus in loci
+            if locus in self.locus_column
+        ]
+        designations = {}
+        for isolate_id in isolate_ids:
+            row = self.get_row(isolate_id)
+            if row is None:
+                continue
+            for locus, column in columns:
+                code = row[column]
+                if code == 0:
+                    continue
+                isolate_designations = designations.setdefault(isolate_id, {})
+                isolate_designations[locus] = [
+                    dict(designation, isolate_id=isolate_id, locus=locus)
+                    for designation in self.decode(code)
+                ]
+        return designations
@@ -0,0 +1,115 @@
+# Written by Keith Jolley
+# Copyright (c) 2024, University of Oxford
+# E-mail: keith.jolley@biology.ox.ac.uk
+#
+# This file is part of BIGSdb Python Toolkit.
+#
+# BIGSdb Python Toolkit is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BIGSdb Python Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BIGSdb Python Toolkit. If not,
+# see <https://www.gnu.org/licenses/>.
+
+import xlsxwriter
+
+MAX_ROWS = 1048576  # Excel worksheet row limit.
+
+
+# Writes rows to an Excel file as they are produced. The workbook is opened in
+# constant_memory mode so that each row is flushed to disk once the next one is
+# started, so memory use does not grow with the number of rows. Column
+# formats are decided once from the header, and column widths are tracked as
+# rows are written. When a worksheet is full, further rows are written to a
+# new worksheet (with the header repeated).
+class ExcelWriter:
+    def __init__(self, filename, header=None, options={}):
+        self.filename = filename
+        self.options = options
+        self.header = header
+        self.workbook = xlsxwriter.Workbook(
+            filename, {"constant_memory": True, "strings_to_urls": False}
+        )
+        self.workbook.use_zip64()
+        self.header_format = self.workbook.add_format({"align": "center", "bold": True})
+        self.cell_format = self.workbook.add_format({"align": "center"})
+        self.text_format = self.workbook.add_format(
+            {"num_format": "@", "align": "center"}
+        )
+        self.text_cols = set()
+        if header:
+            text_fields = {"isolate", "strain", "sample"}
+            if options.get("text_fields"):
+                text_fields.update(options["text_fields"].split(","))
+            self.text_cols = {
+                col for col, field in enumerate(header) if field in text_fields
+            }
+        self.worksheet_name = options.get("worksheet", "output")
+        self.worksheets = []
+        self.widths = {}
+        self._add_worksheet()
+
+    def _add_worksheet(self):
+        if self.worksheets:
+            self._finish_worksheet()
+            # Worksheet names are limited to 31 characters.
+            name = f"{self.worksheet_name[:24]} ({len(self.worksheets) + 1})"
+        else:
+            name = self.worksheet_name
+        self.worksheet = self.workbook.add_worksheet(name)
+        self.worksheets.append(self.worksheet)
+        self.widths = {}
+        self.row = 0
+        if self.header:
+            for col, value in enumerate(self.header):
+                self.worksheet.write_string(0, col, str(value), self.header_format)
+                self._track_width(col, value)
+            self.worksheet.freeze_panes(1, 0)
+            self.row = 1
+
+    def _track_width(self, col, value):
+        width = len(value) if isinstance(value, str) else len(str(value))
+        if width > self.widths.get(col, 0):
+            self.widths[col] = width
+
+    def write_row(self, values):
+        if self.row >= MAX_ROWS:
+            self._add_worksheet()
+        worksheet = self.worksheet
+        row = self.row
+        for col, value in enumerate(values):
+            if value is None or value == "":
+                continue
+            if col in self.text_cols:
+                worksheet.write_string(row, col, str(value), self.text_format)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                worksheet.write_number(row, col, value, self.cell_format)
+            else:
+                worksheet.write_string(row, col, str(value), self.cell_format)
+            self._track_width(col, value)
+        self.row += 1
+
+    def _finish_worksheet(self):
+        for col, width in self.widths.items():
+            width = int(0.9 * width + 2)
+            if "max_width" in self.options:
+                width = min(width, self.options["max_width"])
+            self.worksheet.set_column(col, col, width)
+
+    def close(self):
+        self._finish_worksheet()
+        self.workbook.close()
+        return self.filename
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -21,17 +21,62 @@
 import os
 import signal
 import logging
+import json
+import select
+import shutil
+import time
 import psycopg2.extras
 from psycopg2 import sql
-import gzip
-import shutil
 import io
 import bigsdb.utils
+import bigsdb.parallel_gzip
 from bigsdb.base_application import BaseApplication
 from bigsdb.constants import CONNECTION_DETAILS, LOGS
 
 DBASE_QUOTA_EXCEEDED = 1
 USER_QUOTA_EXCEEDED = 2
+JOBS_CHANNEL = "bigsdb_jobs"
+
+# Cancellations are normally received as notifications. Jobs can also be
+# cancelled by clients that do not send a notification, so the cancel flag is
+# also checked in the database at this interval (seconds).
+CANCEL_CHECK_INTERVAL = 60
+
+# Interval (seconds) between checks of the cancel flag in the database for
+# job managers that do not have a listener for notifications.
+CANCEL_POLL_INTERVAL = 5
+
+# Default minimum interval (seconds) and percentage change between progress
+# updates written by a ProgressReporter.
+PROGRESS_INTERVAL = 5
+PROGRESS_STEP = 5
+
+# Default fair-share scheduling parameters. Each job that a user (or IP
+# address if not logged in) has running, or queued ahead of a job, adds
+# FAIR_SHARE_WEIGHT to that job's effective priority. Each JOB_AGING_INTERVAL
+# seconds that a job has waited takes 1 from it.
+FAIR_SHARE_WEIGHT = 1
+JOB_AGING_INTERVAL = 300
+SCHEDULER_LOCK_ID = 7293651  # Advisory lock serialising claims.
+
+# Jobs started within this number of seconds are used for wait time metrics.
+RECENT_JOBS_PERIOD = 3600
+
+# Parameter recording the isolate data fingerprint for jobs whose output may
+# be re-used (result_cache_ttl).
+DATA_FINGERPRINT_PARAM = "result_cache_data_fingerprint"
+
+# Default age (days since a job ended) at which jobs are archived, and the
+# number of jobs moved in each transaction.
+JOB_ARCHIVE_DAYS = 90
+JOB_ARCHIVE_BATCH_SIZE = 5000
+
+# Tables holding rows for each job, keyed by job_id.
+JOB_CHILD_TABLES = ("params", "isolates", "profiles", "loci", "output")
+
+
+class JobCancelledError(Exception):
+    pass
 
 
 class JobManager(BaseApplication):
@@ -49,6 +94,13 @@ class JobManager(BaseApplication):
         self.system = system
         self.config = config
 
+        # Job workers that run many jobs in one process set this so that a
+        # cancelled job raises JobCancelledError rather than killing the process.
+        self.raise_on_cancel = False
+        self.listener = None
+        self.scheduler = None
+        self.last_cancel_check = {}
+
         self._init_logger(logger=logger)
         self._db_connect()
 
@@ -70,22 +122,53 @@ class JobManager(BaseApplication):
             raise ValueError("jobs_db not defined in bigsdb.conf")
         if options.get("reconnect"):
             self.data_connector.drop_all_connections()
-        self.db = self.data_connector.get_connection(
-            dbase_name=self.config["jobs_db"],
-            host=self.config.get("dbhost") or CONNECTION_DETAILS["HOST"],
-            port=self.config.get("dbport") or CONNECTION_DETAILS["PORT"],
-            user=self.config.get("dbuser") or CONNECTION_DETAILS["USER"],
-            password=self.config.get("dbpassword") or CONNECTION_DETAILS["PASSWORD"],
-        )
+        self.db = self.data_connector.get_connection(**self._get_connection_args())
+
+    def _get_connection_args(self):
+        return {
+            "dbase_name": self.config["jobs_db"],
+            "host": self.config.get("dbhost") or CONNECTION_DETAILS["HOST"],
+            "port": self.config.get("dbport") or CONNECTION_DETAILS["PORT"],
+            "user": self.config.get("dbuser") or CONNECTION_DETAILS["USER"],
+            "password": self.config.get("dbpassword") or CONNECTION_DETAILS["PASSWORD"],
+        }
+
+    # Start listening for job notifications on a dedicated connection. Only
+    # one listener is needed per process, so other job managers in the same
+    # process (e.g. those of plugins run by a JobWorker) can be given it by
+    # setting their listener attribute.
+    def listen(self):
+        if self.listener is None or self.listener.db.closed:
+            self.listener = JobListener(
+                self.data_connector.get_new_connection(**self._get_connection_args()),
+                logger=self.logger,
+            )
+        return self.listener
 
-    def _has_ip_address_got_queued_jobs(self, ip_address):
+    def close_listener(self):
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+
+    # Notifications are sent within the current transaction so are only
+    # delivered to listeners once it has been committed.
+    def _notify(self, cursor, event, job_id, data={}):
+        payload = {"event": event, "job_id": job_id}
+        payload.update(data)
+        cursor.execute("SELECT pg_notify(%s,%s)", [JOBS_CHANNEL, json.dumps(payload)])
+
+    def cancel_job(self, job_id):
+        if self.db.closed:
+            self._db_connect()
         cursor = self.db.cursor()
-        qry = "SELECT EXISTS(SELECT * FROM jobs WHERE (ip_address,status)=(%s,%s))"
+        qry = "UPDATE jobs SET cancel=TRUE WHERE id=%s"
         try:
-            cursor.execute(qry, [ip_address, "submitted"])
+            cursor.execute(qry, [job_id])
+            self._notify(cursor, "cancel", job_id)
+            self.db.commit()
         except Exception as e:
             self.logger.error(f"{e} Query:{qry}")
-        return cursor.fetchone()[0]
+            self.db.rollback()
 
     def _make_job_fingerprint(self, params):
         key = ""
@@ -109,66 +192,67 @@ class JobManager(BaseApplication):
             return
         return True
 
-    def _get_duplicate_job_id(self, fingerprint=None, username=None, ip_address=None):
-        cursor = self.db.cursor()
-        qry = (
-            "SELECT id FROM jobs WHERE fingerprint=%s AND (status='started' OR "
-            "status='submitted') AND "
-        )
+    # Duplicate, queued job and quota checks for a new job are made with a
+    # single statement over the active (submitted or started) jobs. Returns
+    # None if the checks cannot be made, in which case the job is rejected.
+    def _check_admission(self, params, fingerprint):
         check_ip_address = (
             self.system.get("read_access", "") == "public"
             and not self._jobs_require_login()
         )
-        qry += "ip_address=%s" if check_ip_address else "username=%s"
+        owner_column = "ip_address" if check_ip_address else "username"
+        qry = (
+            "WITH active AS (SELECT id,fingerprint,dbase_config,username,"
+            "ip_address,status FROM jobs WHERE status IN ('submitted','started')) "
+            "SELECT EXISTS(SELECT * FROM active WHERE ip_address=%(ip_address)s "
+            "AND status='submitted') AS ip_address_queued,(SELECT id FROM active "
+            f"WHERE fingerprint=%(fingerprint)s AND {owner_column}=%(owner)s LIMIT "
+            "1) AS duplicate_job,(SELECT COUNT(*) FROM active WHERE dbase_config="
+            "%(dbase_config)s) AS dbase_jobs,(SELECT COUNT(*) FROM active WHERE "
+            "(dbase_config,username)=(%(dbase_config)s,%(username)s)) AS user_jobs"
+        )
+        cursor = self.db.cursor(cursor_factory=psycopg2.extras.DictCursor)
         try:
             cursor.execute(
-                qry, [fingerprint, (ip_address if check_ip_address else username)]
+                qry,
+                {
+                    "ip_address": params.get("ip_address"),
+                    "fingerprint": fingerprint,
+                    "owner": (
+                        params.get("ip_address")
+                        if check_ip_address
+                        else params.get("username", "")
+                    ),
+                    "dbase_config": params.get("dbase_config"),
+                    "username": params.get("username"),
+                },
             )
+            return dict(cursor.fetchone())
         except Exception as e:
             self.logger.error(f"{e} Query:{qry}")
-        row = cursor.fetchone()
-        if row == None:
+            self.db.rollback()
             return
-        return row[0]
 
-    def _is_quota_exceeded(self, params):
-        cursor = self.db.cursor()
+    def _is_quota_exceeded(self, params, admission):
         if bigsdb.utils.is_integer(self.system.get("job_quota")):
-            qry = (
-                "SELECT COUNT(*) FROM jobs WHERE dbase_config=%s AND "
-                "status IN ('submitted','started')"
-            )
-            try:
-                cursor.execute(qry, [params.get("dbase_config")])
-            except Exception as e:
-                self.logger.error(f"{e} Query:{qry}")
-            job_count = cursor.fetchone()[0]
-            if job_count >= int(self.system.get("job_quota")):
+            if admission.get("dbase_jobs", 0) >= int(self.system.get("job_quota")):
                 return DBASE_QUOTA_EXCEEDED
         if bigsdb.utils.is_integer(self.system.get("user_job_quota")) and params.get(
             "username"
         ):
-            qry = (
-                "SELECT COUNT(*) FROM jobs WHERE (dbase_config,username)=(%s,%s) "
-                "AND status IN ('submitted','started')"
-            )
-            try:
-                cursor.execute(
-                    qry, [params.get("dbase_config"), params.get("username")]
-                )
-            except Exception as e:
-                self.logger.error(f"{e} Query:{qry}")
-            job_count = cursor.fetchone()[0]
-            if job_count >= int(self.system.get("user_job_quota")):
+            if admission.get("user_jobs", 0) >= int(self.system.get("user_job_quota")):
                 return USER_QUOTA_EXCEEDED
 
-    def _get_status(self, params={}, fingerprint=None):
+    def _get_status(self, params={}, admission={}):
         if params.get("mark_started"):
             return
-        duplicate_job = self._get_duplicate_job_id(
-            fingerprint, params.get("username", ""), params.get("ip_address", "")
-        )
-        quota_exceeded = self._is_quota_exceeded(params)
+        if admission is None:
+            return (
+                "rejected - the job queue could not be checked. Please try again "
+                "later."
+            )
+        duplicate_job = admission.get("duplicate_job")
+        quota_exceeded = self._is_quota_exceeded(params, admission)
         if duplicate_job:
             status = f"rejected - duplicate job ({duplicate_job})"
         elif quota_exceeded:
@@ -211,12 +295,6 @@ class JobManager(BaseApplication):
         if bigsdb.utils.is_integer(params.get("priority")):
             priority += params.get("priority")
 
-        # If IP address already has jobs queued, i.e. not started, then lower the
-        # priority on any new jobs from them. This will prevent a single user from
-        # flooding the queue and preventing other user jobs from running.
-
-        if self._has_ip_address_got_queued_jobs(params.get("ip_address")):
-            priority += 2
         job_id = params.get("job_id") or bigsdb.utils.get_random()
 
         fingerprint_params = params.get("parameters", {}).copy()
@@ -254,7 +332,38 @@ class JobManager(BaseApplication):
                 self._dict_to_string_sorted(params.get("parameters", {})),
             ]
         )
-        status = self._get_status(params, fingerprint)
+        admission = self._check_admission(params, fingerprint)
+
+        # If IP address already has jobs queued, i.e. not started, then lower the
+        # priority on any new jobs from them. This will prevent a single user from
+        # flooding the queue and preventing other user jobs from running.
+        # Fair-share scheduling already does this for each job queued ahead,
+        # so this is only needed if it has been disabled.
+        if (
+            admission
+            and admission.get("ip_address_queued")
+            and not self._is_fair_share_enabled()
+        ):
+            priority += 2
+        status = self._get_status(params, admission)
+
+        # A job can be satisfied by the output of an identical job that has
+        # recently finished, on the same data, if the plugin allows it
+        # (result_cache_ttl). The data fingerprint is kept out of the job
+        # fingerprint so that duplicates are still rejected while the data
+        # are being changed.
+        cached_output = None
+        data_fingerprint = None
+        if params.get("result_cache_ttl"):
+            data_fingerprint = params.get("data_fingerprint")
+        if status == "submitted" and data_fingerprint:
+            cached_output = self._reuse_cached_output(
+                job_id,
+                fingerprint,
+                data_fingerprint,
+                params.get("dbase_config"),
+                params["result_cache_ttl"],
+            )
         cursor = self.db.cursor()
         qry = (
             "INSERT INTO jobs (id,dbase_config,username,email,ip_address,"
@@ -281,44 +390,264 @@ class JobManager(BaseApplication):
                 ],
             )
 
-            qry = "INSERT INTO params (job_id,key,value) VALUES (%s,%s,%s)"
+            # Each table is populated with a single COPY, however many rows.
+            qry = "COPY params"
             cgi_parameters = params.get("parameters", {})
+            param_rows = []
             for param in cgi_parameters.keys():
                 value = cgi_parameters.get(param)
                 if value != None and value != "":
                     if isinstance(value, list):
                         value = "||".join(value)
-                    cursor.execute(qry, [job_id, param, value])
-
-            # Use copy_from file-like-object to speed up populating isolates table.
-            isolates = params.get("isolates", [])
-            qry = None  # In case we get an exception
-            for batch_isolates in bigsdb.utils.batch(isolates, 100):
-                isolate_data = "\n".join(
-                    [f"{job_id}\t{isolate_id}" for isolate_id in batch_isolates]
-                )
-                data_io = io.StringIO(isolate_data)
-                cursor.copy_from(
-                    data_io, "isolates", columns=("job_id", "isolate_id"), sep="\t"
-                )
+                    param_rows.append([job_id, param, value])
+            if data_fingerprint:
+                param_rows.append([job_id, DATA_FINGERPRINT_PARAM, data_fingerprint])
+            self._copy_rows(cursor, "params", ("job_id", "key", "value"), param_rows)
+
+            qry = "COPY isolates"
+            self._copy_rows(
+                cursor,
+                "isolates",
+                ("job_id", "isolate_id"),
+                [[job_id, isolate_id] for isolate_id in params.get("isolates", [])],
+            )
+
+            qry = "COPY profiles"
+            self._copy_rows(
+                cursor,
+                "profiles",
+                ("job_id", "scheme_id", "profile_id"),
+                [
+                    [job_id, cgi_parameters.get("scheme_id"), profile_id]
+                    for profile_id in params.get("profiles", [])
+                ],
+            )
 
-            qry = "INSERT INTO profiles (job_id,scheme_id,profile_id) VALUES (%s,%s,%s)"
-            profiles = params.get("profiles", [])
-            for profile_id in profiles:
+            qry = "COPY loci"
+            self._copy_rows(
+                cursor,
+                "loci",
+                ("job_id", "locus"),
+                [[job_id, locus] for locus in params.get("loci", [])],
+            )
+            if cached_output is not None:
+                qry = "UPDATE jobs"
                 cursor.execute(
-                    qry, [job_id, cgi_parameters.get("scheme_id"), profile_id]
+                    "UPDATE jobs SET status=%s,start_time='now',stop_time='now',"
+                    "percent_complete=100,stage=%s WHERE id=%s",
+                    [
+                        "finished",
+                        f"Re-used output of job {cached_output['job_id']}",
+                        job_id,
+                    ],
                 )
-            qry = "INSERT INTO loci(job_id,locus) VALUES (%s,%s)"
-            loci = params.get("loci", [])
-            for locus in loci:
-                cursor.execute(qry, [job_id, locus])
+                qry = "COPY output"
+                self._copy_rows(
+                    cursor,
+                    "output",
+                    ("job_id", "filename", "description"),
+                    [
+                        [job_id, output["filename"], output["description"]]
+                        for output in cached_output["output"]
+                    ],
+                )
+            qry = None
+            self._notify(
+                cursor,
+                "submitted" if cached_output is None else "status",
+                job_id,
+                {
+                    "status": status if cached_output is None else "finished",
+                    "dbase_config": params.get("dbase_config"),
+                    "module": params.get("module"),
+                },
+            )
             self.db.commit()
         except Exception as e:
             self.logger.error(f"{e}; Query:{qry}")
             self.db.rollback()
+            if cached_output is not None:
+                self._remove_output_files(cached_output["output"])
 
         return job_id
 
+    # Returns the most recent finished job with the fingerprint that stopped
+    # within ttl seconds.
+    def _get_cached_job_id(self, fingerprint, data_fingerprint, dbase_config, ttl):
+        cursor = self.db.cursor()
+        qry = (
+            "SELECT id FROM jobs WHERE (fingerprint,dbase_config,status)="
+            "(%s,%s,'finished') AND stop_time>now()-%s*interval '1 second' AND "
+            "EXISTS(SELECT * FROM params WHERE (job_id,key,value)=(jobs.id,%s,%s)) "
+            "AND EXISTS(SELECT * FROM output WHERE job_id=jobs.id) ORDER BY "
+            "stop_time DESC LIMIT 1"
+        )
+        try:
+            cursor.execute(
+                qry,
+                [
+                    fingerprint,
+                    dbase_config,
+                    ttl,
+                    DATA_FINGERPRINT_PARAM,
+                    data_fingerprint,
+                ],
+            )
+        except Exception as e:
+            self.logger.error(f"{e} Query:{qry}")
+            self.db.rollback()
+            return
+        row = cursor.fetchone()
+        if row is None:
+            return
+        return row[0]
+
+    def get_job_output(self, job_id):
+        cursor = self.db.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        qry = (
+            "SELECT filename,description FROM output WHERE job_id=%s ORDER BY filename"
+        )
+        try:
+            cursor.execute(qry, [job_id])
+            return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            self.logger.error(f"{e} Query:{qry}")
+
+    # Output files of the cached job are hard linked (or copied if that is not
+    # possible) to names for the new job. Returns None if there is no usable
+    # cached job, e.g. because its files have since been deleted.
+    def _reuse_cached_output(
+        self, job_id, fingerprint, data_fingerprint, dbase_config, ttl
+    ):
+        cached_job_id = self._get_cached_job_id(
+            fingerprint, data_fingerprint, dbase_config, ttl
+        )
+        if cached_job_id is None:
+            return
+        output = []
+        try:
+            for cached_output in self.get_job_output(cached_job_id) or []:
+                filename = cached_output["filename"]
+                if filename.startswith(cached_job_id):
+                    new_filename = job_id + filename[len(cached_job_id) :]
+                else:
+                    new_filename = f"{job_id}_{filename}"
+                source = os.path.join(self.config["tmp_dir"], filename)
+                destination = os.path.join(self.config["tmp_dir"], new_filename)
+                try:
+                    os.link(source, destination)
+                except OSError:  # e.g. not supported by the file system.
+                    shutil.copyfile(source, destination)
+                output.append(
+                    {
+                        "filename": new_filename,
+                        "description": cached_output["description"],
+                    }
+                )
+        except Exception as e:
+            self.logger.info(f"Cannot re-use output of job {cached_job_id}: {e}")
+            self._remove_output_files(output)
+            return
+        if not output:
+            return
+        self.logger.info(f"Job {job_id} re-uses output of job {cached_job_id}.")
+        return {"job_id": cached_job_id, "output": output}
+
+    def _remove_output_files(self, output):
+        for output_file in output:
+            try:
+                os.remove(os.path.join(self.config["tmp_dir"], output_file["filename"]))
+            except OSError:
+                pass
+
+    # Jobs that ended more than job_archive_days ago are moved, with their rows
+    # in the per-job tables, to the archive tables (see sql/jobs_archive.sql)
+    # so that the jobs table only holds active and recent jobs. Jobs are moved
+    # in batches, each in its own transaction, so that submissions and status
+    # updates are not held up. With the purge option, jobs and their output
+    # files are deleted rather than archived. Returns the number of jobs
+    # moved. If a batch fails the error is raised, leaving the jobs moved by
+    # earlier batches archived.
+    def archive_jobs(self, options={}):
+        days = int(
+            options.get("days", self.config.get("job_archive_days", JOB_ARCHIVE_DAYS))
+        )
+        if days < 1:
+            raise ValueError("days must be at least 1.")
+        batch_size = int(
+            options.get(
+                "batch_size",
+                self.config.get("job_archive_batch_size", JOB_ARCHIVE_BATCH_SIZE),
+            )
+        )
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1.")
+        if self.db.closed:
+            self._db_connect()
+        total = 0
+        while True:
+            count = self._archive_job_batch(days, batch_size, options.get("purge"))
+            if not count:
+                break
+            total += count
+            self.logger.info(
+                f"{'Purged' if options.get('purge') else 'Archived'} {total} jobs."
+            )
+        return total
+
+    def _archive_job_batch(self, days, batch_size, purge=False):
+        cursor = self.db.cursor()
+        qry = (
+            "SELECT id FROM jobs WHERE status NOT IN ('submitted','started') AND "
+            "COALESCE(stop_time,submit_time)<now()-make_interval(days=>%s) ORDER BY "
+            "COALESCE(stop_time,submit_time) LIMIT %s FOR UPDATE SKIP LOCKED"
+        )
+        try:
+            cursor.execute(qry, [days, batch_size])
+            job_ids = [row[0] for row in cursor.fetchall()]
+            if not job_ids:
+                self.db.rollback()
+                return 0
+            output = []
+            for table in JOB_CHILD_TABLES + ("jobs",):
+                key = "id" if table == "jobs" else "job_id"
+                if purge:
+                    qry = sql.SQL("DELETE FROM {} WHERE {}=ANY(%s)").format(
+                        sql.Identifier(table), sql.Identifier(key)
+                    )
+                    if table == "output":
+                        qry += sql.SQL(" RETURNING filename")
+                else:
+                    qry = sql.SQL(
+                        "WITH moved AS (DELETE FROM {} WHERE {}=ANY(%s) RETURNING *) "
+                        "INSERT INTO {} SELECT * FROM moved"
+                    ).format(
+                        sql.Identifier(table),
+                        sql.Identifier(key),
+                        sql.Identifier(f"archived_{table}"),
+                    )
+                cursor.execute(qry, [job_ids])
+                if purge and table == "output":
+                    output = [{"filename": row[0]} for row in cursor.fetchall()]
+            self.db.commit()
+        except Exception as e:
+            self.logger.error(f"{e} Query:{qry}")
+            self.db.rollback()
+            raise
+        if output:
+            self._remove_output_files(output)
+        return len(job_ids)
+
+    def _copy_rows(self, cursor, table, columns, rows):
+        if not rows:
+            return
+        data = io.StringIO()
+        for row in rows:
+            data.write("\t".join(bigsdb.utils.escape_copy_value(v) for v in row))
+            data.write("\n")
+        data.seek(0)
+        cursor.copy_from(data, table, columns=columns, sep="\t")
+
     def get_job(self, job_id):
         qry = (
             "SELECT *,extract(epoch FROM now() - start_time) AS elapsed,"
@@ -386,21 +715,23 @@ class JobManager(BaseApplication):
         if output_dict.get("description") == None:
             raise ValueError("description not passed.")
         if self.db.closed:
-            self._db_connect({"reconnect": True})
+            self._db_connect()
         if output_dict.get("compress"):
             full_path = os.path.join(self.config["tmp_dir"], output_dict["filename"])
+            gzipped_path = f"{full_path}.gz"
+
+            # A gzipped copy may already have been written alongside the
+            # original (see ParallelGzipWriter), in which case it is only kept
+            # if the original is large enough to be worth compressing.
+            precompressed = output_dict.get("precompressed") and os.path.exists(
+                gzipped_path
+            )
             if os.path.getsize(full_path) > (10 * 1024 * 1024):  # >10 MB
-                gzipped_path = f"{full_path}.gz"
-                if output_dict.get("keep_original"):
-                    with open(full_path, "rb") as f_in, gzip.open(
-                        gzipped_path, "wb"
-                    ) as f_out:
-                        shutil.copyfileobj(f_in, f_out)
-                else:
-                    with open(full_path, "rb") as f_in, gzip.open(
-                        gzipped_path, "wb"
-                    ) as f_out:
-                        shutil.copyfileobj(f_in, f_out)
+                if not precompressed:
+                    bigsdb.parallel_gzip.gzip_file(
+                        full_path, gzipped_path, self.get_gzip_options()
+                    )
+                if not output_dict.get("keep_original"):
                     os.remove(full_path)
 
                 if not os.path.exists(gzipped_path):
@@ -408,6 +739,8 @@ class JobManager(BaseApplication):
                 else:
                     output_dict["filename"] += ".gz"
                     output_dict["description"] += " [gzipped file]"
+            elif precompressed:
+                os.remove(gzipped_path)
         cursor = self.db.cursor()
         qry = "INSERT INTO output (job_id,filename,description) VALUES (%s,%s,%s)"
         try:
@@ -415,15 +748,32 @@ class JobManager(BaseApplication):
                 qry, [job_id, output_dict["filename"], output_dict["description"]]
             )
             self.db.commit()
-        except:
+        except Exception as e:
             self.logger.error(f"{e} Query:{qry}")
             self.db.rollback()
 
+    def get_gzip_options(self):
+        options = {}
+        if self.config.get("gzip_threads"):
+            options["threads"] = int(self.config["gzip_threads"])
+        if self.config.get("gzip_level"):
+            options["level"] = int(self.config["gzip_level"])
+        return options
+
     def update_job_status(self, job_id, status_dict={}):
+        self._write_job_status(job_id, status_dict)
+
+        # Nothing left to cancel once the job has ended.
+        if status_dict.get("status") in ("failed", "cancelled", "finished"):
+            self.last_cancel_check.pop(job_id, None)
+            if self.listener is not None:
+                self.listener.cancelled.discard(job_id)
+            return
+        self.check_cancelled(job_id)
+
+    def _write_job_status(self, job_id, status_dict):
         if self.db.closed:
-            self._db_connect({"reconnect": True})
-        if self.db.closed:
-            self._db_connect(reconnect=True)
+            self._db_connect()
 
         keys = sorted(status_dict.keys())
         values = [status_dict[key] for key in keys]
@@ -435,15 +785,361 @@ class JobManager(BaseApplication):
 
         try:
             cursor.execute(qry, values + [job_id])
+            if "status" in status_dict:
+                self._notify(
+                    cursor, "status", job_id, {"status": status_dict["status"]}
+                )
             self.db.commit()
         except Exception as e:
             self.logger.error(f"{e} Query:{qry}")
             self.db.rollback()
 
-        if status_dict.get("status") == "failed":
-            return
-
-        job = self.get_job_status(job_id)
-        if job.get("status", "") == "cancelled" or job.get("cancel"):
+    def check_cancelled(self, job_id):
+        if self.is_job_cancelled(job_id):
+            if self.raise_on_cancel:
+                raise JobCancelledError(f"Job {job_id} has been cancelled.")
+            job = self.get_job_status(job_id)
             if job.get("pid"):
                 os.kill(job.get("pid"), signal.SIGTERM)
+
+    # Returns a ProgressReporter for plugins that report progress frequently,
+    # e.g. from within a per-record loop.
+    def get_progress_reporter(self, job_id, options={}):
+        return ProgressReporter(self, job_id, options)
+
+    # If the job manager has a listener (see listen), cancellation is picked
+    # up from notifications without querying the jobs table. Setting
+    # jobs.cancel sends a notification from a trigger (see
+    # sql/jobs_notify.sql) whichever client makes the change. The table is
+    # also checked on the first call for a job, and then at most every
+    # CANCEL_CHECK_INTERVAL seconds in case a notification has been missed,
+    # e.g. if the listening connection was lost. Notifications for other jobs
+    # are ignored, as those jobs are checked in the table when they start.
+    # Without a listener the table is checked every CANCEL_POLL_INTERVAL
+    # seconds.
+    def is_job_cancelled(self, job_id):
+        listener = self.listener
+        if listener is not None and listener.db.closed:
+            listener = None
+        if listener is not None:
+            try:
+                for event in listener.poll():
+                    if event.get("job_id") != job_id:
+                        continue
+                    if (
+                        event.get("event") == "cancel"
+                        or event.get("status") == "cancelled"
+                    ):
+                        listener.cancelled.add(job_id)
+                if job_id in listener.cancelled:
+                    return True
+            except Exception as e:
+                self.logger.error(f"Cannot check job notifications: {e}")
+                listener = None
+        if listener is not None:
+            interval = self.config.get(
+                "job_cancel_check_interval", CANCEL_CHECK_INTERVAL
+            )
+        else:
+            interval = self.config.get("job_cancel_poll_interval", CANCEL_POLL_INTERVAL)
+        if time.monotonic() - self.last_cancel_check.get(job_id, 0) < float(interval):
+            return False
+        self.last_cancel_check[job_id] = time.monotonic()
+        job = self.get_job_status(job_id)
+        return job.get("status", "") == "cancelled" or bool(job.get("cancel"))
+
+    # Atomically claim the next job chosen by the fair-share scheduler.
+    def claim_next_job(self, modules=None):
+        return self.get_scheduler().claim_next_job(modules)
+
+    def get_queue_metrics(self):
+        return self.get_scheduler().get_queue_metrics()
+
+    def _is_fair_share_enabled(self):
+        return float(self.config.get("job_fair_share_weight", FAIR_SHARE_WEIGHT)) > 0
+
+    def get_scheduler(self):
+        if self.scheduler is None:
+            self.scheduler = JobScheduler(self)
+        return self.scheduler
+
+
+# Chooses the next job to run by weighted fair queueing over job owners (the
+# username, or IP address for jobs submitted without logging in). A job's
+# effective priority is its priority plus a penalty for each job that its
+# owner already has running or queued ahead of it, less a credit for the time
+# it has waited, so that a user with many queued jobs cannot starve others
+# and no job waits indefinitely. Optionally the number of running jobs per
+# owner (job_max_running_per_user) and per database
+# (job_max_running_per_dbase) is capped.
+class JobScheduler(object):
+    def __init__(self, job_manager, options={}):
+        config = job_manager.config
+        self.job_manager = job_manager
+        self.logger = job_manager.logger
+        self.fair_share_weight = float(
+            options.get(
+                "fair_share_weight",
+                config.get("job_fair_share_weight", FAIR_SHARE_WEIGHT),
+            )
+        )
+        self.aging_interval = float(
+            options.get(
+                "aging_interval", config.get("job_aging_interval", JOB_AGING_INTERVAL)
+            )
+        )
+        self.max_running_per_user = options.get(
+            "max_running_per_user", config.get("job_max_running_per_user")
+        )
+        self.max_running_per_dbase = options.get(
+            "max_running_per_dbase", config.get("job_max_running_per_dbase")
+        )
+
+    def _get_claim_query(self, modules):
+        conditions = []
+        if self.max_running_per_user:
+            conditions.append("COALESCE(o.running,0)<%(max_running_per_user)s")
+        if self.max_running_per_dbase:
+            conditions.append("COALESCE(d.running,0)<%(max_running_per_dbase)s")
+        module_clause = "AND module=ANY(%(modules)s) " if modules is not None else ""
+        where_clause = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        return (
+            "WITH running AS (SELECT COALESCE(NULLIF(username,''),ip_address) AS "
+            "owner,dbase_config FROM jobs WHERE status='started'),owner_running AS "
+            "(SELECT owner,COUNT(*) AS running FROM running GROUP BY owner),"
+            "dbase_running AS (SELECT dbase_config,COUNT(*) AS running FROM running "
+            "GROUP BY dbase_config),queued AS (SELECT id,dbase_config,priority,"
+            "submit_time,COALESCE(NULLIF(username,''),ip_address) AS owner,"
+            "ROW_NUMBER() OVER (PARTITION BY COALESCE(NULLIF(username,''),"
+            "ip_address) ORDER BY priority,submit_time)-1 AS ahead FROM jobs WHERE "
+            "status='submitted' AND NOT COALESCE(cancel,FALSE) "
+            f"{module_clause}),ranked AS (SELECT q.id,q.priority+%(weight)s*"
+            "(q.ahead+COALESCE(o.running,0))-EXTRACT(EPOCH FROM now()-q.submit_time)"
+            "/%(aging_interval)s AS score FROM queued q LEFT JOIN owner_running o ON "
+            "q.owner=o.owner LEFT JOIN dbase_running d ON q.dbase_config="
+            f"d.dbase_config{where_clause}) UPDATE jobs SET "
+            "status='started',start_time='now',pid=%(pid)s WHERE id=(SELECT j.id "
+            "FROM jobs j JOIN ranked r ON j.id=r.id WHERE j.status='submitted' "
+            "ORDER BY r.score,j.submit_time LIMIT 1 FOR UPDATE OF j SKIP LOCKED) "
+            "RETURNING id,dbase_config,module,username,email"
+        )
+
+    def claim_next_job(self, modules=None):
+        db = self.job_manager.db
+        if db.closed:
+            self.job_manager._db_connect()
+            db = self.job_manager.db
+        qry = self._get_claim_query(modules)
+        values = {
+            "pid": os.getpid(),
+            "modules": list(modules) if modules is not None else None,
+            "weight": self.fair_share_weight,
+            "aging_interval": self.aging_interval,
+            "max_running_per_user": self.max_running_per_user,
+            "max_running_per_dbase": self.max_running_per_dbase,
+        }
+        cursor = db.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        try:
+            # Running job counts are only exact if claims are made one at a
+            # time, so workers take it in turns when caps are set.
+            if self.max_running_per_user or self.max_running_per_dbase:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", [SCHEDULER_LOCK_ID])
+            cursor.execute(qry, values)
+            row = cursor.fetchone()
+            db.commit()
+        except Exception as e:
+            self.logger.error(f"{e} Query:{qry}")
+            db.rollback()
+            return
+        if row is not None:
+            return dict(row)
+
+    # Returns queue depth and wait times (in seconds), overall and for each
+    # database.
+    def get_queue_metrics(self):
+        db = self.job_manager.db
+        if db.closed:
+            self.job_manager._db_connect()
+            db = self.job_manager.db
+        cursor = db.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        qry = (
+            "SELECT dbase_config,COUNT(*) FILTER (WHERE status='submitted') AS "
+            "queued,COUNT(*) FILTER (WHERE status='started') AS running,"
+            "COUNT(DISTINCT COALESCE(NULLIF(username,''),ip_address)) FILTER "
+            "(WHERE status='submitted') AS queued_owners,EXTRACT(EPOCH FROM "
+            "MAX(now()-submit_time) FILTER (WHERE status='submitted'))::float AS "
+            "longest_wait FROM jobs WHERE status IN ('submitted','started') GROUP "
+            "BY dbase_config ORDER BY dbase_config"
+        )
+        recent_qry = (
+            "SELECT COUNT(*) AS started,EXTRACT(EPOCH FROM AVG(start_time-"
+            "submit_time))::float AS mean_wait,EXTRACT(EPOCH FROM percentile_cont"
+            "(0.95) WITHIN GROUP (ORDER BY start_time-submit_time))::float AS "
+            "p95_wait FROM jobs "
+            "WHERE start_time>now()-%s*interval '1 second' AND submit_time IS NOT "
+            "NULL"
+        )
+        try:
+            cursor.execute(qry)
+            dbases = {row["dbase_config"]: dict(row) for row in cursor.fetchall()}
+            qry = recent_qry
+            cursor.execute(qry, [RECENT_JOBS_PERIOD])
+            recent = dict(cursor.fetchone())
+            db.commit()
+        except Exception as e:
+            self.logger.error(f"{e} Query:{qry}")
+            db.rollback()
+            return
+        for values in dbases.values():
+            del values["dbase_config"]
+        waits = [
+            values["longest_wait"]
+            for values in dbases.values()
+            if values["longest_wait"] is not None
+        ]
+        return {
+            "queued": sum(values["queued"] for values in dbases.values()),
+            "running": sum(values["running"] for values in dbases.values()),
+            "longest_wait": max(waits) if waits else None,
+            "recent_started": recent["started"],
+            "recent_mean_wait": recent["mean_wait"],
+            "recent_p95_wait": recent["p95_wait"],
+            "dbases": dbases,
+        }
+
+
+# Coalesces job status updates in memory so that they can be made as often as
+# convenient without each one costing a write to the jobs database. Pending
+# changes are written once the progress has moved on by at least 'step'
+# percent or 'interval' seconds have passed since the last write. Stage
+# changes and completion are always written immediately. Cancellation is
+# checked every 'cancel_check_interval' seconds.
+class ProgressReporter(object):
+    def __init__(self, job_manager, job_id, options={}):
+        config = job_manager.config
+        self.job_manager = job_manager
+        self.job_id = job_id
+        self.interval = float(
+            options.get(
+                "interval", config.get("job_progress_interval", PROGRESS_INTERVAL)
+            )
+        )
+        self.step = float(
+            options.get("step", config.get("job_progress_step", PROGRESS_STEP))
+        )
+        self.cancel_check_interval = float(
+            options.get("cancel_check_interval", self.interval)
+        )
+        self.pending = {}
+        self.written = {}
+        self.last_write = time.monotonic()
+        self.last_cancel_check = self.last_write
+
+    def update(self, status_dict):
+        for key, value in status_dict.items():
+            if self.written.get(key) != value or key in self.pending:
+                self.pending[key] = value
+        now = time.monotonic()
+        if now - self.last_cancel_check >= self.cancel_check_interval:
+            self.last_cancel_check = now
+            self.job_manager.check_cancelled(self.job_id)
+        if not self.pending:
+            return
+        if (
+            "stage" in self.pending
+            or self.pending.get("status") in ("failed", "cancelled", "finished")
+            or (self.pending.get("percent_complete") or 0) >= 100
+            or now - self.last_write >= self.interval
+            or (self.pending.get("percent_complete") or 0)
+            - (self.written.get("percent_complete") or 0)
+            >= self.step
+        ):
+            self.flush()
+
+    def set_progress(self, percent_complete):
+        self.update({"percent_complete": percent_complete})
+
+    def flush(self):
+        self.last_write = time.monotonic()
+        if not self.pending:
+            return
+        status_dict = self.pending
+        self.pending = {}
+        self.written.update(status_dict)
+        self.job_manager._write_job_status(self.job_id, status_dict)
+
+    # Write any pending changes along with the final status values.
+    def finish(self, status_dict={}):
+        self.pending.update(status_dict)
+        self.flush()
+
+
+# Receives notifications sent on the jobs channel, e.g. when a job is
+# submitted, changes status or is cancelled. Callbacks can be subscribed for
+# all events or filtered by event type and/or job id. Each event is a dict
+# containing at least 'event' and 'job_id' keys.
+class JobListener(object):
+    def __init__(self, db, channel=JOBS_CHANNEL, logger=None):
+        self.db = db
+        self.channel = channel
+        self.logger = logger
+        self.subscriptions = []
+        self.cancelled = set()
+        self.db.set_session(autocommit=True)
+        cursor = self.db.cursor()
+        cursor.execute(sql.SQL("LISTEN {}").format(sql.Identifier(channel)))
+
+    def subscribe(self, callback, events=None, job_id=None):
+        self.subscriptions.append(
+            {"callback": callback, "events": events, "job_id": job_id}
+        )
+
+    # Return (and dispatch to subscribers) any notifications that have
+    # arrived, without blocking.
+    def poll(self):
+        self.db.poll()
+        events = []
+        while self.db.notifies:
+            notify = self.db.notifies.pop(0)
+            try:
+                event = json.loads(notify.payload)
+            except ValueError:
+                if self.logger:
+                    self.logger.error(f"Invalid job notification: {notify.payload}")
+                continue
+            events.append(event)
+            self._dispatch(event)
+        return events
+
+    # Block until a notification arrives or timeout (seconds) expires.
+    def wait(self, timeout=None):
+        events = self.poll()
+        if events:
+            return events
+        if select.select([self.db], [], [], timeout) == ([], [], []):
+            return []
+        return self.poll()
+
+    def _dispatch(self, event):
+        for subscription in self.subscriptions:
+            if (
+                subscription["events"]
+                and event.get("event") not in subscription["events"]
+            ):
+                continue
+            if (
+                subscription["job_id"] is not None
+                and event.get("job_id") != subscription["job_id"]
+            ):
+                continue
+            try:
+                subscription["callback"](event)
+            except Exception as e:
+                if self.logger:
+                    self.logger.error(f"Job notification callback failed: {e}")
+
+    def close(self):
+        try:
+            self.db.close()
+        except Exception:
+            pass
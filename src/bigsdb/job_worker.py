@@ -0,0 +1,235 @@
+# Written by Keith Jolley
+# Copyright (c) 2024, University of Oxford
+# E-mail: keith.jolley@biology.ox.ac.uk
+#
+# This file is part of BIGSdb Python Toolkit.
+#
+# BIGSdb Python Toolkit is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BIGSdb Python Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BIGSdb Python Toolkit. If not,
+# see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import signal
+import logging
+import importlib
+from bigsdb.base_application import BaseApplication
+from bigsdb.data_connector import DataConnector
+from bigsdb.job_manager import JobManager, JobCancelledError
+from bigsdb.constants import DIRS, LOGS
+
+# Seconds to wait before checking an empty queue again if no notification of a
+# new job has been received.
+POLL_INTERVAL = 5
+
+
+# Long-running process that claims jobs from the queue and runs them
+# back-to-back. Plugin objects (and with them the parsed configuration,
+# database connections and caches) are kept for each plugin/database
+# combination so that subsequent jobs do not pay the start-up cost. Unless
+# disabled with the pooled_connections option, connections are leased from
+# pools for each job and returned at the end of it, so that idle plugins don't
+# hold connections open and broken connections are replaced before a job.
+class JobWorker(BaseApplication):
+    def __init__(
+        self,
+        module_dir=None,
+        config_dir=DIRS["CONFIG_DIR"],
+        dbase_config_dir=DIRS["DBASE_CONFIG_DIR"],
+        logger=None,
+        log_file=None,
+        options={},
+    ):
+        self.check_required_parameters(module_dir=module_dir)
+        self._init_logger(logger=logger, log_file=log_file)
+        super(JobWorker, self).__init__(
+            config_dir=config_dir,
+            dbase_config_dir=dbase_config_dir,
+            logger=self.logger,
+            testing=True,
+        )
+        self._read_db_config_file()
+        self._read_host_mapping_file()
+        self.module_dir = module_dir
+        self.options = options
+        self.system = {}
+        self.pooled = options.get("pooled_connections", True)
+        self.data_connector = DataConnector(
+            system=self.system,
+            config=self.config,
+            logger=self.logger,
+            pooled=self.pooled,
+        )
+        self.job_manager = JobManager(
+            data_connector=self.data_connector,
+            system=self.system,
+            config=self.config,
+            logger=self.logger,
+        )
+        if module_dir not in sys.path:
+            sys.path.insert(0, module_dir)
+        self.modules = self._get_plugin_modules()
+        self.plugins = {}
+        self.jobs_run = 0
+        self.stopping = False
+
+    def _init_logger(self, logger=None, log_file=None):
+        if logger:
+            self.logger = logger
+            return
+        self.logger = logging.getLogger(__name__)
+        f_handler = logging.FileHandler(log_file or LOGS["JOBS_LOG"])
+        f_handler.setLevel(logging.INFO)
+        f_format = logging.Formatter(
+            "%(asctime)s - %(levelname)s: - %(module)s:%(lineno)d - %(message)s"
+        )
+        f_handler.setFormatter(f_format)
+        self.logger.addHandler(f_handler)
+
+    def _get_plugin_modules(self):
+        return sorted(
+            f[:-3]
+            for f in os.listdir(self.module_dir)
+            if f.endswith(".py") and not f.startswith("_")
+        )
+
+    # Finish the current job and then exit.
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        max_jobs = self.options.get("max_jobs")
+        poll_interval = self.options.get("poll_interval", POLL_INTERVAL)
+        try:
+            self._run(max_jobs, poll_interval)
+        finally:
+            self.job_manager.close_listener()
+
+    def _run(self, max_jobs, poll_interval):
+        while not self.stopping:
+            if self.pooled:
+                self.job_manager._db_connect()
+            job = self.job_manager.claim_next_job(self.modules)
+            if job is None:
+                self.data_connector.release_connections()
+                self._wait(poll_interval)
+                continue
+            self.run_job(job)
+            if max_jobs and self.jobs_run >= max_jobs:
+                break
+
+    # Sleep until a job is submitted (signalled by a notification), the poll
+    # interval expires or the worker is asked to stop.
+    def _wait(self, seconds):
+        end = time.monotonic() + seconds
+        while not self.stopping:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                events = self.job_manager.listen().wait(min(1, remaining))
+            except Exception as e:
+                self.logger.error(f"Cannot listen for job notifications: {e}")
+                time.sleep(min(1, remaining))
+                continue
+            if any(event.get("event") == "submitted" for event in events):
+                return
+
+    def run_job(self, job):
+        job_id = job["id"]
+        self.logger.info(f"Running job {job_id} ({job['module']}).")
+        self.jobs_run += 1
+        plugin = None
+        try:
+            plugin = self._get_plugin(job["module"], job["dbase_config"], job_id)
+            plugin.run_job(job_id=job_id)
+        except JobCancelledError:
+            self.logger.info(f"Job {job_id} cancelled.")
+
+            # The job may have been stopped part-way through a transaction.
+            self._discard_plugin(job["module"], job["dbase_config"])
+            self.job_manager.update_job_status(
+                job_id, {"status": "cancelled", "stop_time": "now"}
+            )
+            return
+        except Exception as e:
+            self.logger.exception(f"Job {job_id} failed: {e}")
+            self._discard_plugin(job["module"], job["dbase_config"])
+            self.job_manager.update_job_status(
+                job_id, {"status": "failed", "stop_time": "now"}
+            )
+            return
+        else:
+            self.job_manager.update_job_status(
+                job_id,
+                {"status": "finished", "stop_time": "now", "percent_complete": 100},
+            )
+        finally:
+            self._finish_query_profile(plugin)
+            self._release_connections(plugin)
+
+    def _release_connections(self, plugin):
+        try:
+            if plugin is not None:
+                plugin.data_connector.release_connections()
+            self.data_connector.release_connections()
+        except Exception as e:
+            self.logger.error(f"Error releasing connections: {e}")
+
+    # Each job has its own query profile.
+    def _finish_query_profile(self, plugin):
+        if plugin is not None and plugin.data_connector.profiler:
+            plugin.data_connector.profiler.finish()
+
+    def _get_plugin(self, module_name, database, job_id):
+        key = f"{module_name}|{database}"
+        if key in self.plugins:
+            plugin = self.plugins[key]
+            plugin.initiate_job(job_id)
+        else:
+            module = importlib.import_module(module_name)
+            plugin = getattr(module, module_name)(
+                database=database,
+                config_dir=self.config_dir,
+                dbase_config_dir=self.dbase_config_dir,
+                logger=self.logger,
+                run_job=job_id,
+                options={"pooled_connections": self.pooled},
+            )
+            self.plugins[key] = plugin
+        plugin.job_manager.raise_on_cancel = True
+
+        # Plugins share the worker's listener for cancellation notifications
+        # rather than each opening a connection.
+        plugin.job_manager.listener = self._get_listener()
+        return plugin
+
+    def _get_listener(self):
+        try:
+            return self.job_manager.listen()
+        except Exception as e:
+            self.logger.error(f"Cannot listen for job notifications: {e}")
+
+    # A plugin that has failed may have left its connections in an unknown
+    # state, so start afresh for the next job.
+    def _discard_plugin(self, module_name, database):
+        plugin = self.plugins.pop(f"{module_name}|{database}", None)
+        if plugin is not None:
+            plugin.job_manager.listener = None  # Shared, so not closed.
+            try:
+                plugin.data_connector.drop_all_connections()
+            except Exception as e:
+                self.logger.error(f"Error closing plugin connections: {e}")
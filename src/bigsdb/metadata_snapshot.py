@@ -0,0 +1,154 @@
+# Written by Keith Jolley
+# Copyright (c) 2024, University of Oxford
+# E-mail: keith.jolley@biology.ox.ac.uk
+#
+# This file is part of BIGSdb Python Toolkit.
+#
+# BIGSdb Python Toolkit is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BIGSdb Python Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BIGSdb Python Toolkit. If not,
+# see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+import logging
+import atexit
+import pickle
+
+# Seconds between checks of whether the metadata tables have changed.
+FINGERPRINT_CHECK_INTERVAL = 60
+
+# The snapshot to save for each file when the process exits. Only the most
+# recently created snapshot for a file is kept; any earlier one is saved when
+# it is replaced.
+exit_snapshots = {}
+
+
+def save_exit_snapshots():
+    for snapshot in exit_snapshots.values():
+        snapshot.save()
+
+
+atexit.register(save_exit_snapshots)
+
+
+# Results of metadata queries (loci, schemes, scheme members and fields etc.)
+# shared between processes via a pickled file per database. The snapshot is
+# keyed by a fingerprint of the underlying tables and is discarded if they
+# change. Results obtained by a process that were not already in the snapshot
+# are written back when the process exits (or save() is called) so that
+# subsequent processes start with them already loaded.
+#
+# As the file is unpickled, it is only read or written if its directory is
+# owned by the user running the process and is not accessible to anyone else
+# (the directory is created like this if it doesn't exist).
+class MetadataSnapshot:
+    def __init__(self, filename=None, get_fingerprint=None, logger=None, options={}):
+        self.filename = filename
+        self.get_fingerprint = get_fingerprint
+        if logger is None:
+            self.logger = logging.getLogger(__name__)
+            self.logger.addHandler(logging.NullHandler())
+        else:
+            self.logger = logger
+        self.check_interval = options.get("check_interval", FINGERPRINT_CHECK_INTERVAL)
+        self.fingerprint = None
+        self.entries = {}
+        self.dirty = False
+        self.last_check = None
+        previous = exit_snapshots.get(filename)
+        if previous is not None:
+            previous.save()
+        exit_snapshots[filename] = self
+
+    def _is_cache_dir_private(self):
+        try:
+            stat = os.stat(os.path.dirname(self.filename))
+        except OSError:
+            return False
+        return stat.st_uid == os.getuid() and not stat.st_mode & 0o077
+
+    def refresh(self):
+        now = time.monotonic()
+        if self.last_check is not None and now - self.last_check < self.check_interval:
+            return
+        self.last_check = now
+        fingerprint = self.get_fingerprint()
+        if fingerprint == self.fingerprint:
+            return
+        self.fingerprint = fingerprint
+        self.entries = {}
+        self.dirty = False
+        self._load()
+
+    def _load(self):
+        if not self._is_cache_dir_private():
+            return
+        try:
+            with open(self.filename, "rb") as f:
+                snapshot = pickle.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            self.logger.error(f"Cannot read metadata snapshot {self.filename}: {e}")
+            return
+        if snapshot.get("fingerprint") == self.fingerprint:
+            self.entries = snapshot.get("entries", {})
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        return self.entries[key]
+
+    # None is not stored, as it may be the result of a failed query. Nothing
+    # is stored if the fingerprint could not be determined.
+    def __setitem__(self, key, value):
+        if value is None or self.fingerprint is None:
+            return
+        self.entries[key] = value
+        self.dirty = True
+
+    # Entries added by other processes since this snapshot was loaded are
+    # merged in, as long as they were made against the same fingerprint.
+    def save(self):
+        if not self.dirty or self.fingerprint is None:
+            return
+        entries = dict(self.entries)
+        try:
+            os.makedirs(os.path.dirname(self.filename), mode=0o700, exist_ok=True)
+            if not self._is_cache_dir_private():
+                self.logger.error(
+                    f"Metadata snapshot directory {os.path.dirname(self.filename)} "
+                    "is not private - snapshot not saved."
+                )
+                self.dirty = False
+                return
+            try:
+                with open(self.filename, "rb") as f:
+                    snapshot = pickle.load(f)
+                if snapshot.get("fingerprint") == self.fingerprint:
+                    entries = {**snapshot.get("entries", {}), **entries}
+            except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+                pass
+            tmp_file = f"{self.filename}.{os.getpid()}.tmp"
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(
+                    {"fingerprint": self.fingerprint, "entries": entries},
+                    f,
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+            os.replace(tmp_file, self.filename)
+            self.dirty = False
+        except Exception as e:
+            self.logger.error(f"Cannot write metadata snapshot {self.filename}: {e}")
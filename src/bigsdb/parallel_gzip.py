@@ -0,0 +1,99 @@
+# Written by Keith Jolley
+# Copyright (c) 2024, University of Oxford
+# E-mail: keith.jolley@biology.ox.ac.uk
+#
+# This file is part of BIGSdb Python Toolkit.
+#
+# BIGSdb Python Toolkit is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BIGSdb Python Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BIGSdb Python Toolkit. If not,
+# see <https://www.gnu.org/licenses/>.
+
+import os
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+BLOCK_SIZE = 1024 * 1024  # Uncompressed bytes per gzip member.
+DEFAULT_LEVEL = 6
+
+
+# Compresses data written to it in parallel, pigz-style. The input is split
+# into blocks that are each compressed as a separate gzip member by a pool of
+# threads (zlib releases the GIL while compressing). Members are written to
+# the output in order, so the result is a standard multi-member gzip file
+# that can be read by gzip/gunzip or Python's gzip module.
+#
+# Data can be written as it is produced, e.g. while an export is still
+# running, so that little compression work remains once it has finished.
+class ParallelGzipWriter:
+    def __init__(self, filename, options={}):
+        self.level = options.get("level", DEFAULT_LEVEL)
+        self.threads = options.get("threads") or os.cpu_count() or 1
+        self.block_size = options.get("block_size", BLOCK_SIZE)
+        self.fh = open(filename, "wb")
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.closed = False
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[: self.block_size])
+            del self.buffer[: self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def _submit(self, block):
+        self.pending.append(self.executor.submit(compress_block, block, self.level))
+
+        # Limit the number of blocks held in memory.
+        while len(self.pending) > 2 * self.threads:
+            self.fh.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self.fh.write(self.pending.popleft().result())
+        finally:
+            self.executor.shutdown()
+            self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def compress_block(block, level=DEFAULT_LEVEL):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31 = gzip wrapper.
+    return compressor.compress(block) + compressor.flush()
+
+
+def gzip_file(in_path, out_path, options={}):
+    block_size = options.get("block_size", BLOCK_SIZE)
+    with open(in_path, "rb") as f_in, ParallelGzipWriter(out_path, options) as f_out:
+        while True:
+            block = f_in.read(block_size)
+            if not block:
+                break
+            f_out.write(block)
@@ -25,6 +25,7 @@ import re
 from collections import defaultdict
 import bigsdb.utils
 from bigsdb.base_application import BaseApplication
+from bigsdb.data_connector import DataConnector
 from bigsdb.job_manager import JobManager
 from bigsdb.prefstore import Prefstore
 from bigsdb.scheme_selector import SchemeSelector
@@ -44,6 +45,7 @@ class Plugin(BaseApplication):
         logger=None,
         log_file=None,
         run_job=None,
+        options={},
     ):
         if not retrieving_attributes:
             if arg_file and database == None:
@@ -55,6 +57,7 @@ class Plugin(BaseApplication):
             dbase_config_dir=dbase_config_dir,
             logger=self.logger,
             testing=retrieving_attributes,
+            options=options,
         )
         if arg_file != None:
             self._read_arg_file(arg_file)
@@ -105,15 +108,20 @@ class Plugin(BaseApplication):
         self.logger.addHandler(f_handler)
 
     def _initiate(self):
+        if self.data_connector.profiler:
+            self.data_connector.profiler.set_run_name(
+                f"{self.instance}_{type(self).__name__}"
+            )
         self.params = self.args.get("cgi_params")
         self.script_name = os.environ.get("SCRIPT_NAME", "") or "bigsdb.pl"
         self.username = self.args.get("username", "")
         self.email = self.args.get("email", "")
-        self.datastore.initiate_view(
-            username=self.args.get("username"),
-            curate=self.args.get("curate", False),
-            set_id=self.get_set_id(),
-        )
+        self.view_args = {
+            "username": self.args.get("username"),
+            "curate": self.args.get("curate", False),
+            "set_id": self.get_set_id(),
+        }
+        self.datastore.initiate_view(**self.view_args)
         self.prefstore = Prefstore(
             data_connector=self.data_connector,
             config=self.config,
@@ -138,15 +146,66 @@ class Plugin(BaseApplication):
             logger=self.logger,
         )
 
+    # Prepare an already initiated plugin object to run another job. Used by
+    # long-running job workers so that configuration and database connections
+    # are re-used between jobs.
+    def initiate_job(self, job_id):
+        self.cache = defaultdict(nested_defaultdict)
+        self.job_manager.last_cancel_check = {}
+        self._lease_connections()
+        self.datastore.reset_session()
+        self._initiate_job(job_id)
+
+    # With pooled connections, those used for the previous job have been
+    # returned to their pools, so connections are leased again for this job.
+    def _lease_connections(self):
+        if not self.data_connector.pooled:
+            return
+        self._db_connect()
+        self.datastore.set_connection(self.db)
+        job_manager = getattr(self, "job_manager", None)
+        if job_manager is not None:
+            job_manager._db_connect()
+
     def _initiate_job(self, job_id):
+        if self.data_connector.profiler:
+            self.data_connector.profiler.set_run_name(
+                f"{self.instance}_{type(self).__name__}_job_{job_id}"
+            )
         self.params = self.job_manager.get_job_params(job_id)
         job = self.job_manager.get_job(job_id)
 
-        self.datastore.initiate_view(
-            username=job.get("username"),
-            curate=self.params.get("curate"),
-            set_id=self.params.get("set_id"),
+        self.view_args = {
+            "username": job.get("username"),
+            "curate": self.params.get("curate"),
+            "set_id": self.params.get("set_id"),
+        }
+        self.datastore.initiate_view(**self.view_args)
+
+    # Give a forked worker process (e.g. from a multiprocessing pool) its own
+    # database connection and datastore. The objects inherited from the parent
+    # are kept referenced but never used, as closing their connections would
+    # also close them for the parent.
+    def initiate_worker_process(self):
+        self.inherited_connections = [self.data_connector, self.db, self.datastore]
+        self.data_connector = DataConnector(
+            system=self.system, config=self.config, logger=self.logger
         )
+        self._db_connect()
+        self._setup_datastore()
+        self.datastore.initiate_view(**self.view_args)
+
+    # Parameters for JobManager.add_job so that a job can be satisfied by the
+    # output of an identical job that finished within the plugin's
+    # result_cache_ttl (seconds), as long as the isolate data have not changed.
+    def get_result_cache_params(self):
+        ttl = self.get_attributes().get("result_cache_ttl")
+        if not ttl:
+            return {}
+        return {
+            "result_cache_ttl": ttl,
+            "data_fingerprint": self.datastore.get_isolate_data_fingerprint(),
+        }
 
     def _initiate_prefs(self):
         self.set_pref_requirements()
@@ -828,7 +887,7 @@ setTimeout(function(){{
             common_names = self.datastore.run_query(
                 "SELECT id, common_name FROM loci WHERE common_name IS NOT NULL",
                 None,
-                {"fetch": "all_hashref", "key": "id"},
+                {"fetch": "all_hashref", "key": "id", "metadata": 1},
             )
             set_id = self.get_set_id()
             loci = self.datastore.get_loci(
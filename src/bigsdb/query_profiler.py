@@ -0,0 +1,216 @@
+# Written by Keith Jolley
+# Copyright (c) 2024, University of Oxford
+# E-mail: keith.jolley@biology.ox.ac.uk
+#
+# This file is part of BIGSdb Python Toolkit.
+#
+# BIGSdb Python Toolkit is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BIGSdb Python Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BIGSdb Python Toolkit. If not,
+# see <https://www.gnu.org/licenses/>.
+
+import os
+import re
+import json
+import time
+import atexit
+import hashlib
+import logging
+import threading
+import psycopg2.extensions
+
+# Statements run more than this number of times in one run are reported as a
+# possible N+1 query pattern (a query run once for each row of another).
+N_PLUS_ONE_THRESHOLD = 50
+TOP_STATEMENTS = 10  # Number of statements listed in the log summary.
+
+
+# Statements that differ only in their literal values or the length of value
+# lists have the same shape.
+def normalise_statement(qry):
+    qry = re.sub(r"'(?:[^']|'')*'", "?", qry)
+    qry = re.sub(r"\b\d+(?:\.\d+)?\b", "?", qry)
+    qry = re.sub(r"%s|%\(\w+\)s", "?", qry)
+    qry = re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)", "(?)", qry)
+    return re.sub(r"\s+", " ", qry).strip()
+
+
+def get_statement_fingerprint(statement):
+    return hashlib.md5(statement.encode()).hexdigest()[:12]
+
+
+# Records the number of times each statement shape is run on connections made
+# by a DataConnector, with the total and maximum time taken and the number of
+# rows returned or affected. A profile covers a run (a plugin invocation or a
+# job) and is written as JSON to the profile directory, with a summary of the
+# most expensive statements and any possible N+1 patterns sent to the log.
+class QueryProfiler:
+    def __init__(self, profile_dir=None, logger=None, options={}):
+        self.profile_dir = profile_dir
+        if logger is None:
+            self.logger = logging.getLogger(__name__)
+            self.logger.addHandler(logging.NullHandler())
+        else:
+            self.logger = logger
+        self.threshold = options.get("n_plus_one_threshold", N_PLUS_ONE_THRESHOLD)
+        self.top = options.get("top", TOP_STATEMENTS)
+        self.lock = threading.Lock()
+        self.connection_factory = type(
+            "ProfilingConnection", (ProfilingConnection,), {"profiler": self}
+        )
+        self.name = None
+        self._reset()
+        atexit.register(self.finish)
+
+    def _reset(self):
+        self.statements = {}
+        self.started = time.time()
+
+    def set_run_name(self, name):
+        self.name = name
+
+    def record(self, qry, elapsed, rows):
+        statement = normalise_statement(qry)
+        with self.lock:
+            stats = self.statements.get(statement)
+            if stats is None:
+                stats = self.statements[statement] = {
+                    "fingerprint": get_statement_fingerprint(statement),
+                    "statement": statement,
+                    "count": 0,
+                    "total_time": 0.0,
+                    "max_time": 0.0,
+                    "rows": 0,
+                }
+            stats["count"] += 1
+            stats["total_time"] += elapsed
+            if elapsed > stats["max_time"]:
+                stats["max_time"] = elapsed
+            if rows > 0:
+                stats["rows"] += rows
+
+    def get_profile(self):
+        with self.lock:
+            statements = sorted(
+                (dict(stats) for stats in self.statements.values()),
+                key=lambda stats: stats["total_time"],
+                reverse=True,
+            )
+        for stats in statements:
+            stats["mean_time"] = stats["total_time"] / stats["count"]
+            stats["n_plus_one"] = stats["count"] > self.threshold
+        return {
+            "name": self.name,
+            "pid": os.getpid(),
+            "started": self.started,
+            "duration": time.time() - self.started,
+            "queries": sum(stats["count"] for stats in statements),
+            "query_time": sum(stats["total_time"] for stats in statements),
+            "statements": statements,
+        }
+
+    # Write the profile of the current run and start a new one.
+    def finish(self):
+        if not self.statements:
+            return
+        profile = self.get_profile()
+        self._reset()
+        self.name = None
+        self.log_summary(profile)
+        if not self.profile_dir:
+            return
+        name = re.sub(r"[^\w\-]", "_", profile["name"] or f"run_{profile['pid']}")
+        filename = f"{self.profile_dir}/{name}_{int(profile['started'])}.json"
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            with open(filename, "w") as f:
+                json.dump(profile, f, indent=2)
+        except Exception as e:
+            self.logger.error(f"Cannot write query profile {filename}: {e}")
+
+    def log_summary(self, profile):
+        self.logger.info(
+            f"Query profile {profile['name'] or profile['pid']}: "
+            f"{profile['queries']} queries in {profile['query_time']:.3f}s "
+            f"({profile['duration']:.3f}s elapsed)."
+        )
+        for stats in profile["statements"][: self.top]:
+            self.logger.info(
+                f"{stats['count']} x {stats['total_time']:.3f}s "
+                f"(max {stats['max_time']:.3f}s, {stats['rows']} rows) "
+                f"[{stats['fingerprint']}] {stats['statement'][:200]}"
+            )
+        for stats in profile["statements"]:
+            if stats["n_plus_one"]:
+                self.logger.warning(
+                    f"Possible N+1 query pattern: statement run {stats['count']} "
+                    f"times [{stats['fingerprint']}] {stats['statement'][:200]}"
+                )
+
+
+class ProfilingCursor:
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._record(query, start)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self._record(query, start)
+
+    def copy_from(self, file, table, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().copy_from(file, table, *args, **kwargs)
+        finally:
+            self._record(f"COPY {table} FROM STDIN", start)
+
+    def copy_expert(self, sql, file, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, *args, **kwargs)
+        finally:
+            self._record(sql, start)
+
+    def _record(self, query, start):
+        elapsed = time.perf_counter() - start
+        if not isinstance(query, str):
+            if isinstance(query, bytes):
+                query = query.decode(errors="replace")
+            else:  # psycopg2.sql.Composable
+                query = query.as_string(self.connection)
+        self.connection.profiler.record(query, elapsed, self.rowcount)
+
+
+# Connection whose cursors (of whichever cursor factory is requested) record
+# each statement with the profiler.
+class ProfilingConnection(psycopg2.extensions.connection):
+    profiler = None
+    cursor_classes = {}
+
+    def cursor(self, *args, **kwargs):
+        factory = (
+            kwargs.get("cursor_factory")
+            or self.cursor_factory
+            or psycopg2.extensions.cursor
+        )
+        if factory not in self.cursor_classes:
+            self.cursor_classes[factory] = type(
+                f"Profiling{factory.__name__}", (ProfilingCursor, factory), {}
+            )
+        kwargs["cursor_factory"] = self.cursor_classes[factory]
+        return super().cursor(*args, **kwargs)
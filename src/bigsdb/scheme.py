@@ -19,8 +19,20 @@
 # see <https://www.gnu.org/licenses/>.
 
 import logging
+import time
+import random
+from array import array
 import psycopg2.extras
 
+# Seconds between checks of whether the profile table has changed since the
+# profile index was loaded.
+PROFILE_INDEX_CHECK_INTERVAL = 60
+
+# If a query has no more than this number of combinations of allowed alleles,
+# each is looked up in the complete profile hash. Otherwise rows are found via
+# the inverted list of the most selective locus.
+MAX_PROFILE_COMBINATIONS = 64
+
 
 class Scheme:
     def __init__(self, attributes, logger=None):
@@ -31,6 +43,7 @@ class Scheme:
             self.logger.addHandler(logging.NullHandler())
         else:
             self.logger = logger
+        self.profile_index = None
         self._initiate()
 
     def _initiate(self):
@@ -44,6 +57,26 @@ class Scheme:
         indices = {row[0]: row[1] for row in data}
         self.locus_index = indices
 
+    # The profile index is loaded on first use and reloaded if the profile
+    # table has changed.
+    def get_profile_index(self):
+        if self.profile_index is None:
+            self.profile_index = ProfileIndex(
+                db=self.db,
+                table=f"mv_scheme_{self.dbase_id}",
+                loci=self.loci,
+                locus_index=self.locus_index,
+                fields=self.fields,
+                logger=self.logger,
+                check_interval=getattr(
+                    self,
+                    "profile_index_check_interval",
+                    PROFILE_INDEX_CHECK_INTERVAL,
+                ),
+            )
+        self.profile_index.refresh()
+        return self.profile_index
+
     def get_profile_by_primary_keys(self, values):
         if not self.db:
             return
@@ -66,16 +99,15 @@ class Scheme:
                 return
             return profile[0]
 
-    # designations is a dict containing a list of allele_designations for each locus.
-    def get_field_values_by_designations(self, designations, options={}):
-        loci = self.loci
-        fields = self.fields
-
+    # Returns a dict of the allele ids that each locus may take in a matching
+    # profile. designations is a dict containing a list of allele_designations
+    # for each locus.
+    def _get_allowed_allele_ids(self, designations, options={}):
         used_loci = []
         missing_loci = {}
         values = {}
 
-        for locus in loci:
+        for locus in self.loci:
             if locus not in designations:
                 if options.get("dont_match_missing_loci"):
                     continue
@@ -90,33 +122,57 @@ class Scheme:
                 values[locus] = {"allele_count": len(designations[locus])}
                 allele_ids = []
                 for designation in designations[locus]:
-                    if designation["allele_id"] == "0":
-                        missing_loci[locus] = 1
-                    if "allele_id" in designation:
-                        designation["allele_id"] = designation["allele_id"].replace(
-                            "'", "\\'"
-                        )
-                    else:
+                    if "allele_id" not in designation:
                         self.logger.error(
-                            f"{self['instance']}: Undefined allele for locus {locus}"
+                            f"{self.instance}: Undefined allele for locus {locus}"
                         )
+                        continue
+                    if designation["allele_id"] == "0":
+                        missing_loci[locus] = 1
                     allele_ids.append(designation["allele_id"])
                 values[locus]["allele_ids"] = allele_ids
             used_loci.append(locus)
 
-        if not values:
-            return {}
-
-        locus_terms = []
         for locus in used_loci:
             if not options.get("dont_match_missing_loci", True):
-                if self["allow_missing_loci"]:
+                if getattr(self, "allow_missing_loci", False):
                     values[locus]["allele_ids"].append("N")
-                if self["allow_presence"] and locus not in missing_loci:
+                if getattr(self, "allow_presence", False) and locus not in missing_loci:
                     values[locus]["allele_ids"].append("P")
-            allele_ids = values[locus]["allele_ids"]
+        return {locus: values[locus]["allele_ids"] for locus in used_loci}
+
+    # The locus with the fewest allowed alleles, avoiding N and P where
+    # possible as these can match many profiles.
+    def _get_key_locus(self, allowed):
+        return min(
+            allowed,
+            key=lambda locus: (
+                bool({"N", "P"} & set(allowed[locus])),
+                len(allowed[locus]),
+            ),
+        )
+
+    def _use_index(self, options):
+        return options.get("use_index", getattr(self, "use_profile_index", False))
+
+    # designations is a dict containing a list of allele_designations for each locus.
+    def get_field_values_by_designations(self, designations, options={}):
+        fields = self.fields
+        allowed = self._get_allowed_allele_ids(designations, options)
+        if not allowed:
+            return {}
+
+        if self._use_index(options):
+            index = self.get_profile_index()
+            return index.get_field_values(index.find(allowed))
+
+        locus_terms = []
+        for locus, allele_ids in allowed.items():
             formatted_allele_ids = ",".join(
-                [f"E'{allele_id}'" for allele_id in allele_ids]
+                [
+                    "E'" + str(allele_id).replace("'", "\\'") + "'"
+                    for allele_id in allele_ids
+                ]
             )
             locus_terms.append(
                 f"profile[{self.locus_index[locus]}] IN " f"({formatted_allele_ids})"
@@ -133,7 +189,7 @@ class Scheme:
         try:
             cursor.execute(qry)
         except Exception as e:
-            self.logger.warn(
+            self.logger.warning(
                 "Check database attributes in the scheme_fields table for "
                 f"scheme#{self.id} ({self.name})! {e}"
             )
@@ -143,3 +199,288 @@ class Scheme:
         field_data = [dict(row) for row in cursor.fetchall()]
         self.db.commit()
         return field_data
+
+    # Match many sets of designations (e.g. one per isolate) at once.
+    # designation_sets is a dict of designations (as passed to
+    # get_field_values_by_designations) keyed by any id. Returns a dict of
+    # field data keyed by the same ids. Without the profile index, all sets
+    # are matched with a single query. Candidate profiles for each set are
+    # found by the allowed alleles of one locus (see _get_key_locus), and only
+    # these are unnested and kept if they match at every locus.
+    def get_field_values_by_designation_sets(self, designation_sets, options={}):
+        allowed_sets = {}
+        for key, designations in designation_sets.items():
+            allowed = self._get_allowed_allele_ids(designations, options)
+            if allowed:
+                allowed_sets[key] = allowed
+        field_data = {key: [] for key in allowed_sets}
+        if not allowed_sets:
+            return field_data
+
+        if self._use_index(options):
+            index = self.get_profile_index()
+            for key, allowed in allowed_sets.items():
+                field_data[key] = index.get_field_values(index.find(allowed))
+            return field_data
+        if not self.primary_keys:
+            for key in allowed_sets:
+                field_data[key] = self.get_field_values_by_designations(
+                    designation_sets[key], options
+                )
+            return field_data
+
+        # Keys may be of any type so are passed to the database as positions in
+        # a list.
+        keys = list(allowed_sets.keys())
+        set_numbers, positions, allele_ids, required = [], [], [], []
+        key_alleles = {}  # Set numbers and allele ids by key locus position.
+        for set_number, key in enumerate(keys):
+            allowed = allowed_sets[key]
+            key_locus = self._get_key_locus(allowed)
+            key_set_numbers, key_allele_ids = key_alleles.setdefault(
+                self.locus_index[key_locus], ([], [])
+            )
+            for allele_id in allowed[key_locus]:
+                key_set_numbers.append(set_number)
+                key_allele_ids.append(str(allele_id))
+            for locus, locus_allele_ids in allowed.items():
+                for allele_id in locus_allele_ids:
+                    set_numbers.append(set_number)
+                    positions.append(self.locus_index[locus])
+                    allele_ids.append(str(allele_id))
+                    required.append(len(allowed))
+
+        table = f"mv_scheme_{self.dbase_id}"
+        field_list = ",".join(f'm.{field} AS "{field}"' for field in self.fields)
+        pk_list = ",".join(f"s.{pk}" for pk in self.primary_keys)
+        candidate_pk_list = ",".join(f"c.{pk}" for pk in self.primary_keys)
+        pk_join = " AND ".join(f"m.{pk}=x.{pk}" for pk in self.primary_keys)
+
+        # Each key locus position is a constant subscript so that an index on
+        # that locus can be used.
+        candidate_qry = " UNION ALL ".join(
+            f"SELECT k.set_number,{pk_list},s.profile FROM {table} s JOIN "
+            "unnest(%s::int[],%s::text[]) AS k(set_number,allele_id) ON "
+            f"s.profile[{position}]=k.allele_id"
+            for position in key_alleles
+        )
+        qry = (
+            "WITH q AS (SELECT * FROM unnest(%s::int[],%s::int[],%s::text[],"
+            "%s::int[]) AS q(set_number,position,allele_id,required)),c AS "
+            f"({candidate_qry}) SELECT x.set_number,{field_list} FROM (SELECT "
+            f"c.set_number,{candidate_pk_list} FROM c CROSS JOIN LATERAL "
+            "unnest(c.profile) WITH ORDINALITY AS p(allele_id,position) JOIN q ON "
+            "(q.set_number,q.position,q.allele_id)=(c.set_number,p.position,"
+            f"p.allele_id) GROUP BY c.set_number,{candidate_pk_list} HAVING "
+            "COUNT(DISTINCT q.position)=MAX(q.required)) x JOIN "
+            f"{table} m ON {pk_join} ORDER BY x.set_number"
+        )
+        values = [set_numbers, positions, allele_ids, required]
+        for key_set_numbers, key_allele_ids in key_alleles.values():
+            values += [key_set_numbers, key_allele_ids]
+        cursor = self.db.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        try:
+            cursor.execute(qry, values)
+        except Exception as e:
+            self.logger.warning(
+                "Check database attributes in the scheme_fields table for "
+                f"scheme#{self.id} ({self.name})! {e}"
+            )
+            self.db.rollback()
+            raise ValueError("Scheme configuration error")
+        for row in cursor.fetchall():
+            row = dict(row)
+            field_data[keys[row.pop("set_number")]].append(row)
+        self.db.commit()
+        return field_data
+
+
+# In-memory index of the profiles in a scheme's materialized view
+# (mv_scheme_<id>), used to match allele designations to profiles without a
+# database query per isolate.
+#
+# Allele ids are encoded as integers per locus and the profiles stored in a
+# single flat integer array, one row per profile and one column per locus.
+# Complete profiles are hashed for exact lookups. For queries with many
+# possible allele combinations (multiple designations, N or P matches, or
+# loci that are ignored) the candidate rows are taken from an inverted list of
+# the most selective locus and then checked against the remaining loci.
+class ProfileIndex:
+    def __init__(
+        self,
+        db=None,
+        table=None,
+        loci=[],
+        locus_index={},
+        fields=[],
+        logger=None,
+        check_interval=PROFILE_INDEX_CHECK_INTERVAL,
+    ):
+        self.db = db
+        self.table = table
+        self.loci = list(loci)
+        self.locus_column = {locus: i for i, locus in enumerate(self.loci)}
+        self.locus_index = locus_index
+        self.fields = list(fields)
+        self.logger = logger
+        self.check_interval = check_interval
+        self.signature = None
+        self.last_check = None
+
+    def refresh(self):
+        now = time.monotonic()
+        if self.last_check is not None and now - self.last_check < self.check_interval:
+            return
+        self.last_check = now
+        signature = self._get_signature()
+        if signature != self.signature:
+            self.load()
+            self.signature = signature
+
+    # Changes are detected from the row count, latest datestamp and the
+    # table's insert/update/delete statistics counters.
+    def _get_signature(self):
+        cursor = self.db.cursor()
+        qry = (
+            f"SELECT COUNT(*),MAX(datestamp),(SELECT n_tup_ins+n_tup_upd+n_tup_del "
+            f"FROM pg_stat_user_tables WHERE relname=%s) FROM {self.table}"
+        )
+        try:
+            cursor.execute(qry, [self.table])
+            signature = cursor.fetchone()
+            self.db.commit()
+        except Exception as e:
+            self.logger.error(f"{e} Query:{qry}")
+            self.db.rollback()
+            raise
+        return tuple(signature)
+
+    def load(self):
+        locus_count = len(self.loci)
+        positions = [self.locus_index[locus] - 1 for locus in self.loci]
+        self.codes = [{} for _ in self.loci]
+        self.code_counts = [[] for _ in self.loci]
+        self.matrix = array("i")
+        self.field_values = []
+        self.profile_hash = {}
+        self.inverted = {}
+        field_list = ",".join(f'{field} AS "{field}"' for field in self.fields)
+        qry = f"SELECT {field_list},profile FROM {self.table}"
+        cursor = self.db.cursor(f"bigsdb_profile_index_{random.randint(0, 99999999)}")
+        cursor.itersize = 10000
+        row_number = 0
+        try:
+            cursor.execute(qry)
+            for record in cursor:
+                profile = record[-1]
+                row_codes = array("i", bytes(4 * locus_count))
+                for column, position in enumerate(positions):
+                    allele_id = profile[position] if position < len(profile) else None
+                    codes = self.codes[column]
+                    code = codes.get(allele_id)
+                    if code is None:
+                        code = len(codes)
+                        codes[allele_id] = code
+                        self.code_counts[column].append(0)
+                    self.code_counts[column][code] += 1
+                    row_codes[column] = code
+                self.matrix.extend(row_codes)
+                self.field_values.append(tuple(record[:-1]))
+                self.profile_hash.setdefault(hash(row_codes.tobytes()), []).append(
+                    row_number
+                )
+                row_number += 1
+            cursor.close()
+            self.db.commit()
+        except Exception as e:
+            self.logger.error(f"{e} Query:{qry}")
+            self.db.rollback()
+            raise
+        self.row_count = row_number
+
+    # allowed is a dict of allowed allele ids keyed by locus. Loci not
+    # included can take any value. Returns a list of matching row numbers.
+    def find(self, allowed):
+        allowed_codes = {}
+        for locus, allele_ids in allowed.items():
+            column = self.locus_column[locus]
+            codes = {
+                self.codes[column][str(allele_id)]
+                for allele_id in allele_ids
+                if str(allele_id) in self.codes[column]
+            }
+            if not codes:
+                return []
+            allowed_codes[column] = codes
+        if not allowed_codes:
+            return list(range(self.row_count))
+        if len(allowed_codes) == len(self.loci):
+            combinations = 1
+            for codes in allowed_codes.values():
+                combinations *= len(codes)
+            if combinations <= MAX_PROFILE_COMBINATIONS:
+                return self._find_by_hash(allowed_codes)
+        return self._find_by_scan(allowed_codes)
+
+    def _find_by_hash(self, allowed_codes):
+        locus_count = len(self.loci)
+        profiles = [array("i", bytes(4 * locus_count))]
+        for column in range(locus_count):
+            codes = sorted(allowed_codes[column])
+            expanded = []
+            for profile in profiles:
+                for code in codes:
+                    new_profile = array("i", profile)
+                    new_profile[column] = code
+                    expanded.append(new_profile)
+            profiles = expanded
+        rows = []
+        for profile in profiles:
+            for row in self.profile_hash.get(hash(profile.tobytes()), []):
+                start = row * locus_count
+                if self.matrix[start : start + locus_count] == profile:
+                    rows.append(row)
+        return sorted(rows)
+
+    def _find_by_scan(self, allowed_codes):
+        locus_count = len(self.loci)
+        driver = min(
+            allowed_codes,
+            key=lambda column: sum(
+                self.code_counts[column][code] for code in allowed_codes[column]
+            ),
+        )
+        inverted = self._get_inverted_list(driver)
+        candidates = []
+        for code in allowed_codes[driver]:
+            candidates.extend(inverted.get(code, []))
+        others = [
+            (column, codes)
+            for column, codes in allowed_codes.items()
+            if column != driver
+        ]
+        matrix = self.matrix
+        rows = []
+        for row in candidates:
+            start = row * locus_count
+            if all(matrix[start + column] in codes for column, codes in others):
+                rows.append(row)
+        return sorted(rows)
+
+    # Inverted lists are only built for loci that are used to drive a scan, so
+    # that memory use for large (e.g. cgMLST) schemes stays close to that of
+    # the profile array itself.
+    def _get_inverted_list(self, column):
+        if column not in self.inverted:
+            locus_count = len(self.loci)
+            inverted = {}
+            for row in range(self.row_count):
+                code = self.matrix[row * locus_count + column]
+                if code not in inverted:
+                    inverted[code] = array("i")
+                inverted[code].append(row)
+            self.inverted[column] = inverted
+        return self.inverted[column]
+
+    def get_field_values(self, rows):
+        return [dict(zip(self.fields, self.field_values[row])) for row in rows]
@@ -18,7 +18,30 @@
 # along with BIGSdb Python Toolkit. If not,
 # see <https://www.gnu.org/licenses/>.
 
-
+import re
+import json
+import hashlib
+
+# Groups nested deeper than this are not displayed. This prevents runaway
+# recursion if a child group is set as the parent of one of its ancestors.
+MAX_GROUP_LEVEL = 10
+
+# Option keys that affect the rendered tree.
+TREE_OPTIONS = [
+    "isolate_display",
+    "analysis_pref",
+    "no_disabled",
+    "select_schemes",
+    "schemes_only",
+    "filter_no_submissions",
+]
+
+
+# The group hierarchy and scheme list are each loaded with a single query and
+# the tree is then built in memory. Rendered trees are cached (in the metadata
+# snapshot if enabled so that they are shared between processes) keyed on the
+# set, tree options and the scheme preferences that they depend on. Both
+# caches are discarded when the locus, scheme or group tables change.
 class SchemeSelector:
     def __init__(self, datastore, prefs, params, set_id=None):
         self.datastore = datastore
@@ -27,24 +50,76 @@ class SchemeSelector:
         self.set_id = set_id
 
     def get_tree(self, options={}):
+        key = self._get_cache_key(options)
+        cache = self._get_tree_cache()
+        if cache is not None and key in cache:
+            main_buffer = cache[key]
+        else:
+            main_buffer = self._build_tree(options)
+            if cache is not None:
+                cache[key] = main_buffer
+
+        if options.get("get_groups"):
+            groups = set()
+            for match in re.findall(r"group_id=(\d+)", main_buffer):
+                groups.add(match)
+            return groups
 
-        groups_with_no_parent = self.datastore.run_query(
-            "SELECT id FROM scheme_groups WHERE id NOT IN (SELECT group_id FROM "
-            "scheme_group_group_members) ORDER BY display_order,name",
-            None,
-            {"fetch": "col_arrayref"},
+        return main_buffer
+
+    # Returns None (so trees are not cached) if it cannot be told whether the
+    # tables have changed.
+    def _get_tree_cache(self):
+        snapshot = self.datastore.get_metadata_snapshot()
+        if snapshot is not None:
+            return snapshot
+        fingerprint = self.datastore.get_metadata_fingerprint()
+        if fingerprint is None:
+            return
+        trees = self.datastore.cache["scheme_trees"]
+        if trees.get("fingerprint") != fingerprint:
+            trees.clear()
+            trees["fingerprint"] = fingerprint
+        return trees
+
+    def _get_cache_key(self, options):
+        prefs = {}
+        for pref in ("isolate_display_schemes", "analysis_schemes", "disable_schemes"):
+            prefs[pref] = sorted(
+                str(scheme_id) for scheme_id, value in self.prefs[pref].items() if value
+            )
+        prefs_digest = hashlib.md5(
+            json.dumps(prefs, sort_keys=True).encode()
+        ).hexdigest()
+        tree_options = tuple(
+            (option, bool(options.get(option))) for option in TREE_OPTIONS
         )
+        return ("scheme_tree", self.set_id, tree_options, prefs_digest)
+
+    def _build_tree(self, options):
+        groups = self._get_groups()
+        schemes = self._get_schemes(options)
+        group_schemes = {}
+        for scheme in schemes:
+            for group_id in scheme["groups"]:
+                group_schemes.setdefault(group_id, []).append(scheme)
+        children = {}
+        for group in groups:
+            children.setdefault(group["parent_id"], []).append(group)
 
         buffer = ""
-
+        groups_with_no_parent = children.get(None, [])
         for group in groups_with_no_parent:
-            group_info = self.datastore.get_scheme_group_info(group)
-            group_scheme_buffer = self._get_group_schemes(group, options)
-            child_group_buffer = self._get_child_groups(group, 1, options)
+            group_scheme_buffer = self._get_group_schemes(
+                group_schemes.get(group["id"], []), options
+            )
+            child_group_buffer = self._get_child_groups(
+                group["id"], children, group_schemes, options
+            )
             if not group_scheme_buffer and not child_group_buffer:
                 continue
 
-            buffer += f"<li><a>{group_info['name']}</a>\n"
+            buffer += f"<li><a>{group['name']}</a>\n"
             buffer += group_scheme_buffer
             buffer += child_group_buffer
             buffer += "</li>\n"
@@ -53,7 +128,7 @@ class SchemeSelector:
             {
                 "options": options,
                 "groups_with_no_parent": groups_with_no_parent,
-                "page": self.params["page"],
+                "schemes": schemes,
             }
         )
 
@@ -74,98 +149,106 @@ class SchemeSelector:
             main_buffer += "</ul>\n</li></ul>\n"
         else:
             main_buffer = "<ul><li><a>No loci available for analysis.</a></li></ul>\n"
-
-        if options.get("get_groups"):
-            groups = set()
-            for match in re.findall(r"group_id=(\d+)", main_buffer):
-                groups.add(match)
-            return groups
-
         return main_buffer
 
-    def _get_group_schemes(self, group_id, options={}):
-
-        buffer = ""
-        set_clause = (
-            f" AND scheme_id IN (SELECT scheme_id FROM set_schemes WHERE set_id={set_id})"
-            if self.set_id
-            else ""
+    # Returns every group that can be reached from a top-level group, once for
+    # each parent, in display order.
+    def _get_groups(self):
+        return self.datastore.run_query(
+            "WITH RECURSIVE tree(id,parent_id,level) AS (SELECT id,NULL::integer,0 "
+            "FROM scheme_groups WHERE id NOT IN (SELECT group_id FROM "
+            "scheme_group_group_members) UNION ALL SELECT m.group_id,m.parent_group_id,"
+            "t.level+1 FROM scheme_group_group_members m JOIN tree t ON "
+            "m.parent_group_id=t.id WHERE t.level<?) SELECT DISTINCT t.id,t.parent_id,"
+            "g.name,g.display_order FROM tree t JOIN scheme_groups g ON t.id=g.id "
+            "ORDER BY g.display_order,g.name",
+            MAX_GROUP_LEVEL - 1,
+            {"fetch": "all_arrayref", "slice": {}, "metadata": 1},
         )
 
+    # Returns all schemes (in the set if one is selected) in display order,
+    # with the groups that they belong to.
+    def _get_schemes(self, options={}):
+        values = []
+        if self.set_id:
+            set_clause = " JOIN set_schemes ss ON s.id=ss.scheme_id AND ss.set_id=?"
+            name = "COALESCE(NULLIF(ss.set_name,''),s.name)"
+            values.append(self.set_id)
+        else:
+            set_clause = ""
+            name = "s.name"
+        # Schemes not in a group are only listed if they have loci that
+        # accept submissions when filter_no_submissions is set.
+        submissions = (
+            ",s.id IN (SELECT scheme_id FROM scheme_members sm JOIN loci l ON "
+            "sm.locus=l.id WHERE NOT l.no_submissions OR l.no_submissions IS NULL)"
+            if options.get("filter_no_submissions")
+            else ",true"
+        )
         schemes = self.datastore.run_query(
-            "SELECT scheme_id FROM scheme_group_scheme_members m LEFT JOIN schemes s ON "
-            f"s.id=m.scheme_id WHERE m.group_id=? {set_clause} ORDER BY display_order,name",
-            group_id,
-            {"fetch": "col_arrayref"},
+            f"SELECT s.id,{name} AS name,ARRAY(SELECT group_id FROM "
+            "scheme_group_scheme_members WHERE scheme_id=s.id) AS groups"
+            f"{submissions} AS submissions FROM schemes s{set_clause} ORDER BY "
+            "s.display_order,s.name",
+            values,
+            {"fetch": "all_arrayref", "slice": {}, "metadata": 1},
         )
+        return [
+            {
+                "id": scheme["id"],
+                "name": scheme["name"].replace("&", "&amp;"),
+                "groups": scheme["groups"],
+                "submissions": scheme["submissions"],
+            }
+            for scheme in schemes
+        ]
 
-        if schemes:
-            for scheme_id in schemes:
-                if options.get("isolate_display") and not self.prefs[
-                    "isolate_display_schemes"
-                ].get(scheme_id):
-                    continue
-                if options.get("analysis_pref") and not self.prefs[
-                    "analysis_schemes"
-                ].get(scheme_id):
-                    continue
-                if options.get("no_disabled") and self.prefs["disable_schemes"].get(
-                    scheme_id
-                ):
-                    continue
+    def _get_group_schemes(self, schemes, options={}):
 
-                scheme_info = self.datastore.get_scheme_info(
-                    scheme_id, {"set_id": self.set_id}
-                )
-
-                scheme_info["name"] = scheme_info["name"].replace("&", "&amp;")
+        buffer = ""
+        for scheme in schemes:
+            if not self._should_display_scheme_in_tree(scheme["id"], options):
+                continue
+            if options.get("no_disabled") and self.prefs["disable_schemes"].get(
+                scheme["id"]
+            ):
+                continue
 
-                id_attr = (
-                    f' id="s_{scheme_id}"' if options.get("select_schemes") else ""
-                )
-                buffer += f'<li{id_attr}><a>{scheme_info["name"]}</a></li>\n'
+            id_attr = f' id="s_{scheme["id"]}"' if options.get("select_schemes") else ""
+            buffer += f'<li{id_attr}><a>{scheme["name"]}</a></li>\n'
 
         return f"<ul>{buffer}</ul>\n" if buffer else ""
 
-    def _get_child_groups(self, group_id, level, options={}):
+    def _get_child_groups(self, group_id, children, group_schemes, options, level=1):
 
         buffer = ""
-        child_groups = self.datastore.run_query(
-            "SELECT id FROM scheme_groups LEFT JOIN scheme_group_group_members ON "
-            "scheme_groups.id=group_id WHERE parent_group_id=? ORDER BY display_order,name",
-            group_id,
-            {"fetch": "col_arrayref"},
-        )
-
-        if child_groups:
-            for group_id in child_groups:
-                group_info = self.datastore.get_scheme_group_info(group_id)
-                new_level = level
-                if new_level == 10:
-                    break  # prevent runaway if child is set as the parent of a parental group
-
-                group_scheme_buffer = self._get_group_schemes(group_id, options)
-                child_group_buffer = self._get_child_groups(
-                    group_id, new_level + 1, options
-                )
-
-                if group_scheme_buffer or child_group_buffer:
-                    page = self.params.get("page")
-                    if options.get("schemes_only"):
-                        buffer += f'<li>{group_info["name"]}\n'
-                    else:
-                        buffer += f'<li><a>{group_info["name"]}</a>\n'
-                    buffer += group_scheme_buffer
-                    buffer += child_group_buffer
-                    buffer += "</li>"
+        if level == MAX_GROUP_LEVEL:
+            return buffer
+        for group in children.get(group_id, []):
+            group_scheme_buffer = self._get_group_schemes(
+                group_schemes.get(group["id"], []), options
+            )
+            child_group_buffer = self._get_child_groups(
+                group["id"], children, group_schemes, options, level + 1
+            )
+
+            if group_scheme_buffer or child_group_buffer:
+                if options.get("schemes_only"):
+                    buffer += f'<li>{group["name"]}\n'
+                else:
+                    buffer += f'<li><a>{group["name"]}</a>\n'
+                buffer += group_scheme_buffer
+                buffer += child_group_buffer
+                buffer += "</li>"
 
         return f"<ul>\n{buffer}</ul>\n" if buffer else ""
 
     def _add_schemes_not_in_groups(self, args):
         options = args.get("options", {})
         groups_with_no_parent = args.get("groups_with_no_parent", [])
-        page = args.get("page", "")
-        schemes_not_in_group = self._get_schemes_not_in_groups(options)
+        schemes_not_in_group = self._get_schemes_not_in_groups(
+            args.get("schemes", []), options
+        )
         buffer = ""
 
         if schemes_not_in_group:
@@ -181,8 +264,11 @@ class SchemeSelector:
             for scheme in schemes_not_in_group:
                 if not self._should_display_scheme_in_tree(scheme["id"], options):
                     continue
-
-                scheme["name"] = scheme["name"].replace("&", "&amp;")
+                id_attr = (
+                    f' id="s_{scheme["id"]}"' if options.get("select_schemes") else ""
+                )
+                temp_buffer += f'<li{id_attr}><a>{scheme["name"]}</a></li>\n'
+                data_exists = True
 
             if groups_with_no_parent:
                 temp_buffer += "</ul></li>"
@@ -192,38 +278,16 @@ class SchemeSelector:
 
         return buffer
 
-    def _get_schemes_not_in_groups(self, options={}):
-        set_id = self.set_id
-        set_clause = (
-            f"AND id IN (SELECT scheme_id FROM set_schemes WHERE set_id={set_id})"
-            if set_id
-            else ""
-        )
-
-        no_submission_clause = (
-            " AND id IN (SELECT scheme_id FROM scheme_members sm JOIN loci l ON "
-            "sm.locus=l.id WHERE NOT l.no_submissions OR l.no_submissions IS NULL)"
-            if options.get("filter_no_submissions")
-            else ""
-        )
-
-        schemes = self.datastore.run_query(
-            "SELECT id FROM schemes WHERE id NOT IN (SELECT scheme_id FROM "
-            f"scheme_group_scheme_members) {set_clause}{no_submission_clause} ORDER "
-            "BY display_order,name",
-            None,
-            {"fetch": "col_arrayref", "slice": {}},
-        )
-
+    def _get_schemes_not_in_groups(self, schemes, options={}):
         not_in_group = []
-        for scheme_id in schemes:
-            if self.prefs["disable_schemes"].get(scheme_id) and options.get(
+        for scheme in schemes:
+            if scheme["groups"] or not scheme["submissions"]:
+                continue
+            if self.prefs["disable_schemes"].get(scheme["id"]) and options.get(
                 "no_disabled"
             ):
                 continue
-            scheme_info = self.datastore.get_scheme_info(scheme_id, {"set_id": set_id})
-            not_in_group.append({"id": scheme_id, "name": scheme_info["name"]})
-
+            not_in_group.append(scheme)
         return not_in_group
 
     def _should_display_scheme_in_tree(self, scheme_id, options):
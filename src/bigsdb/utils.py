@@ -77,6 +77,18 @@ def escape_html(string):
     return string
 
 
+# Escape a value for use in PostgreSQL COPY text format.
+def escape_copy_value(value):
+    if value == None:
+        return "\\N"
+    string = str(value)
+    string = string.replace("\\", "\\\\")
+    string = string.replace("\t", "\\t")
+    string = string.replace("\n", "\\n")
+    string = string.replace("\r", "\\r")
+    return string
+
+
 def get_random():
     return (
         "BIGSdb_"
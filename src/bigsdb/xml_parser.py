@@ -23,6 +23,17 @@ import pyuca
 import bigsdb.utils
 from bigsdb.constants import COUNTRIES
 
+_collator = None
+
+
+# Building a collator parses the full Unicode collation table, so a single
+# instance is shared by the process and only created when first needed.
+def get_collator():
+    global _collator
+    if _collator is None:
+        _collator = pyuca.Collator()
+    return _collator
+
 
 class XMLParser(object):
     def __init__(self):
@@ -30,11 +41,13 @@ class XMLParser(object):
         self.system = {}
         self.attributes = {}
         self.optlists = {}
+        self.option_lists = {}
         self.prefixes_already_defined = False
 
     def parse(self, xml_file):
         tree = ET.parse(xml_file)
         root = tree.getroot()
+        self.option_lists = {}
         system = root.find("system")
         self.system = system.attrib
         fields = root.findall("field")
@@ -86,7 +99,14 @@ class XMLParser(object):
         self._set_prefix_fields()
         return self.attributes[field]
 
+    # Option lists (sorted if required) are built once per field. A copy is
+    # returned so that callers can modify it.
     def get_field_option_list(self, field):
+        if field not in self.option_lists:
+            self.option_lists[field] = self._build_field_option_list(field)
+        return list(self.option_lists[field])
+
+    def _build_field_option_list(self, field):
         list = []
         if "values" in self.attributes[field]:
             special_values = self._get_special_optlist_values(
@@ -97,8 +117,7 @@ class XMLParser(object):
         for value in self.optlists[field]:
             list.append(value)
         if "sort" in self.attributes[field] and self.attributes[field]["sort"] == "yes":
-            collator = pyuca.Collator()
-            list = sorted(list, key=collator.sort_key)
+            list = sorted(list, key=get_collator().sort_key)
         return list
 
     def _set_prefix_fields(self):
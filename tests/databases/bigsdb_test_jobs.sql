@@ -0,0 +1,75 @@
+CREATE TABLE jobs (
+id text NOT NULL,
+dbase_config text NOT NULL,
+username text,
+email text,
+ip_address text NOT NULL,
+submit_time timestamptz NOT NULL,
+start_time timestamptz,
+stop_time timestamptz,
+module text NOT NULL,
+status text NOT NULL,
+pid int,
+percent_complete int NOT NULL,
+message_html text,
+priority int NOT NULL,
+fingerprint text,
+stage text,
+cancel boolean,
+PRIMARY KEY (id)
+);
+
+CREATE TABLE params (
+job_id text NOT NULL,
+key text NOT NULL,
+value text NOT NULL,
+PRIMARY KEY (job_id,key),
+CONSTRAINT p_job_id FOREIGN KEY (job_id) REFERENCES jobs
+ON DELETE CASCADE
+ON UPDATE CASCADE
+);
+
+CREATE TABLE isolates (
+job_id text NOT NULL,
+isolate_id int NOT NULL,
+PRIMARY KEY (job_id,isolate_id),
+CONSTRAINT i_job_id FOREIGN KEY (job_id) REFERENCES jobs
+ON DELETE CASCADE
+ON UPDATE CASCADE
+);
+
+CREATE TABLE profiles (
+job_id text NOT NULL,
+scheme_id int NOT NULL,
+profile_id text NOT NULL,
+PRIMARY KEY (job_id,scheme_id,profile_id),
+CONSTRAINT pr_job_id FOREIGN KEY (job_id) REFERENCES jobs
+ON DELETE CASCADE
+ON UPDATE CASCADE
+);
+
+CREATE TABLE loci (
+job_id text NOT NULL,
+locus text NOT NULL,
+PRIMARY KEY (job_id,locus),
+CONSTRAINT l_job_id FOREIGN KEY (job_id) REFERENCES jobs
+ON DELETE CASCADE
+ON UPDATE CASCADE
+);
+
+CREATE TABLE output (
+job_id text NOT NULL,
+filename text NOT NULL,
+description text NOT NULL,
+PRIMARY KEY (job_id,description),
+CONSTRAINT o_job_id FOREIGN KEY (job_id) REFERENCES jobs
+ON DELETE CASCADE
+ON UPDATE CASCADE
+);
+
+CREATE TABLE archived_jobs (LIKE jobs INCLUDING DEFAULTS);
+CREATE TABLE archived_params (LIKE params INCLUDING DEFAULTS);
+CREATE TABLE archived_isolates (LIKE isolates INCLUDING DEFAULTS);
+CREATE TABLE archived_profiles (LIKE profiles INCLUDING DEFAULTS);
+CREATE TABLE archived_loci (LIKE loci INCLUDING DEFAULTS);
+CREATE TABLE archived_output (LIKE output INCLUDING DEFAULTS);
@@ -0,0 +1,79 @@
+# Written by Keith Jolley
+# Copyright (c) 2024, University of Oxford
+# E-mail: keith.jolley@biology.ox.ac.uk
+#
+# This file is part of BIGSdb Python Toolkit.
+#
+# BIGSdb Python Toolkit is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BIGSdb Python Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BIGSdb Python Toolkit. If not,
+# see <https://www.gnu.org/licenses/>.
+
+import sys
+import os
+import shutil
+import pathlib
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from bigsdb.config_snapshot import ConfigSnapshot
+
+dir = pathlib.Path(__file__).parent.resolve()
+
+
+class TestConfigSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.dir.name, "cache")
+        os.mkdir(self.cache_dir, mode=0o700)
+        self.conf_file = os.path.join(self.dir.name, "bigsdb.conf")
+        shutil.copy(f"{dir}/config_files/bigsdb.conf", self.conf_file)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def get_snapshot(self):
+        return ConfigSnapshot(
+            cache_dir=self.cache_dir,
+            name="test",
+            sources=[self.conf_file, os.path.join(self.dir.name, "db.conf")],
+        )
+
+    def test_shared_between_instances(self):
+        snapshot = self.get_snapshot()
+        self.assertIsNone(snapshot.load())
+        snapshot.save(({"prefs_db": "bigsdb_prefs"}, {"db": "test"}))
+        snapshot = self.get_snapshot()
+        self.assertEqual(snapshot.load()[1]["db"], "test")
+        mode = os.stat(f"{self.cache_dir}/test.pickle").st_mode
+        self.assertEqual(mode & 0o777, 0o600)
+
+    def test_invalidated_by_source_change(self):
+        snapshot = self.get_snapshot()
+        snapshot.load()
+        snapshot.save(({"prefs_db": "bigsdb_prefs"}, {"db": "test"}))
+        with open(self.conf_file, "a") as f:
+            f.write("new_key=1\n")
+        self.assertIsNone(self.get_snapshot().load())
+
+    def test_not_used_if_cache_dir_not_private(self):
+        os.chmod(self.cache_dir, 0o755)
+        snapshot = self.get_snapshot()
+        self.assertIsNone(snapshot.load())
+        snapshot.save(({}, {}))
+        self.assertFalse(os.path.exists(f"{self.cache_dir}/test.pickle"))
+
+
+if __name__ == "__main__":
+    unittest.main()
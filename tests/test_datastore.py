@@ -21,7 +21,10 @@
 import sys
 import os
 import pathlib
+import tempfile
+import time
 import unittest
+from unittest.mock import patch
 import psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 
@@ -30,7 +33,12 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")
 from bigsdb.base_application import BaseApplication
 from bigsdb.data_connector import DataConnector
 from bigsdb.constants import CONNECTION_DETAILS
-from bigsdb.datastore import Datastore
+from bigsdb.datastore import (
+    Datastore,
+    replace_placeholders,
+    convert_placeholders_to_numbered,
+)
+from bigsdb.designation_matrix import DesignationMatrix
 from bigsdb.xml_parser import XMLParser
 
 TEST_ISOLATE_DATABASE = "bigsdb_test_isolates"
@@ -84,6 +92,21 @@ class TestDatastore(unittest.TestCase):
         value = self.datastore.get_eav_field_value(1, "Bexsero_reactivity")
         self.assertEqual(value, "insufficient data")
 
+    def test_get_eav_values(self):
+        fields = self.datastore.get_eav_fieldnames()
+        values = self.datastore.get_eav_values([1, 2, 1200], fields)
+        self.assertEqual(values[1].get("Bexsero_reactivity"), "insufficient data")
+        for field in fields:
+            self.assertEqual(
+                values.get(1, {}).get(field),
+                self.datastore.get_eav_field_value(1, field),
+            )
+        table = self.datastore.create_temp_list_table_from_list("int", [1, 2])
+        self.assertEqual(
+            self.datastore.get_eav_values(table, fields).get(1), values.get(1)
+        )
+        self.db.rollback()
+
     def test_isolates_with_seqbin(self):
         ids, labels = self.datastore.get_isolates_with_seqbin()
         self.assertEqual(len(ids), 3)
@@ -95,6 +118,22 @@ class TestDatastore(unittest.TestCase):
         self.assertEqual(user_info.get("surname"), "Doe")
         self.assertEqual(user_info.get("email"), "john.doe@test.com")
 
+    def test_lazy_user_db(self):
+        self.datastore.user_dbs[2] = {
+            "connection": {
+                "dbase_name": TEST_USERS_DATABASE,
+                "host": HOST,
+                "port": PORT,
+                "user": USER,
+                "password": PASSWORD,
+            },
+            "name": TEST_USERS_DATABASE,
+        }
+        self.datastore.prewarm_user_dbs()
+        user_info = self.datastore.get_remote_user_info("jdoe", 2)
+        self.assertEqual(user_info.get("email"), "john.doe@test.com")
+        del self.datastore.user_dbs[2]
+
     def test_get_seqbin_count(self):
         count = self.datastore.get_seqbin_count()
         self.assertEqual(count, 3)
@@ -239,6 +278,68 @@ class TestDatastore(unittest.TestCase):
         self.assertEqual(list[0].get("isolate"), "A4/M1027")
         self.assertEqual(list[1].get("country"), "Pakistan")
 
+    def test_run_query_iterative(self):
+        rows = self.datastore.run_query(
+            "SELECT id,isolate,country FROM isolates WHERE id<=? ORDER BY id",
+            2,
+            {"fetch": "iter_hashref", "itersize": 1},
+        )
+        rows = list(rows)
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0].get("country"), "USA")
+        self.assertEqual(rows[1].get("country"), "Pakistan")
+        rows = self.datastore.run_query(
+            "SELECT id,isolate,country FROM isolates WHERE id<=2 ORDER BY id",
+            None,
+            {"fetch": "iter_arrayref"},
+        )
+        rows = list(rows)
+        self.assertEqual(rows[1][2], "Pakistan")
+        self.db.rollback()
+
+    def test_run_query_prepared(self):
+        qry = "SELECT country FROM isolates WHERE id=? AND country LIKE '%%a%%'"
+        for _ in range(3):
+            country = self.datastore.run_query(qry, 2, {"prepare": True})
+            self.assertEqual(country, "Pakistan")
+        stats = self.datastore.get_statement_cache_stats()
+        self.assertEqual(stats["prepared"], 1)
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(
+            convert_placeholders_to_numbered(replace_placeholders(qry)),
+            ("SELECT country FROM isolates WHERE id=$1 AND country LIKE '%a%'", 1),
+        )
+        self.db.rollback()
+
+    def test_prepared_statement_bookkeeping(self):
+        with patch("bigsdb.datastore.MAX_STATEMENT_COUNTS", 10):
+            for i in range(25):
+                self.datastore.run_query(f"SELECT {i}", None, {"prepare": 1})
+        counts = self.datastore.prepared[id(self.db)]["counts"]
+        self.assertTrue(0 < len(counts) <= 10)
+
+        # Closed connections are not kept.
+        connection_args = {
+            "dbname": TEST_ISOLATE_DATABASE,
+            "host": HOST,
+            "port": PORT,
+            "user": USER,
+            "password": PASSWORD,
+        }
+        closed_db = psycopg2.connect(**connection_args)
+        self.datastore.run_query("SELECT 1", None, {"db": closed_db, "prepare": True})
+        closed_db.close()
+        other_db = psycopg2.connect(**connection_args)
+        self.datastore.run_query("SELECT 1", None, {"db": other_db, "prepare": True})
+        self.assertFalse(
+            any(
+                connection["db"] is closed_db
+                for connection in self.datastore.prepared.values()
+            )
+        )
+        other_db.close()
+        self.db.rollback()
+
     def test_create_temp_list_table_from_list(self):
         table = self.datastore.create_temp_list_table_from_list("int", [1, 2, 3, 4, 5])
         qry = f"SELECT COUNT(*) FROM {table}"
@@ -265,6 +366,134 @@ class TestDatastore(unittest.TestCase):
         self.assertEqual(designations[2]["locus"], "aroE")
         self.assertEqual(designations[2]["allele_id"], "3")
 
+    def test_get_allele_designations_by_isolate_ids(self):
+        table = self.datastore.create_temp_list_table_from_list(
+            "text", ["abcZ", "adk", "aroE"]
+        )
+        designations = self.datastore.get_allele_designations_by_isolate_ids(
+            [1, 3], table
+        )
+        self.assertEqual(len(designations[1]), 3)
+        self.assertEqual(designations[1]["abcZ"][0]["allele_id"], "1")
+        self.assertEqual(designations[1]["adk"][0]["allele_id"], "3")
+        self.assertEqual(designations[3]["abcZ"][0]["allele_id"], "119")
+
+    def test_designation_matrix(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            matrix = DesignationMatrix(
+                db=self.db,
+                dbase_name=TEST_ISOLATE_DATABASE,
+                cache_dir=cache_dir,
+                logger=self.datastore.logger,
+            )
+            matrix.refresh()
+            table = self.datastore.create_temp_list_table_from_list(
+                "text", ["abcZ", "adk"]
+            )
+            expected = self.datastore.get_allele_designations_by_isolate_ids(
+                [1, 2, 3], table
+            )
+            designations = matrix.get_designations([1, 2, 3], ["abcZ", "adk"])
+            for isolate_id, loci in expected.items():
+                for locus, locus_designations in loci.items():
+                    self.assertEqual(
+                        [d["allele_id"] for d in designations[isolate_id][locus]],
+                        [d["allele_id"] for d in locus_designations],
+                    )
+        self.db.rollback()
+
+    def test_designation_matrix_update(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            matrix = DesignationMatrix(
+                db=self.db,
+                dbase_name=TEST_ISOLATE_DATABASE,
+                cache_dir=cache_dir,
+                logger=self.datastore.logger,
+                options={"check_interval": 0},
+            )
+
+            # The caller's transaction is not committed by a refresh.
+            cursor = self.db.cursor()
+            cursor.execute("CREATE TEMP TABLE designation_matrix_test (id int)")
+            cursor.execute("SELECT txid_current()")
+            txid = cursor.fetchone()[0]
+            matrix.refresh()
+            cursor.execute("SELECT txid_current_if_assigned()")
+            self.assertEqual(cursor.fetchone()[0], txid)
+            self.db.rollback()
+
+            # Changed designations are patched in place.
+            inode = os.stat(matrix.matrix_file).st_ino
+            cursor.execute(
+                "UPDATE allele_designations SET datestamp=datestamp WHERE isolate_id=1"
+            )
+            self.db.commit()
+            start = time.time()
+            while time.time() - start < 10:
+                if matrix._get_state()[0]["stats"] != matrix.meta["stats"]:
+                    break
+                time.sleep(0.2)
+            matrix.refresh()
+            self.assertEqual(os.stat(matrix.matrix_file).st_ino, inode)
+            self.assertEqual(matrix.meta["stats"], matrix._get_state()[0]["stats"])
+            designations = matrix.get_designations([1], ["abcZ"])
+            self.assertTrue(designations[1]["abcZ"])
+
+            # Readers find out if the matrix has gone, e.g. after a failure.
+            os.remove(matrix.meta_file)
+            with self.assertRaises(RuntimeError):
+                matrix.get_designations([1], ["abcZ"])
+        self.db.rollback()
+
+    def test_get_table_change_fingerprint(self):
+        fingerprint = self.datastore.get_table_change_fingerprint(["loci", "schemes"])
+        self.assertEqual(
+            fingerprint,
+            self.datastore.get_table_change_fingerprint(["loci", "schemes"]),
+        )
+        self.assertNotEqual(
+            fingerprint, self.datastore.get_table_change_fingerprint(["loci"])
+        )
+        self.db.rollback()
+
+    def test_get_isolate_data_fingerprint(self):
+        fingerprint = self.datastore.get_isolate_data_fingerprint()
+        self.assertEqual(fingerprint, self.datastore.get_isolate_data_fingerprint())
+        self.db.rollback()
+
+    def test_isolate_data_fingerprint_changes(self):
+        for table in ["users", "user_group_members", "project_members"]:
+            fingerprint = self.datastore.get_isolate_data_fingerprint()
+            self.db.rollback()
+            cursor = self.db.cursor()
+            cursor.execute(f"UPDATE {table} SET datestamp=datestamp")
+            if cursor.rowcount == 0:
+                self.db.rollback()
+                continue
+            self.db.commit()
+            self.assertTrue(wait_for_change(self.datastore, fingerprint), table)
+        seqdef_db = psycopg2.connect(
+            dbname=TEST_SEQDEF_DATABASE,
+            host=HOST,
+            port=PORT,
+            user=USER,
+            password=PASSWORD,
+        )
+        fingerprint = self.datastore.get_isolate_data_fingerprint()
+        self.db.rollback()
+        cursor = seqdef_db.cursor()
+        cursor.execute("UPDATE profiles SET datestamp=datestamp")
+        seqdef_db.commit()
+        seqdef_db.close()
+        self.assertTrue(wait_for_change(self.datastore, fingerprint))
+        fingerprint = self.datastore.get_isolate_data_fingerprint()
+        view_key = "base_view" if "base_view" in self.system else "view"
+        view = self.system.get(view_key)
+        self.system[view_key] = "temp_view"
+        self.assertNotEqual(fingerprint, self.datastore.get_isolate_data_fingerprint())
+        self.system[view_key] = view
+        self.db.rollback()
+
     def test_get_scheme_info(self):
         info = self.datastore.get_scheme_info(1)
         self.assertEqual(info["name"], "MLST")
@@ -326,12 +555,110 @@ class TestDatastore(unittest.TestCase):
         self.assertIn("3751", values.get("ST", {}))
         self.assertIn("ST-11 complex", values.get("clonal_complex", {}))
 
+    def test_scheme_get_field_values_by_designations_with_index(self):
+        scheme = self.datastore.get_scheme(scheme_id=1)
+        designations = {
+            "abcZ": [{"allele_id": "2"}],
+            "adk": [{"allele_id": "3"}],
+            "aroE": [{"allele_id": "4"}, {"allele_id": "9"}],
+            "fumC": [{"allele_id": "3"}],
+            "gdh": [{"allele_id": "8"}],
+            "pdhC": [{"allele_id": "4"}],
+            "pgm": [{"allele_id": "6"}],
+        }
+        values = scheme.get_field_values_by_designations(designations)
+        indexed_values = scheme.get_field_values_by_designations(
+            designations, {"use_index": True}
+        )
+        self.assertCountEqual(
+            [value["ST"] for value in indexed_values],
+            [value["ST"] for value in values],
+        )
+        self.assertIn("11", [value["ST"] for value in indexed_values])
+
+    def test_get_scheme_field_values_by_isolate_ids(self):
+        values = self.datastore.get_scheme_field_values_by_isolate_ids([1, 2, 3], 1)
+        for isolate_id in [1, 2, 3]:
+            self.assertEqual(
+                values[isolate_id],
+                self.datastore.get_scheme_field_values_by_isolate_id(isolate_id, 1),
+            )
+
     def test_get_scheme_allele_designations(self):
         designations = self.datastore.get_scheme_allele_designations(
             isolate_id=3, scheme_id=1
         )
         self.assertEqual(designations["abcZ"][0]["allele_id"], "119")
 
+    def test_pooled_connection(self):
+        data_connector = DataConnector(
+            system=self.system, config=self.config, pooled=True
+        )
+        db = data_connector.get_connection(
+            dbase_name=TEST_ISOLATE_DATABASE,
+            host=HOST,
+            port=PORT,
+            user=USER,
+            password=PASSWORD,
+        )
+        self.assertIs(
+            db,
+            data_connector.get_connection(
+                dbase_name=TEST_ISOLATE_DATABASE,
+                host=HOST,
+                port=PORT,
+                user=USER,
+                password=PASSWORD,
+            ),
+        )
+        db.close()
+        new_db = data_connector.get_connection(
+            dbase_name=TEST_ISOLATE_DATABASE,
+            host=HOST,
+            port=PORT,
+            user=USER,
+            password=PASSWORD,
+        )
+        self.assertIsNot(db, new_db)
+        self.assertFalse(new_db.closed)
+        data_connector.release_connections()
+        stats = data_connector.get_pool_stats()
+        self.assertEqual(stats[f"{HOST}|{TEST_ISOLATE_DATABASE}"]["idle"], 1)
+        data_connector.drop_all_connections()
+
+    def test_pooled_connection_released(self):
+        data_connector = DataConnector(
+            system=self.system, config=self.config, pooled=True
+        )
+        connection_args = {
+            "dbase_name": TEST_ISOLATE_DATABASE,
+            "host": HOST,
+            "port": PORT,
+            "user": USER,
+            "password": PASSWORD,
+        }
+        db = data_connector.get_connection(**connection_args)
+        cursor = db.cursor()
+        cursor.execute("SELECT 1")
+        stats = data_connector.get_pool_stats()[f"{HOST}|{TEST_ISOLATE_DATABASE}"]
+        self.assertEqual(stats["in_use"], 1)
+        self.assertEqual(stats["idle"], 0)
+
+        # The lease is returned to the pool (with its transaction ended) and
+        # the same connection is leased again for the next job.
+        data_connector.release_connections()
+        stats = data_connector.get_pool_stats()[f"{HOST}|{TEST_ISOLATE_DATABASE}"]
+        self.assertEqual(stats["in_use"], 0)
+        self.assertEqual(stats["idle"], 1)
+        self.assertEqual(
+            db.info.transaction_status, psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        )
+        self.assertIs(data_connector.get_connection(**connection_args), db)
+        stats = data_connector.get_pool_stats()[f"{HOST}|{TEST_ISOLATE_DATABASE}"]
+        self.assertEqual(stats["in_use"], 1)
+        self.assertEqual(stats["reconnects"], 0)
+        data_connector.drop_all_connections()
+
     @classmethod
     def setUpClass(cls):
         cls.con = psycopg2.connect(dbname="postgres")
@@ -453,6 +780,18 @@ class TestDatastore(unittest.TestCase):
         cur.execute(f"DROP USER {USER}")
 
 
+# Statistics counters are updated shortly after a transaction commits.
+def wait_for_change(datastore, fingerprint, timeout=10):
+    start = time.time()
+    while time.time() - start < timeout:
+        new_fingerprint = datastore.get_isolate_data_fingerprint()
+        datastore.db.rollback()
+        if new_fingerprint != fingerprint:
+            return True
+        time.sleep(0.2)
+    return False
+
+
 def database_exists(conn, db_name):
     cursor = conn.cursor()
     query = "SELECT 1 FROM pg_database WHERE datname = %s"
@@ -0,0 +1,67 @@
+# Written by Keith Jolley
+# Copyright (c) 2024, University of Oxford
+# E-mail: keith.jolley@biology.ox.ac.uk
+#
+# This file is part of BIGSdb Python Toolkit.
+#
+# BIGSdb Python Toolkit is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BIGSdb Python Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BIGSdb Python Toolkit. If not,
+# see <https://www.gnu.org/licenses/>.
+
+import sys
+import os
+import tempfile
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import bigsdb.excel_writer as excel_writer
+from bigsdb.excel_writer import ExcelWriter
+
+
+class TestExcelWriter(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, "test.xlsx")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_write_rows(self):
+        with ExcelWriter(
+            self.filename, ["id", "isolate", "country"], {"worksheet": "Export"}
+        ) as writer:
+            writer.write_row([1, "A4/M1027", "USA"])
+            writer.write_row([2, "120M", "Pakistan"])
+        with zipfile.ZipFile(self.filename) as xlsx:
+            workbook = xlsx.read("xl/workbook.xml").decode()
+            self.assertIn('name="Export"', workbook)
+            sheet = xlsx.read("xl/worksheets/sheet1.xml").decode()
+            self.assertIn("Pakistan", sheet)
+            self.assertIn("<v>2</v>", sheet)  # Numbers are written as numbers.
+
+    def test_worksheet_rollover(self):
+        max_rows = excel_writer.MAX_ROWS
+        excel_writer.MAX_ROWS = 10
+        try:
+            writer = ExcelWriter(self.filename, ["id"], {"worksheet": "Export"})
+            for i in range(25):
+                writer.write_row([i])
+            writer.close()
+        finally:
+            excel_writer.MAX_ROWS = max_rows
+        self.assertEqual(len(writer.worksheets), 3)
+        with zipfile.ZipFile(self.filename) as xlsx:
+            workbook = xlsx.read("xl/workbook.xml").decode()
+            self.assertIn('name="Export (3)"', workbook)
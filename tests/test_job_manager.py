@@ -0,0 +1,470 @@
+# Written by Keith Jolley
+# Copyright (c) 2024, University of Oxford
+# E-mail: keith.jolley@biology.ox.ac.uk
+#
+# This file is part of BIGSdb Python Toolkit.
+#
+# BIGSdb Python Toolkit is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BIGSdb Python Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BIGSdb Python Toolkit. If not,
+# see <https://www.gnu.org/licenses/>.
+
+import sys
+import os
+import pathlib
+import tempfile
+import logging
+import time
+import unittest
+from unittest.mock import patch
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from bigsdb.base_application import BaseApplication
+from bigsdb.data_connector import DataConnector
+from bigsdb.job_manager import JobManager, JobScheduler
+from bigsdb.job_worker import JobWorker
+
+TEST_JOBS_DATABASE = "bigsdb_test_jobs"
+HOST = "localhost"
+PORT = 5432
+USER = "bigsdb_tests"
+PASSWORD = "test"
+PERSIST = True  # Set to False to drop and recreate test databases each time.
+
+
+# Plugin run by the JobWorker tests. The action job parameter sets whether a
+# job finishes, fails or is cancelled.
+TEST_PLUGIN = """
+from bigsdb.base_application import BaseApplication
+from bigsdb.data_connector import DataConnector
+from bigsdb.job_manager import JobManager
+
+
+class WorkerTestPlugin(BaseApplication):
+    instances = []
+
+    def __init__(
+        self,
+        database=None,
+        config_dir=None,
+        dbase_config_dir=None,
+        logger=None,
+        run_job=None,
+        options={},
+    ):
+        super().__init__(config_dir=config_dir, logger=logger, testing=True)
+        self._read_db_config_file()
+        self._read_host_mapping_file()
+        self.data_connector = DataConnector(
+            system={},
+            config=self.config,
+            logger=logger,
+            pooled=options.get("pooled_connections", False),
+        )
+        self.job_manager = JobManager(
+            data_connector=self.data_connector,
+            system={},
+            config=self.config,
+            logger=logger,
+        )
+        WorkerTestPlugin.instances.append(self)
+
+    def initiate_job(self, job_id):
+        self.job_manager.last_cancel_check = {}
+        self.job_manager._db_connect()
+
+    def run_job(self, job_id):
+        action = self.job_manager.get_job_params(job_id).get("action")
+        if action == "fail":
+            raise ValueError("Job failed.")
+        if action == "cancel":
+            self.job_manager.cancel_job(job_id)
+            self.job_manager.check_cancelled(job_id)
+"""
+
+
+class TestJobManager(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestJobManager, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        cursor = self.db.cursor()
+        for table in ["jobs", "archived_jobs"] + [
+            f"archived_{table}"
+            for table in ["params", "isolates", "profiles", "loci", "output"]
+        ]:
+            cursor.execute(f"DELETE FROM {table}")
+        self.db.commit()
+
+    def add_job(self, options={}):
+        params = {
+            "dbase_config": "test",
+            "ip_address": "127.0.0.1",
+            "module": "Export",
+            "username": "test",
+            "email": "test@test.com",
+            "parameters": {"set_id": 1},
+            "isolates": [1, 2, 3],
+        }
+        params.update(options)
+        job_id = self.job_manager.add_job(params)
+        return job_id, self.job_manager.get_job_status(job_id)
+
+    def finish_job(self, job_id):
+        filename = f"{job_id}.txt"
+        with open(os.path.join(self.config["tmp_dir"], filename), "w") as f:
+            f.write("output")
+        self.job_manager.update_job_output(
+            job_id, {"filename": filename, "description": "01_Output"}
+        )
+        self.job_manager.update_job_status(
+            job_id, {"status": "finished", "stop_time": "now"}
+        )
+
+    def test_add_job_rows(self):
+        job_id, status = self.add_job(
+            {
+                "parameters": {
+                    "set_id": 1,
+                    "title": "Tab\tnew line\nbackslash\\",
+                    "fields": ["id", "isolate"],
+                    "empty": "",
+                    "scheme_id": 1,
+                },
+                "isolates": list(range(1, 1001)),
+                "profiles": ["1", "2"],
+                "loci": ["abcZ", "adk"],
+            }
+        )
+        self.assertEqual(status.get("status"), "submitted")
+        params = self.job_manager.get_job_params(job_id)
+        self.assertEqual(params["title"], "Tab\tnew line\nbackslash\\")
+        self.assertEqual(params["fields"], "id||isolate")
+        self.assertNotIn("empty", params)
+        self.assertEqual(
+            self.job_manager.get_job_isolates(job_id), list(range(1, 1001))
+        )
+        self.assertEqual(self.job_manager.get_job_loci(job_id), ["abcZ", "adk"])
+        cursor = self.db.cursor()
+        cursor.execute(
+            "SELECT scheme_id,profile_id FROM profiles WHERE job_id=%s ORDER BY "
+            "profile_id",
+            [job_id],
+        )
+        self.assertEqual(cursor.fetchall(), [(1, "1"), (1, "2")])
+        self.db.rollback()
+
+    def test_fair_share_scheduling(self):
+        user1_jobs = [self.add_job({"isolates": [i]})[0] for i in range(1, 4)]
+        user2_job, _ = self.add_job({"username": "test2"})
+        scheduler = JobScheduler(self.job_manager)
+        claimed = [scheduler.claim_next_job()["id"] for _ in range(4)]
+
+        # The second user's job runs before the first user's remaining jobs.
+        self.assertEqual(claimed, [user1_jobs[0], user2_job] + user1_jobs[1:])
+        self.assertIsNone(scheduler.claim_next_job())
+        self.assertEqual(
+            self.job_manager.get_job_status(user2_job)["status"], "started"
+        )
+
+    def test_scheduling_caps_and_modules(self):
+        user1_jobs = [self.add_job({"isolates": [i]})[0] for i in range(1, 3)]
+        user2_job, _ = self.add_job({"username": "test2", "module": "Other"})
+        scheduler = JobScheduler(self.job_manager, {"max_running_per_user": 1})
+        self.assertEqual(scheduler.claim_next_job(["Export"])["id"], user1_jobs[0])
+
+        # Only one job can run for each user, and only for the modules given.
+        self.assertIsNone(scheduler.claim_next_job(["Export"]))
+        self.assertEqual(scheduler.claim_next_job()["id"], user2_job)
+        self.assertIsNone(scheduler.claim_next_job())
+        metrics = scheduler.get_queue_metrics()
+        self.assertEqual(metrics["queued"], 1)
+        self.assertEqual(metrics["running"], 2)
+        self.assertEqual(metrics["dbases"]["test"]["queued_owners"], 1)
+
+    def test_job_worker(self):
+        with tempfile.TemporaryDirectory() as dir:
+            module_dir = os.path.join(dir, "plugins")
+            config_dir = os.path.join(dir, "config")
+            os.mkdir(module_dir)
+            os.mkdir(config_dir)
+            with open(os.path.join(module_dir, "WorkerTestPlugin.py"), "w") as f:
+                f.write(TEST_PLUGIN)
+            with open(os.path.join(config_dir, "bigsdb.conf"), "w") as f:
+                f.write(f"jobs_db={TEST_JOBS_DATABASE}\ntmp_dir={dir}\n")
+            with open(os.path.join(config_dir, "db.conf"), "w") as f:
+                f.write(
+                    f"dbhost={HOST}\ndbport={PORT}\ndbuser={USER}\n"
+                    f"dbpassword={PASSWORD}\n"
+                )
+            job_ids = [
+                self.add_job(
+                    {"module": "WorkerTestPlugin", "parameters": {"action": action}}
+                )[0]
+                for action in ["finish", "fail", "finish", "cancel", "finish"]
+            ]
+            worker = JobWorker(
+                module_dir=module_dir,
+                config_dir=config_dir,
+                logger=self.job_manager.logger,
+                options={"max_jobs": 5, "poll_interval": 0},
+            )
+            worker.run()
+            self.assertEqual(
+                [
+                    self.job_manager.get_job_status(job_id)["status"]
+                    for job_id in job_ids
+                ],
+                ["finished", "failed", "finished", "cancelled", "finished"],
+            )
+
+            # A new plugin object is made after each job that doesn't finish.
+            plugin_class = sys.modules["WorkerTestPlugin"].WorkerTestPlugin
+            self.assertEqual(len(plugin_class.instances), 3)
+
+            # Connections are returned to their pools at the end of each job
+            # and the shared listener is closed when the worker stops.
+            plugin = worker.plugins["WorkerTestPlugin|test"]
+            self.assertIs(plugin, plugin_class.instances[-1])
+            for data_connector in [worker.data_connector, plugin.data_connector]:
+                for stats in data_connector.get_pool_stats().values():
+                    self.assertEqual(stats["in_use"], 0)
+            self.assertIsNone(worker.job_manager.listener)
+            for plugin in plugin_class.instances:
+                plugin.data_connector.drop_all_connections()
+            worker.data_connector.drop_all_connections()
+
+    def test_reuse_cached_output(self):
+        cache_params = {"result_cache_ttl": 600, "data_fingerprint": "data1"}
+        job_id, _ = self.add_job(cache_params)
+        self.finish_job(job_id)
+        cached_job_id, status = self.add_job(cache_params)
+        self.assertEqual(status.get("status"), "finished")
+        self.assertEqual(
+            self.job_manager.get_job_output(cached_job_id)[0]["filename"],
+            f"{cached_job_id}.txt",
+        )
+
+        # Not re-used once the data have changed.
+        new_job_id, status = self.add_job(
+            {"result_cache_ttl": 600, "data_fingerprint": "data2"}
+        )
+        self.assertEqual(status.get("status"), "submitted")
+        self.assertEqual(self.job_manager.get_job_output(new_job_id), [])
+
+        # Not re-used unless the plugin allows it.
+        self.job_manager.update_job_status(
+            new_job_id, {"status": "failed", "stop_time": "now"}
+        )
+        _, status = self.add_job({"data_fingerprint": "data1"})
+        self.assertEqual(status.get("status"), "submitted")
+
+    def test_admission(self):
+        job_id, status = self.add_job()
+        self.assertEqual(status.get("status"), "submitted")
+        _, status = self.add_job()
+        self.assertEqual(status.get("status"), f"rejected - duplicate job ({job_id})")
+        _, status = self.add_job({"isolates": [1, 2]})
+        self.assertEqual(status.get("status"), "submitted")
+        self.system["user_job_quota"] = 2
+        _, status = self.add_job({"isolates": [1]})
+        self.assertTrue(status.get("status").startswith("rejected"))
+        del self.system["user_job_quota"]
+
+    def test_admission_error(self):
+        self.assertIsNone(
+            self.job_manager._check_admission({"ip_address": object()}, "test")
+        )
+
+        # Jobs are rejected if the checks cannot be made.
+        with patch.object(JobManager, "_check_admission", return_value=None):
+            job_id, status = self.add_job()
+        self.assertTrue(status.get("status").startswith("rejected"))
+        job_id, status = self.add_job()
+        self.assertEqual(status.get("status"), "submitted")
+
+    def test_archive_jobs(self):
+        job_ids = []
+        for i in range(5):
+            job_id, _ = self.add_job({"isolates": [i + 1]})
+            self.finish_job(job_id)
+            job_ids.append(job_id)
+        active_job_id, _ = self.add_job({"isolates": [10]})
+        cursor = self.db.cursor()
+        cursor.execute(
+            "UPDATE jobs SET submit_time=submit_time-interval '100 days',"
+            "stop_time=stop_time-interval '100 days'"
+        )
+        self.db.commit()
+        self.assertEqual(self.job_manager.archive_jobs({"batch_size": 2}), 5)
+        cursor.execute("SELECT id FROM jobs")
+        self.assertEqual([row[0] for row in cursor.fetchall()], [active_job_id])
+        cursor.execute("SELECT COUNT(*) FROM archived_jobs")
+        self.assertEqual(cursor.fetchone()[0], 5)
+        cursor.execute("SELECT COUNT(*) FROM archived_isolates")
+        self.assertEqual(cursor.fetchone()[0], 5)
+        cursor.execute("SELECT COUNT(*) FROM archived_output")
+        self.assertEqual(cursor.fetchone()[0], 5)
+        self.db.commit()
+        self.assertEqual(self.job_manager.archive_jobs(), 0)
+
+    def test_archive_jobs_error(self):
+        job_id, _ = self.add_job()
+        self.finish_job(job_id)
+        cursor = self.db.cursor()
+        cursor.execute(
+            "UPDATE jobs SET stop_time=stop_time-interval '100 days' WHERE id=%s",
+            [job_id],
+        )
+        self.db.commit()
+
+        # The archive table is owned by the user that created the database.
+        admin_db = psycopg2.connect(dbname=TEST_JOBS_DATABASE)
+        admin_cursor = admin_db.cursor()
+        admin_cursor.execute("ALTER TABLE archived_loci RENAME TO archived_loci_tmp")
+        admin_db.commit()
+        try:
+            with self.assertRaises(psycopg2.Error):
+                self.job_manager.archive_jobs()
+        finally:
+            admin_cursor.execute(
+                "ALTER TABLE archived_loci_tmp RENAME TO archived_loci"
+            )
+            admin_db.commit()
+            admin_db.close()
+        self.assertEqual(self.job_manager.get_job_status(job_id)["status"], "finished")
+        self.db.rollback()
+
+    def test_listener(self):
+        listener = self.job_manager.listen()
+        try:
+            events = []
+            listener.subscribe(events.append, events=["submitted"])
+            job_id, _ = self.add_job()
+            for _ in range(10):
+                if events:
+                    break
+                listener.wait(1)
+            self.assertEqual(events[0]["job_id"], job_id)
+
+            # Cancellation is picked up from the notification.
+            self.assertFalse(self.job_manager.is_job_cancelled(job_id))
+            self.job_manager.cancel_job(job_id)
+            cancelled = False
+            for _ in range(10):
+                cancelled = self.job_manager.is_job_cancelled(job_id)
+                if cancelled:
+                    break
+                time.sleep(0.2)
+            self.assertTrue(cancelled)
+            self.job_manager.update_job_status(
+                job_id, {"status": "cancelled", "stop_time": "now"}
+            )
+            self.assertNotIn(job_id, listener.cancelled)
+            self.assertNotIn(job_id, self.job_manager.last_cancel_check)
+        finally:
+            self.job_manager.close_listener()
+        self.assertIsNone(self.job_manager.listener)
+        self.assertTrue(listener.db.closed)
+
+    def test_cancel_without_listener(self):
+        job_manager = JobManager(
+            data_connector=self.data_connector,
+            system=self.system,
+            config=dict(self.config),
+            logger=self.job_manager.logger,
+        )
+        job_id, _ = self.add_job()
+        self.assertFalse(job_manager.is_job_cancelled(job_id))
+        self.job_manager.cancel_job(job_id)
+
+        # The table is only checked again after the poll interval.
+        self.assertFalse(job_manager.is_job_cancelled(job_id))
+        job_manager.config["job_cancel_poll_interval"] = 0
+        self.assertTrue(job_manager.is_job_cancelled(job_id))
+        self.assertIsNone(job_manager.listener)
+
+    @classmethod
+    def setUpClass(cls):
+        cls.con = psycopg2.connect(dbname="postgres")
+        dir = pathlib.Path(__file__).parent.resolve()
+        if not PERSIST or not database_exists(cls.con, TEST_JOBS_DATABASE):
+            cls.con.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            cur = cls.con.cursor()
+            cur.execute(f"DROP DATABASE IF EXISTS {TEST_JOBS_DATABASE}")
+            cur.execute(f"SELECT EXISTS(SELECT * FROM pg_roles WHERE rolname='{USER}')")
+            if not cur.fetchone()[0]:
+                cur.execute(f"CREATE USER {USER}")
+                cur.execute(f"ALTER USER {USER} WITH PASSWORD '{PASSWORD}'")
+            cur.execute(f"CREATE DATABASE {TEST_JOBS_DATABASE}")
+            cls.con.close()
+            cls.con = psycopg2.connect(dbname=TEST_JOBS_DATABASE)
+            cur = cls.con.cursor()
+            with open(f"{dir}/databases/bigsdb_test_jobs.sql", "r") as f:
+                cur.execute(f.read())
+            cur.execute(
+                "GRANT SELECT, INSERT, UPDATE, DELETE ON ALL TABLES "
+                f"IN SCHEMA public TO {USER}"
+            )
+            cls.con.commit()
+            cur.close()
+        cls.con.close()
+
+        # Read BIGSdb config file
+        conf_file = f"{dir}/config_files/bigsdb.conf"
+        cls.application = BaseApplication(testing=True)
+        cls.config = cls.application._read_config_file(filename=conf_file)
+        cls.config["host_map"] = {}
+        cls.config["jobs_db"] = TEST_JOBS_DATABASE
+        cls.config["dbhost"] = HOST
+        cls.config["dbport"] = PORT
+        cls.config["dbuser"] = USER
+        cls.config["dbpassword"] = PASSWORD
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.config["tmp_dir"] = cls.tmp_dir.name
+        cls.system = {"db": "test"}
+
+        logger = logging.getLogger("test_job_manager")
+        logger.addHandler(logging.NullHandler())
+        cls.data_connector = DataConnector(
+            system=cls.system, config=cls.config, logger=logger
+        )
+        cls.job_manager = JobManager(
+            data_connector=cls.data_connector,
+            system=cls.system,
+            config=cls.config,
+            logger=logger,
+        )
+        cls.db = cls.job_manager.db
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.data_connector.drop_all_connections()
+        cls.tmp_dir.cleanup()
+        if PERSIST:
+            return
+        cls.con = psycopg2.connect(dbname="postgres")
+        cls.con.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        cur = cls.con.cursor()
+        cur.execute(f"DROP DATABASE {TEST_JOBS_DATABASE}")
+
+
+def database_exists(conn, db_name):
+    cursor = conn.cursor()
+    query = "SELECT 1 FROM pg_database WHERE datname = %s"
+    cursor.execute(query, (db_name,))
+    result = cursor.fetchone()
+    cursor.close()
+    return result is not None
@@ -0,0 +1,115 @@
+# Written by Keith Jolley
+# Copyright (c) 2024, University of Oxford
+# E-mail: keith.jolley@biology.ox.ac.uk
+#
+# This file is part of BIGSdb Python Toolkit.
+#
+# BIGSdb Python Toolkit is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BIGSdb Python Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BIGSdb Python Toolkit. If not,
+# see <https://www.gnu.org/licenses/>.
+
+import sys
+import os
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from bigsdb.metadata_snapshot import (
+    MetadataSnapshot,
+    exit_snapshots,
+    save_exit_snapshots,
+)
+
+
+class TestMetadataSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, "cache", "test.pickle")
+        self.fingerprint = "a"
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def get_snapshot(self):
+        snapshot = MetadataSnapshot(
+            filename=self.filename,
+            get_fingerprint=lambda: self.fingerprint,
+            options={"check_interval": 0},
+        )
+        snapshot.refresh()
+        return snapshot
+
+    def test_shared_between_instances(self):
+        snapshot = self.get_snapshot()
+        self.assertNotIn("loci", snapshot)
+        snapshot["loci"] = ["abcZ", "adk"]
+        snapshot.save()
+        snapshot = self.get_snapshot()
+        self.assertEqual(snapshot["loci"], ["abcZ", "adk"])
+
+    def test_invalidated_by_fingerprint(self):
+        snapshot = self.get_snapshot()
+        snapshot["loci"] = ["abcZ", "adk"]
+        snapshot.save()
+        self.fingerprint = "b"
+        snapshot.refresh()
+        self.assertNotIn("loci", snapshot)
+        self.assertNotIn("loci", self.get_snapshot())
+
+    def test_merge_on_save(self):
+        first = self.get_snapshot()
+        second = self.get_snapshot()
+        first["loci"] = ["abcZ"]
+        second["schemes"] = [1]
+        first.save()
+        second.save()
+        snapshot = self.get_snapshot()
+        self.assertEqual(snapshot["loci"], ["abcZ"])
+        self.assertEqual(snapshot["schemes"], [1])
+
+    def test_not_used_if_dir_not_private(self):
+        snapshot = self.get_snapshot()
+        snapshot["loci"] = ["abcZ"]
+        snapshot.save()
+        os.chmod(os.path.dirname(self.filename), 0o777)
+        self.assertNotIn("loci", self.get_snapshot())
+        snapshot = self.get_snapshot()
+        snapshot["schemes"] = [1]
+        snapshot.save()
+        os.chmod(os.path.dirname(self.filename), 0o700)
+        snapshot = self.get_snapshot()
+        self.assertIn("loci", snapshot)
+        self.assertNotIn("schemes", snapshot)
+
+    def test_saved_at_exit_once_per_file(self):
+        first = self.get_snapshot()
+        first["loci"] = ["abcZ"]
+        second = self.get_snapshot()
+
+        # The earlier snapshot is saved when it is replaced.
+        self.assertIs(exit_snapshots[self.filename], second)
+        self.assertIn("loci", self.get_snapshot())
+        third = exit_snapshots[self.filename]
+        third["schemes"] = [1]
+        save_exit_snapshots()
+        self.assertIn("schemes", self.get_snapshot())
+
+    def test_none_not_stored(self):
+        snapshot = self.get_snapshot()
+        snapshot["scheme_info"] = None
+        self.assertNotIn("scheme_info", snapshot)
+        self.fingerprint = None
+        snapshot.refresh()
+        snapshot["loci"] = ["abcZ"]
+        self.assertNotIn("loci", snapshot)
@@ -0,0 +1,56 @@
+# Written by Keith Jolley
+# Copyright (c) 2024, University of Oxford
+# E-mail: keith.jolley@biology.ox.ac.uk
+#
+# This file is part of BIGSdb Python Toolkit.
+#
+# BIGSdb Python Toolkit is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BIGSdb Python Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BIGSdb Python Toolkit. If not,
+# see <https://www.gnu.org/licenses/>.
+
+import sys
+import os
+import gzip
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from bigsdb.parallel_gzip import ParallelGzipWriter, gzip_file
+
+
+class TestParallelGzip(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_writer(self):
+        filename = os.path.join(self.dir.name, "test.txt.gz")
+        lines = [f"{i}\tisolate_{i}\n" for i in range(10000)]
+        with ParallelGzipWriter(filename, {"threads": 4, "block_size": 1000}) as f:
+            for line in lines:
+                f.write(line)
+        with gzip.open(filename, "rt") as f:
+            self.assertEqual(f.read(), "".join(lines))
+
+    def test_gzip_file(self):
+        in_path = os.path.join(self.dir.name, "test.txt")
+        out_path = f"{in_path}.gz"
+        data = os.urandom(5000) + b"abc\n" * 10000
+        with open(in_path, "wb") as f:
+            f.write(data)
+        gzip_file(in_path, out_path, {"threads": 2, "block_size": 4096, "level": 1})
+        with gzip.open(out_path, "rb") as f:
+            self.assertEqual(f.read(), data)
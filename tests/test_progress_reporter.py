@@ -0,0 +1,110 @@
+# Written by Keith Jolley
+# Copyright (c) 2024, University of Oxford
+# E-mail: keith.jolley@biology.ox.ac.uk
+#
+# This file is part of BIGSdb Python Toolkit.
+#
+# BIGSdb Python Toolkit is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BIGSdb Python Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BIGSdb Python Toolkit. If not,
+# see <https://www.gnu.org/licenses/>.
+
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from bigsdb.job_manager import ProgressReporter
+
+
+# Records the writes and cancellation checks that a ProgressReporter makes
+# instead of using the jobs database.
+class FakeJobManager:
+    def __init__(self, config={}):
+        self.config = config
+        self.writes = []
+        self.cancel_checks = 0
+
+    def _write_job_status(self, job_id, status_dict):
+        self.writes.append(dict(status_dict))
+
+    def check_cancelled(self, job_id):
+        self.cancel_checks += 1
+
+
+class TestProgressReporter(unittest.TestCase):
+    def setUp(self):
+        self.job_manager = FakeJobManager()
+
+    def get_reporter(self, options={}):
+        return ProgressReporter(
+            self.job_manager,
+            "job1",
+            {"interval": 3600, "step": 5, "cancel_check_interval": 3600, **options},
+        )
+
+    def test_progress_throttled_by_step(self):
+        reporter = self.get_reporter()
+        for percent_complete in range(1, 5):
+            reporter.set_progress(percent_complete)
+        self.assertEqual(self.job_manager.writes, [])
+        reporter.set_progress(5)
+        self.assertEqual(self.job_manager.writes, [{"percent_complete": 5}])
+        for percent_complete in range(6, 10):
+            reporter.set_progress(percent_complete)
+        reporter.set_progress(10)
+        self.assertEqual(len(self.job_manager.writes), 2)
+
+    def test_stage_and_completion_written_immediately(self):
+        reporter = self.get_reporter()
+        reporter.set_progress(2)
+        reporter.update({"stage": "Exporting"})
+        self.assertEqual(
+            self.job_manager.writes, [{"percent_complete": 2, "stage": "Exporting"}]
+        )
+
+        # Unchanged values are not written again.
+        reporter.update({"stage": "Exporting"})
+        self.assertEqual(len(self.job_manager.writes), 1)
+        reporter.set_progress(3)
+        reporter.finish({"percent_complete": 100, "stage": "Finished"})
+        self.assertEqual(
+            self.job_manager.writes[-1], {"percent_complete": 100, "stage": "Finished"}
+        )
+        reporter.finish()
+        self.assertEqual(len(self.job_manager.writes), 2)
+
+    def test_interval(self):
+        reporter = self.get_reporter({"interval": 0})
+        reporter.set_progress(1)
+        reporter.set_progress(2)
+        self.assertEqual(
+            self.job_manager.writes, [{"percent_complete": 1}, {"percent_complete": 2}]
+        )
+
+    def test_cancel_checks(self):
+        reporter = self.get_reporter()
+        for percent_complete in range(10):
+            reporter.set_progress(percent_complete)
+        self.assertEqual(self.job_manager.cancel_checks, 0)
+        reporter = self.get_reporter({"cancel_check_interval": 0})
+        for percent_complete in range(10):
+            reporter.set_progress(percent_complete)
+        self.assertEqual(self.job_manager.cancel_checks, 10)
+
+    def test_config_defaults(self):
+        self.job_manager.config = {"job_progress_interval": 10, "job_progress_step": 2}
+        reporter = ProgressReporter(self.job_manager, "job1")
+        self.assertEqual(reporter.interval, 10)
+        self.assertEqual(reporter.step, 2)
+        self.assertEqual(reporter.cancel_check_interval, 10)
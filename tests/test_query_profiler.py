@@ -0,0 +1,81 @@
+# Written by Keith Jolley
+# Copyright (c) 2024, University of Oxford
+# E-mail: keith.jolley@biology.ox.ac.uk
+#
+# This file is part of BIGSdb Python Toolkit.
+#
+# BIGSdb Python Toolkit is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BIGSdb Python Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BIGSdb Python Toolkit. If not,
+# see <https://www.gnu.org/licenses/>.
+
+import sys
+import os
+import json
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from bigsdb.query_profiler import QueryProfiler, normalise_statement
+
+
+class TestQueryProfiler(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.profiler = QueryProfiler(
+            profile_dir=self.dir.name, options={"n_plus_one_threshold": 3}
+        )
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_normalise_statement(self):
+        self.assertEqual(
+            normalise_statement(
+                "SELECT * FROM isolates WHERE id IN (1, 2,3) AND\n  country='UK'"
+            ),
+            "SELECT * FROM isolates WHERE id IN (?) AND country=?",
+        )
+        self.assertEqual(
+            normalise_statement("SELECT name FROM temp_list_12 WHERE id=%s"),
+            "SELECT name FROM temp_list_12 WHERE id=?",
+        )
+
+    def test_profile(self):
+        for id in range(1, 5):
+            self.profiler.record(f"SELECT * FROM loci WHERE id={id}", 0.01, 1)
+        self.profiler.record("SELECT * FROM schemes", 0.5, 20)
+        profile = self.profiler.get_profile()
+        self.assertEqual(profile["queries"], 5)
+        slowest, loci = profile["statements"]
+        self.assertEqual(slowest["rows"], 20)
+        self.assertFalse(slowest["n_plus_one"])
+        self.assertEqual(loci["count"], 4)
+        self.assertEqual(loci["rows"], 4)
+        self.assertTrue(loci["n_plus_one"])
+
+    def test_finish(self):
+        self.profiler.set_run_name("test_job_1")
+        self.profiler.record("SELECT * FROM schemes", 0.5, 20)
+        self.profiler.finish()
+        files = os.listdir(self.dir.name)
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].startswith("test_job_1_"))
+        with open(os.path.join(self.dir.name, files[0])) as f:
+            profile = json.load(f)
+        self.assertEqual(profile["statements"][0]["statement"], "SELECT * FROM schemes")
+        self.assertEqual(self.profiler.get_profile()["queries"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
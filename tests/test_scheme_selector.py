@@ -0,0 +1,151 @@
+# Written by Keith Jolley
+# Copyright (c) 2024, University of Oxford
+# E-mail: keith.jolley@biology.ox.ac.uk
+#
+# This file is part of BIGSdb Python Toolkit.
+#
+# BIGSdb Python Toolkit is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BIGSdb Python Toolkit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BIGSdb Python Toolkit. If not,
+# see <https://www.gnu.org/licenses/>.
+
+import sys
+import os
+import pathlib
+import time
+import unittest
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from bigsdb.base_application import BaseApplication
+from bigsdb.data_connector import DataConnector
+from bigsdb.datastore import Datastore
+from bigsdb.scheme_selector import SchemeSelector
+from bigsdb.xml_parser import XMLParser
+
+TEST_ISOLATE_DATABASE = "bigsdb_test_isolates"
+HOST = "localhost"
+PORT = 5432
+USER = "bigsdb_tests"
+PASSWORD = "test"
+
+
+class TestSchemeSelector(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestSchemeSelector, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        self.prefs = {
+            "isolate_display_schemes": {},
+            "analysis_schemes": {},
+            "disable_schemes": {},
+        }
+        self.scheme_selector = SchemeSelector(
+            datastore=self.datastore, prefs=self.prefs, params={}
+        )
+
+    def test_get_tree(self):
+        tree = self.scheme_selector.get_tree({"select_schemes": 1})
+        self.assertIn("MLST", tree)
+        self.assertEqual(tree, self.scheme_selector.get_tree({"select_schemes": 1}))
+        groups = self.scheme_selector.get_tree({"get_groups": 1})
+        self.assertIsInstance(groups, set)
+        self.db.rollback()
+
+    def test_tree_updated_when_schemes_change(self):
+        tree = self.scheme_selector.get_tree({"select_schemes": 1})
+        self.db.rollback()
+        cursor = self.db.cursor()
+        cursor.execute("UPDATE schemes SET name='MLST_renamed' WHERE id=1")
+        self.db.commit()
+        try:
+            start = time.time()
+            while time.time() - start < 10:
+                new_tree = self.scheme_selector.get_tree({"select_schemes": 1})
+                self.db.rollback()
+                if new_tree != tree:
+                    break
+                time.sleep(0.2)
+            self.assertIn("MLST_renamed", new_tree)
+        finally:
+            cursor.execute("UPDATE schemes SET name='MLST' WHERE id=1")
+            self.db.commit()
+
+    @classmethod
+    def setUpClass(cls):
+        dir = pathlib.Path(__file__).parent.resolve()
+        cls.con = psycopg2.connect(dbname="postgres")
+        if not database_exists(cls.con, TEST_ISOLATE_DATABASE):
+            cls.con.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            cur = cls.con.cursor()
+            cur.execute(f"SELECT EXISTS(SELECT * FROM pg_roles WHERE rolname='{USER}')")
+            if not cur.fetchone()[0]:
+                cur.execute(f"CREATE USER {USER}")
+                cur.execute(f"ALTER USER {USER} WITH PASSWORD '{PASSWORD}'")
+            cur.execute(f"CREATE DATABASE {TEST_ISOLATE_DATABASE}")
+            cls.con.close()
+            cls.con = psycopg2.connect(dbname=TEST_ISOLATE_DATABASE)
+            cur = cls.con.cursor()
+            with open(f"{dir}/databases/bigsdb_test_isolates.sql", "r") as f:
+                cur.copy_expert(sql=f.read(), file=f)
+            cur.execute(
+                "GRANT SELECT, INSERT, UPDATE, DELETE ON ALL TABLES "
+                f"IN SCHEMA public TO {USER}"
+            )
+            cls.con.commit()
+            cur.close()
+        cls.con.close()
+
+        # Read BIGSdb config file
+        conf_file = f"{dir}/config_files/bigsdb.conf"
+        cls.application = BaseApplication(testing=True)
+        cls.config = cls.application._read_config_file(filename=conf_file)
+        cls.config["host_map"] = {}
+        cls.config["dbuser"] = USER
+        cls.config["dbpassword"] = PASSWORD
+
+        # Read database config
+        dbase_config = f"{dir}/config_files/config.xml"
+        cls.parser = XMLParser()
+        cls.parser.parse(dbase_config)
+        cls.system = cls.parser.get_system()
+
+        cls.data_connector = DataConnector(system=cls.system, config=cls.config)
+        cls.db = cls.data_connector.get_connection(
+            dbase_name=TEST_ISOLATE_DATABASE,
+            host=HOST,
+            port=PORT,
+            user=USER,
+            password=PASSWORD,
+        )
+        cls.datastore = Datastore(
+            db=cls.db,
+            system=cls.system,
+            config=cls.config,
+            parser=cls.parser,
+            data_connector=cls.data_connector,
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
+
+
+def database_exists(conn, db_name):
+    cursor = conn.cursor()
+    query = "SELECT 1 FROM pg_database WHERE datname = %s"
+    cursor.execute(query, (db_name,))
+    result = cursor.fetchone()
+    cursor.close()
+    return result is not None
@@ -60,6 +60,12 @@ class TestUtils(unittest.TestCase):
             escaped, "&lt;script&gt;alert(&quot;test&quot;)&lt;/script&gt;"
         )
 
+    def test_escape_copy_value(self):
+        self.assertEqual(utils.escape_copy_value("abc"), "abc")
+        self.assertEqual(utils.escape_copy_value(5), "5")
+        self.assertEqual(utils.escape_copy_value(None), "\\N")
+        self.assertEqual(utils.escape_copy_value("a\tb\nc\\d\re"), "a\\tb\\nc\\\\d\\re")
+
     def test_get_random(self):
         result = utils.get_random()
         self.assertTrue(isinstance(result, str))
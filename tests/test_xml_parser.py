@@ -59,6 +59,12 @@ class TestXmlParser(unittest.TestCase):
         self.assertEqual(len(options), 10)
         self.assertEqual(options[2], "eye")
 
+    def test_field_option_list_cached(self):
+        options = self.parser.get_field_option_list("source")
+        options.append("other")
+        self.assertEqual(len(self.parser.get_field_option_list("source")), 10)
+        self.assertIs(xml_parser.get_collator(), xml_parser.get_collator())
+
     def test_is_field(self):
         self.assertTrue(self.parser.is_field("isolate"))
         self.assertFalse(self.parser.is_field("area"))